@@ -678,6 +678,21 @@ def pad_msa(np_example, min_num_seq):
     return np_example
 
 
+def read_indexed_file(
+    alignment_dir: str,
+    alignment_index: Any,
+    name: str,
+) -> Optional[str]:
+    """Reads one file of a chain from its alignment db, None if the db does not hold it."""
+    for (file, start, size) in alignment_index["files"]:
+        if(file == name):
+            with open(os.path.join(alignment_dir, alignment_index["db"]), "rb") as fp:
+                fp.seek(start)
+                return fp.read(size).decode("utf-8")
+
+    return None
+
+
 class DataPipeline:
     """Assembles input features."""
     def __init__(
@@ -764,6 +779,13 @@ class DataPipeline:
                         input_sequence,
                     )
                     all_hits[name] = hits
+                elif(name == "hmm_output.sto"):
+                    hits = parsers.parse_hmmsearch_sto(
+                        read_template(start, size),
+                        input_sequence,
+                        chain_features,
+                    )
+                    all_hits[name] = hits
 
             fp.close()
         else:
@@ -1112,18 +1134,27 @@ class DataPipelineMultimer:
             sequence: str,
             description: str,
             chain_alignment_dir: str,
-            is_homomer_or_monomer: bool
+            is_homomer_or_monomer: bool,
+            chain_alignment_index: Optional[Any] = None,
     ) -> FeatureDict:
         """Runs the monomer pipeline on a single chain."""
         chain_fasta_str = f'>{chain_id}\n{sequence}\n'
-        if not os.path.exists(chain_alignment_dir):
+        if chain_alignment_index is None and not os.path.exists(chain_alignment_dir):
             raise ValueError(f"Alignments for {chain_id} not found...")
         with temp_fasta_file(chain_fasta_str) as chain_fasta_path:
             chain_features = {}
-            # Add antibody-specific features, if available
-            if os.path.exists(os.path.join(chain_alignment_dir, "region_index.json")):
+            if chain_alignment_index is not None:
+                region_index_str = read_indexed_file(
+                    chain_alignment_dir, chain_alignment_index, "region_index.json"
+                )
+            elif os.path.exists(os.path.join(chain_alignment_dir, "region_index.json")):
                 with open(os.path.join(chain_alignment_dir, "region_index.json"), "r") as fp:
-                    region_index = json.load(fp)
+                    region_index_str = fp.read()
+            else:
+                region_index_str = None
+            # Add antibody-specific features, if available
+            if region_index_str is not None:
+                region_index = json.loads(region_index_str)
                 chain_features["region_index"] = region_index
                 chain_features["chaintype_id"] = np.repeat(CHAIN_TO_ID[region_index["chain_type"]], len(sequence))
                 region_id = np.zeros(len(sequence))
@@ -1142,6 +1173,7 @@ class DataPipelineMultimer:
             seq_chain_features = self._monomer_data_pipeline.process_fasta(
                 fasta_path=chain_fasta_path,
                 alignment_dir=chain_alignment_dir,
+                alignment_index=chain_alignment_index,
                 chain_features=chain_features,
             )
             chain_features.update(seq_chain_features)
@@ -1151,17 +1183,24 @@ class DataPipelineMultimer:
             if not is_homomer_or_monomer:
                 all_seq_msa_features = self._all_seq_msa_features(
                     chain_fasta_path,
-                    chain_alignment_dir
+                    chain_alignment_dir,
+                    chain_alignment_index,
                 )
                 chain_features.update(all_seq_msa_features)
                 
         return chain_features
 
-    def _all_seq_msa_features(self, fasta_path, alignment_dir):
+    def _all_seq_msa_features(self, fasta_path, alignment_dir, alignment_index=None):
         """Get MSA features for unclustered paired msa."""
-        paired_msa_path = os.path.join(alignment_dir, "paired_hits.a3m")
-        with open(paired_msa_path, "r") as fp:
-            uniprot_msa_string = fp.read()
+        uniprot_msa_string = None
+        if alignment_index is not None:
+            uniprot_msa_string = read_indexed_file(
+                alignment_dir, alignment_index, "paired_hits.a3m"
+            )
+        if uniprot_msa_string is None:
+            paired_msa_path = os.path.join(alignment_dir, "paired_hits.a3m")
+            with open(paired_msa_path, "r") as fp:
+                uniprot_msa_string = fp.read()
         msa = parsers.parse_a3m(uniprot_msa_string)
         all_seq_features = make_msa_features([msa], deduplication=False)
         valid_feats = msa_pairing.MSA_FEATURES + (
@@ -1176,8 +1215,14 @@ class DataPipelineMultimer:
     def process_fasta(self,
                       fasta_path: str,
                       alignment_dir: str,
+                      alignment_index: Optional[Any] = None,
                       ) -> FeatureDict:
-        """Creates features."""
+        """Creates features.
+        
+        alignment_index optionally maps chain names to their index in
+        a packed alignment db, see utils/alignment_db.py. Chains missing
+        from it are read from their alignment directory.
+        """
         with open(fasta_path) as f:
             input_fasta_str = f.read()
 
@@ -1198,7 +1243,10 @@ class DataPipelineMultimer:
                 sequence=seq,
                 description=desc,
                 chain_alignment_dir=os.path.join(alignment_dir, desc),
-                is_homomer_or_monomer=is_homomer_or_monomer
+                is_homomer_or_monomer=is_homomer_or_monomer,
+                chain_alignment_index=(
+                    alignment_index.get(desc) if alignment_index is not None else None
+                ),
             )
 
             chain_features = convert_monomer_features(
@@ -0,0 +1,203 @@
+"""Pre-parsed store of template mmCIF chains.
+
+Parsing the full mmCIF of every template hit with Biopython dominates template
+featurization. The store keeps, for every chain of every mmCIF file, the atom37
+positions and masks needed by the template featurizer in a single binary file,
+with a JSON index holding the sequences, release dates and chain offsets:
+
+    <store>.db       float32 atom37 positions followed by the uint8 atom37 mask
+                     of every chain, each chain aligned to 4 bytes.
+    <store>.index    {pdb_id: {"release_date": str,
+                               "chain_to_seqres": {chain_id: seqres},
+                               "chains": {chain_id: [start, num_res]},
+                               "chain_errors": {chain_id: [error type, message]},
+                               "errors": {chain_id: message}}}
+
+Chains are read from a read-only memory map of the db file, no mmCIF is parsed.
+"""
+import dataclasses
+import json
+import os
+from typing import Any, Mapping, Optional, Tuple
+
+import numpy as np
+
+from openfold.data import mmcif_parsing
+from openfold.data.errors import MultipleChainsError
+from openfold.np import residue_constants
+
+DB_SUFFIX = ".db"
+INDEX_SUFFIX = ".index"
+
+
+def parse_mmcif_chains(file_id: str, mmcif_string: str) -> Tuple[dict, list]:
+    """Parses an mmCIF string into a store index entry and its chain arrays.
+
+    Returns:
+        A tuple with the index entry of the file, without chain offsets, and a
+        list of (chain_id, positions, mask) tuples.
+    """
+    parsing_result = mmcif_parsing.parse(
+        file_id=file_id, mmcif_string=mmcif_string
+    )
+    errors = {
+        chain_id: str(error)
+        for (_, chain_id), error in parsing_result.errors.items()
+    }
+    mmcif_object = parsing_result.mmcif_object
+    if mmcif_object is None:
+        return {"errors": errors}, []
+
+    entry = {
+        "release_date": mmcif_object.header["release_date"],
+        "chain_to_seqres": dict(mmcif_object.chain_to_seqres),
+        "chain_errors": {},
+        "errors": errors,
+    }
+    chains = []
+    for chain_id in mmcif_object.chain_to_seqres:
+        try:
+            # Positions are stored without zero centering, it is applied on read.
+            positions, mask = mmcif_parsing.get_atom_coords(
+                mmcif_object=mmcif_object, chain_id=chain_id
+            )
+        except Exception as e:
+            entry["chain_errors"][chain_id] = [type(e).__name__, str(e)]
+            continue
+        chains.append(
+            (chain_id, positions.astype(np.float32), mask.astype(np.uint8))
+        )
+
+    return entry, chains
+
+
+class MmcifStoreWriter:
+    """Writes the entries of parse_mmcif_chains to a store."""
+
+    def __init__(self, store_path: str):
+        self.db_path = store_path + DB_SUFFIX
+        self.index_path = store_path + INDEX_SUFFIX
+        # Write to temporary files first so readers never see a partial store.
+        self._tmp_db_path = "{}.{}.tmp".format(self.db_path, os.getpid())
+        self._tmp_index_path = "{}.{}.tmp".format(self.index_path, os.getpid())
+        self._db_f = open(self._tmp_db_path, "wb")
+        self._start = 0
+        self.index = {}
+
+    def add(self, file_id: str, entry: dict, chains: list):
+        entry = dict(entry)
+        entry["chains"] = {}
+        for chain_id, positions, mask in chains:
+            data = positions.tobytes() + mask.tobytes()
+            data += b"\0" * (-len(data) % 4)
+            self._db_f.write(data)
+            entry["chains"][chain_id] = [self._start, positions.shape[0]]
+            self._start += len(data)
+        self.index[file_id] = entry
+
+    def close(self):
+        self._db_f.close()
+        with open(self._tmp_index_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(self._tmp_db_path, self.db_path)
+        os.replace(self._tmp_index_path, self.index_path)
+
+
+@dataclasses.dataclass(frozen=True)
+class StoredMmcifObject:
+    """The parts of a MmcifObject used by the template featurizer, read from a store.
+
+    Contains:
+        file_id: The PDB ID of the entry.
+        header: Dict holding the release date of the entry.
+        chain_to_seqres: Dict mapping chain_id to 1 letter amino acid sequence.
+        store: The MmcifStore holding the atom data of the chains.
+    """
+    file_id: str
+    header: Mapping[str, Any]
+    chain_to_seqres: Mapping[str, str]
+    store: Any
+
+
+class MmcifStore:
+    """Reads pre-parsed template chains from a store written by MmcifStoreWriter."""
+
+    def __init__(self, store_path: str):
+        self.db_path = store_path + DB_SUFFIX
+        with open(store_path + INDEX_SUFFIX, "r") as f:
+            self._index = json.load(f)
+        self._db = None
+
+    def __contains__(self, pdb_id: str) -> bool:
+        return pdb_id in self._index
+
+    def _get_db(self) -> np.ndarray:
+        # Mapped on first use, so the store can be opened before forking workers.
+        if self._db is None:
+            self._db = np.memmap(self.db_path, dtype=np.uint8, mode="r")
+        return self._db
+
+    def parse(self, pdb_id: str) -> mmcif_parsing.ParsingResult:
+        """Returns the stored entry of pdb_id like mmcif_parsing.parse."""
+        entry = self._index[pdb_id]
+        errors = {
+            (pdb_id, chain_id): error
+            for chain_id, error in entry.get("errors", {}).items()
+        }
+        if "chain_to_seqres" not in entry:
+            return mmcif_parsing.ParsingResult(mmcif_object=None, errors=errors)
+
+        mmcif_object = StoredMmcifObject(
+            file_id=pdb_id,
+            header={"release_date": entry["release_date"]},
+            chain_to_seqres=entry["chain_to_seqres"],
+            store=self,
+        )
+        return mmcif_parsing.ParsingResult(
+            mmcif_object=mmcif_object, errors=errors
+        )
+
+    def get_atom_coords(
+        self,
+        pdb_id: str,
+        chain_id: str,
+        _zero_center_positions: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the atom37 positions and mask of a chain like mmcif_parsing.get_atom_coords."""
+        entry = self._index[pdb_id]
+        if chain_id in entry["chain_errors"]:
+            error_type, message = entry["chain_errors"][chain_id]
+            if error_type == MultipleChainsError.__name__:
+                raise MultipleChainsError(message)
+            raise KeyError(message)
+        if chain_id not in entry["chains"]:
+            raise MultipleChainsError(
+                f"Expected exactly one chain in structure with id {chain_id}."
+            )
+
+        start, num_res = entry["chains"][chain_id]
+        atom_num = residue_constants.atom_type_num
+        positions_size = num_res * atom_num * 3 * 4
+        db = self._get_db()
+        all_atom_positions = np.frombuffer(
+            db[start : start + positions_size].tobytes(), dtype=np.float32
+        ).reshape(num_res, atom_num, 3).copy()
+        all_atom_mask = db[
+            start + positions_size : start + positions_size + num_res * atom_num
+        ].reshape(num_res, atom_num).astype(np.float32)
+
+        if _zero_center_positions:
+            binary_mask = all_atom_mask.astype(bool)
+            translation_vec = all_atom_positions[binary_mask].mean(axis=0)
+            all_atom_positions[binary_mask] -= translation_vec
+
+        return all_atom_positions, all_atom_mask
+
+
+def load_mmcif_store(store_path: Optional[str]) -> Optional[MmcifStore]:
+    """Opens the store at store_path, None if no store is given."""
+    if not store_path:
+        return None
+    if store_path.endswith(INDEX_SUFFIX):
+        store_path = store_path[: -len(INDEX_SUFFIX)]
+    return MmcifStore(store_path)
@@ -26,6 +26,7 @@ DeletionMatrix = Sequence[Sequence[int]]
 
 import numpy as np
 from utils.blosum import cal_blusom_score, parse_blosum_matrix, blosum80_str
+from utils.msa_codec import split_deletions as split_a3m_deletions
 
 
 def cal_sequence_identity(
@@ -132,14 +133,15 @@ def parse_fasta(fasta_string: str) -> Tuple[Sequence[str], Sequence[str]]:
         if line.startswith(">"):
             index += 1
             descriptions.append(line[1:])  # Remove the '>' at the beginning.
-            sequences.append("")
+            sequences.append([])
             continue
         elif line.startswith("#"):
             continue
         elif not line:
             continue  # Skip blank lines.
-        sequences[index] += line
+        sequences[index].append(line)
 
+    sequences = ["".join(lines) for lines in sequences]
     return sequences, descriptions
 
 
@@ -221,21 +223,17 @@ def parse_a3m(a3m_string: str) -> Msa:
                 the aligned sequence i at residue position j.
     """
     sequences, descriptions = parse_fasta(a3m_string) 
-    deletion_matrix = []
-    for msa_sequence in sequences:
-        deletion_vec = []
-        deletion_count = 0
-        for j in msa_sequence:
-            if j.islower():
-                deletion_count += 1
-            else:
-                deletion_vec.append(deletion_count)
-                deletion_count = 0
-        deletion_matrix.append(deletion_vec)
-
-    # Make the MSA matrix out of aligned (deletion-free) sequences.
-    deletion_table = str.maketrans("", "", string.ascii_lowercase)
-    aligned_sequences = [s.translate(deletion_table) for s in sequences]
+    # Count and remove the lowercase residues of all sequences at once.
+    aligned, offsets, deletions = split_a3m_deletions(sequences)
+    aligned = aligned.tobytes().decode("ascii")
+    offsets = offsets.tolist()
+    deletions = deletions.tolist()
+    aligned_sequences = [
+        aligned[offsets[i] : offsets[i + 1]] for i in range(len(sequences))
+    ]
+    deletion_matrix = [
+        deletions[offsets[i] : offsets[i + 1]] for i in range(len(sequences))
+    ]
     return Msa(
         sequences=aligned_sequences, 
         deletion_matrix=deletion_matrix,
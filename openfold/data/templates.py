@@ -15,19 +15,22 @@
 
 """Functions for getting templates and calculating template features."""
 import abc
+import collections
+import contextlib
 import dataclasses
 import datetime
 import functools
-import glob
 import json
 import logging
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, Mapping, Optional, Sequence, Tuple
 
 import numpy as np
 
 from openfold.data import parsers, mmcif_parsing
+from openfold.data.mmcif_store import StoredMmcifObject, load_mmcif_store
 from openfold.data.errors import Error
 from openfold.data.tools import kalign
 from openfold.data.tools.utils import to_date
@@ -532,11 +535,18 @@ def _get_atom_positions(
     _zero_center_positions: bool = False,
 ) -> Tuple[np.ndarray, np.ndarray]:
     """Gets atom positions and mask from a list of Biopython Residues."""
-    coords_with_mask = mmcif_parsing.get_atom_coords(
-        mmcif_object=mmcif_object, 
-        chain_id=auth_chain_id,
-        _zero_center_positions=_zero_center_positions,
-    )
+    if isinstance(mmcif_object, StoredMmcifObject):
+        coords_with_mask = mmcif_object.store.get_atom_coords(
+            pdb_id=mmcif_object.file_id,
+            chain_id=auth_chain_id,
+            _zero_center_positions=_zero_center_positions,
+        )
+    else:
+        coords_with_mask = mmcif_parsing.get_atom_coords(
+            mmcif_object=mmcif_object, 
+            chain_id=auth_chain_id,
+            _zero_center_positions=_zero_center_positions,
+        )
     all_atom_positions, all_atom_mask = coords_with_mask
     _check_residue_distances(
         all_atom_positions, all_atom_mask, max_ca_ca_distance
@@ -833,8 +843,12 @@ def _process_single_hit(
     strict_error_check: bool = False,
     _zero_center_positions: bool = True,
     return_mmcif_result: bool = False,
+    mmcif_store=None,
 ) -> SingleHitResult:
-    """Tries to extract template features from a single HHSearch hit."""
+    """Tries to extract template features from a single HHSearch hit.
+
+    Entries of mmcif_store are read from the store instead of parsing their mmCIF.
+    """
     # Fail hard if we can't get the PDB ID and chain name from the hit.
     hit_pdb_code, hit_chain_id = _get_pdb_id_and_chain(hit)
 
@@ -862,12 +876,19 @@ def _process_single_hit(
         template_sequence,
     )
 
-    # Fail if we can't find the mmCIF file.
-    cif_string = _read_file(cif_path)
+    if (
+        mmcif_store is not None
+        and hit_pdb_code in mmcif_store
+        and not return_mmcif_result
+    ):
+        parsing_result = mmcif_store.parse(hit_pdb_code)
+    else:
+        # Fail if we can't find the mmCIF file.
+        cif_string = _read_file(cif_path)
 
-    parsing_result = mmcif_parsing.parse(
-        file_id=hit_pdb_code, mmcif_string=cif_string
-    )
+        parsing_result = mmcif_parsing.parse(
+            file_id=hit_pdb_code, mmcif_string=cif_string
+        )
     if return_mmcif_result:
         return parsing_result
 
@@ -998,6 +1019,49 @@ def get_custom_template_features(
 
 
 
+def _process_hits_in_order(process_hit, hits, max_workers: int = 1):
+    """Yields (hit, result) of process_hit for every hit, in the order of hits.
+
+    Up to max_workers hits are processed ahead in a thread pool, the time of a hit
+    is mostly spent in file reads and kalign subprocesses, so the GIL is not the
+    limit. Once the generator is closed, hits that are not started yet are cancelled.
+    """
+    if max_workers <= 1:
+        for hit in hits:
+            yield hit, process_hit(hit=hit)
+        return
+
+    hits = iter(hits)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = collections.deque()
+    try:
+        for hit in hits:
+            pending.append((hit, executor.submit(process_hit, hit=hit)))
+            if len(pending) >= max_workers:
+                break
+        while pending:
+            hit, future = pending.popleft()
+            next_hit = next(hits, None)
+            if next_hit is not None:
+                pending.append(
+                    (next_hit, executor.submit(process_hit, hit=next_hit))
+                )
+            yield hit, future.result()
+    finally:
+        # Do not wait for the hits already running, their results are not used.
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def _has_cif_files(mmcif_dir: str) -> bool:
+    """Whether mmcif_dir holds any CIF, stops at the first one instead of listing them all."""
+    if not os.path.isdir(mmcif_dir):
+        return False
+    with os.scandir(mmcif_dir) as entries:
+        return any(entry.name.endswith(".cif") for entry in entries)
+
+
 @dataclasses.dataclass(frozen=True)
 class TemplateSearchResult:
     features: Mapping[str, Any]
@@ -1018,6 +1082,8 @@ class TemplateHitFeaturizer(abc.ABC):
         strict_error_check: bool = False,
         _shuffle_top_k_prefiltered: Optional[int] = None,
         _zero_center_positions: bool = True,
+        mmcif_store_path: Optional[str] = None,
+        max_workers: int = 1,
     ):
         """Initializes the Template Search.
 
@@ -1041,9 +1107,16 @@ class TemplateHitFeaturizer(abc.ABC):
                 * If any template has identical PDB ID to the query.
                 * If any template is a duplicate of the query.
                 * Any feature computation errors.
+            mmcif_store_path: An optional path to a store of pre-parsed template
+                chains written by scripts/generate_mmcif_store.py. Templates in
+                the store are read from it instead of parsing their mmCIF files,
+                the others are still read from mmcif_dir.
+            max_workers: The number of hits processed in parallel threads. The
+                features are the same for any number of workers.
         """
         self._mmcif_dir = mmcif_dir
-        if not glob.glob(os.path.join(self._mmcif_dir, "*.cif")):
+        self._mmcif_store = load_mmcif_store(mmcif_store_path)
+        if self._mmcif_store is None and not _has_cif_files(self._mmcif_dir):
             logging.error("Could not find CIFs in %s", self._mmcif_dir)
             raise ValueError(f"Could not find CIFs in {self._mmcif_dir}")
 
@@ -1077,6 +1150,7 @@ class TemplateHitFeaturizer(abc.ABC):
 
         self._shuffle_top_k_prefiltered = _shuffle_top_k_prefiltered
         self._zero_center_positions = _zero_center_positions
+        self._max_workers = max_workers
 
     @abc.abstractmethod
     def get_templates(
@@ -1133,47 +1207,51 @@ class HhsearchHitFeaturizer(TemplateHitFeaturizer):
             stk = self._shuffle_top_k_prefiltered
             idx[:stk] = np.random.permutation(idx[:stk])
 
-        for i in idx:
-            # We got all the templates we wanted, stop processing hits.
-            if len(already_seen) >= self._max_hits:
-                break
-
-            hit = filtered[i]
-
-            result = _process_single_hit(
-                query_sequence=query_sequence,
-                hit=hit,
-                mmcif_dir=self._mmcif_dir,
-                max_template_date=self._max_template_date,
-                release_dates=self._release_dates,
-                obsolete_pdbs=self._obsolete_pdbs,
-                strict_error_check=self._strict_error_check,
-                kalign_binary_path=self._kalign_binary_path,
-                _zero_center_positions=self._zero_center_positions,
-            )
-
-            if result.error:
-                errors.append(result.error)
-
-            # There could be an error even if there are some results, e.g. thrown by
-            # other unparsable chains in the same mmCIF file.
-            if result.warning:
-                warnings.append(result.warning)
-
-            if result.features is None:
-                logging.info(
-                    "Skipped invalid hit %s, error: %s, warning: %s",
-                    hit.name,
-                    result.error,
-                    result.warning,
-                )
-            else:
-                already_seen_key = result.features["template_sequence"]
-                if(already_seen_key in already_seen):
-                    continue
-                already_seen.add(already_seen_key)
-                for k in template_features:
-                    template_features[k].append(result.features[k])
+        hits_in_order = [filtered[i] for i in idx] if self._max_hits > 0 else []
+        process_hit = functools.partial(
+            _process_single_hit,
+            query_sequence=query_sequence,
+            mmcif_dir=self._mmcif_dir,
+            max_template_date=self._max_template_date,
+            release_dates=self._release_dates,
+            obsolete_pdbs=self._obsolete_pdbs,
+            strict_error_check=self._strict_error_check,
+            kalign_binary_path=self._kalign_binary_path,
+            _zero_center_positions=self._zero_center_positions,
+            mmcif_store=self._mmcif_store,
+        )
+        # Hits are processed in a thread pool, the results are used in order so
+        # the features do not depend on the number of workers.
+        with contextlib.closing(
+            _process_hits_in_order(process_hit, hits_in_order, self._max_workers)
+        ) as results:
+            for hit, result in results:
+                if result.error:
+                    errors.append(result.error)
+
+                # There could be an error even if there are some results, e.g. thrown by
+                # other unparsable chains in the same mmCIF file.
+                if result.warning:
+                    warnings.append(result.warning)
+
+                if result.features is None:
+                    logging.info(
+                        "Skipped invalid hit %s, error: %s, warning: %s",
+                        hit.name,
+                        result.error,
+                        result.warning,
+                    )
+                else:
+                    already_seen_key = result.features["template_sequence"]
+                    if(already_seen_key in already_seen):
+                        continue
+                    already_seen.add(already_seen_key)
+                    for k in template_features:
+                        template_features[k].append(result.features[k])
+
+                # We got all the templates we wanted, stop processing hits.
+                if len(already_seen) >= self._max_hits:
+                    break
 
         if already_seen:
             for name in template_features:
@@ -1237,42 +1315,47 @@ class HmmsearchHitFeaturizer(TemplateHitFeaturizer):
             stk = self._shuffle_top_k_prefiltered
             idx[:stk] = np.random.permutation(idx[:stk])
 
-        for i in idx:
-            if(len(already_seen) >= self._max_hits):
-                break
-
-            hit = filtered[i]
-
-            result = _process_single_hit(
-                query_sequence=query_sequence,
-                hit=hit,
-                mmcif_dir=self._mmcif_dir,
-                max_template_date = self._max_template_date,
-                release_dates = self._release_dates,
-                obsolete_pdbs = self._obsolete_pdbs,
-                strict_error_check = self._strict_error_check,
-                kalign_binary_path = self._kalign_binary_path
-            )
-
-            if result.error:
-                errors.append(result.error)
-
-            if result.warning:
-                warnings.append(result.warning)
-
-            if result.features is None:
-                logging.debug(
-                    "Skipped invalid hit %s, error: %s, warning: %s",
-                    hit.name, result.error, result.warning,
-                )
-            else:
-                already_seen_key = result.features["template_sequence"]
-                if(already_seen_key in already_seen):
-                    continue
-                # Increment the hit counter, since we got features out of this hit.
-                already_seen.add(already_seen_key)
-                for k in template_features:
-                    template_features[k].append(result.features[k])
+        hits_in_order = [filtered[i] for i in idx] if self._max_hits > 0 else []
+        process_hit = functools.partial(
+            _process_single_hit,
+            query_sequence=query_sequence,
+            mmcif_dir=self._mmcif_dir,
+            max_template_date=self._max_template_date,
+            release_dates=self._release_dates,
+            obsolete_pdbs=self._obsolete_pdbs,
+            strict_error_check=self._strict_error_check,
+            kalign_binary_path=self._kalign_binary_path,
+            mmcif_store=self._mmcif_store,
+        )
+        # Hits are processed in a thread pool, the results are used in order so
+        # the features do not depend on the number of workers.
+        with contextlib.closing(
+            _process_hits_in_order(process_hit, hits_in_order, self._max_workers)
+        ) as results:
+            for hit, result in results:
+                if result.error:
+                    errors.append(result.error)
+
+                if result.warning:
+                    warnings.append(result.warning)
+
+                if result.features is None:
+                    logging.debug(
+                        "Skipped invalid hit %s, error: %s, warning: %s",
+                        hit.name, result.error, result.warning,
+                    )
+                else:
+                    already_seen_key = result.features["template_sequence"]
+                    if(already_seen_key in already_seen):
+                        continue
+                    # Increment the hit counter, since we got features out of this hit.
+                    already_seen.add(already_seen_key)
+                    for k in template_features:
+                        template_features[k].append(result.features[k])
+
+                # We got all the templates we wanted, stop processing hits.
+                if len(already_seen) >= self._max_hits:
+                    break
 
         if already_seen:
             for name in template_features:
@@ -32,7 +32,8 @@ class Hmmsearch(object):
         binary_path: str,
         hmmbuild_binary_path: str,
         database_path: str,
-        flags: Optional[Sequence[str]] = None
+        flags: Optional[Sequence[str]] = None,
+        n_cpu: int = 8
     ):
         """Initializes the Python hmmsearch wrapper.
 
@@ -42,6 +43,7 @@ class Hmmsearch(object):
                 an hmm from an input a3m.
             database_path: The path to the hmmsearch database (FASTA format).
             flags: List of flags to be used by hmmsearch.
+            n_cpu: The default number of CPUs to give hmmsearch.
 
         Raises:
             RuntimeError: If hmmsearch binary not found within the path.
@@ -59,6 +61,7 @@ class Hmmsearch(object):
                              '--domE', '100',
                              '--incdomE', '100']
         self.flags = flags
+        self.n_cpu = n_cpu
 
         if not os.path.exists(self.database_path):
             logging.error('Could not find hmmsearch database %s', database_path)
@@ -72,19 +75,29 @@ class Hmmsearch(object):
     def input_format(self) -> str:
         return 'sto'
 
-    def query(self, msa_sto: str, output_dir: Optional[str] = None) -> str:
-        """Queries the database using hmmsearch using a given stockholm msa."""
+    def query(self,
+        msa_sto: str,
+        output_dir: Optional[str] = None,
+        n_cpu: Optional[int] = None
+    ) -> str:
+        """Queries the database using hmmsearch using a given stockholm msa.
+
+        n_cpu overrides the number of CPUs of this call, so that concurrent
+        queries can share the CPUs of the machine.
+        """
         hmm = self.hmmbuild_runner.build_profile_from_sto(
             msa_sto,
             model_construction='hand'
         )
-        return self.query_with_hmm(hmm, output_dir)
+        return self.query_with_hmm(hmm, output_dir, n_cpu)
 
     def query_with_hmm(self, 
         hmm: str, 
-        output_dir: Optional[str] = None
+        output_dir: Optional[str] = None,
+        n_cpu: Optional[int] = None
     ) -> str:
         """Queries the database using hmmsearch using a given hmm."""
+        n_cpu = self.n_cpu if n_cpu is None else n_cpu
         with utils.tmpdir_manager() as query_tmp_dir:
             hmm_input_path = os.path.join(query_tmp_dir, 'query.hmm')
             output_dir = query_tmp_dir if output_dir is None else output_dir
@@ -95,7 +108,7 @@ class Hmmsearch(object):
             cmd = [
                     self.binary_path,
                     '--noali',    # Don't include the alignment in stdout.
-                    '--cpu', '8'
+                    '--cpu', str(n_cpu)
             ]
             # If adding flags, we have to do so before the output and input:
             if self.flags:
@@ -13,14 +13,21 @@ from tqdm import tqdm
 from openfold.data.mmcif_parsing import parse 
 
 
-def parse_file(f, args):
-    with open(os.path.join(args.mmcif_dir, f), "r") as fp:
-        mmcif_string = fp.read()
+def parse_file(f, mmcif_dir, record_failures=False):
     file_id = os.path.splitext(f)[0]
-    mmcif = parse(file_id=file_id, mmcif_string=mmcif_string)
+    try:
+        with open(os.path.join(mmcif_dir, f), "r") as fp:
+            mmcif_string = fp.read()
+        mmcif = parse(file_id=file_id, mmcif_string=mmcif_string)
+    except Exception as e:
+        if not record_failures:
+            raise
+        logging.info(f"Could not parse {f}: {e}. Skipping...")
+        return {file_id: {"error": str(e)}}
     if mmcif.mmcif_object is None:
         logging.info(f"Could not parse {f}. Skipping...")
-        return {}
+        # Without release_date, the entry is ignored by the release date readers.
+        return {file_id: {"error": "could not parse"}} if record_failures else {}
     else:
         mmcif = mmcif.mmcif_object
 
@@ -37,18 +44,52 @@ def parse_file(f, args):
     return {file_id: local_data}
 
 
-def main(args):
-    files = [f for f in os.listdir(args.mmcif_dir) if ".cif" in f]
-    fn = partial(parse_file, args=args)
+def generate_mmcif_cache(
+    mmcif_dir, output_path, no_workers=4, chunksize=10, reuse=False, record_failures=False
+):
+    """
+    Write the release date, chains and resolution of every mmCIF file in mmcif_dir
+    to output_path. With reuse, an existing cache is loaded and only the files
+    missing from it are parsed. With record_failures, files that cannot be read or
+    parsed get an entry with only an "error" field, so that they are not parsed again
+    on the next update; only use it for caches read as release dates.
+    """
     data = {}
-    with Pool(processes=args.no_workers) as p:
+    if reuse and os.path.exists(output_path):
+        with open(output_path, "r") as fp:
+            data = json.load(fp)
+
+    files = [
+        f for f in os.listdir(mmcif_dir)
+        if f.endswith(".cif") and os.path.splitext(f)[0] not in data
+    ]
+    if not files and os.path.exists(output_path):
+        return data
+
+    cached_count = len(data)
+    fn = partial(parse_file, mmcif_dir=mmcif_dir, record_failures=record_failures)
+    with Pool(processes=no_workers) as p:
         with tqdm(total=len(files)) as pbar:
-            for d in p.imap_unordered(fn, files, chunksize=args.chunksize):
+            for d in p.imap_unordered(fn, files, chunksize=chunksize):
                 data.update(d)
                 pbar.update()
+    # Without record_failures, files that cannot be parsed are retried on the next update.
+    if len(data) == cached_count and os.path.exists(output_path):
+        return data
 
-    with open(args.output_path, "w") as fp:
+    # Write to a temporary file first so readers never see a partial cache.
+    tmp_path = "{}.{}.tmp".format(output_path, os.getpid())
+    with open(tmp_path, "w") as fp:
         fp.write(json.dumps(data, indent=4))
+    os.replace(tmp_path, output_path)
+
+    return data
+
+
+def main(args):
+    generate_mmcif_cache(
+        args.mmcif_dir, args.output_path, args.no_workers, args.chunksize
+    )
 
 
 if __name__ == "__main__":
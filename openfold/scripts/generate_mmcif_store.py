@@ -0,0 +1,59 @@
+import argparse
+from functools import partial
+import logging
+from multiprocessing import Pool
+import os
+
+import sys
+sys.path.append(".") # an innocent hack to get this to run from the top level
+
+from tqdm import tqdm
+
+from openfold.data.mmcif_store import MmcifStoreWriter, parse_mmcif_chains
+
+
+def parse_file(f, args):
+    with open(os.path.join(args.mmcif_dir, f), "r") as fp:
+        mmcif_string = fp.read()
+    file_id = os.path.splitext(f)[0]
+    entry, chains = parse_mmcif_chains(file_id=file_id, mmcif_string=mmcif_string)
+    if "chain_to_seqres" not in entry:
+        logging.info(f"Could not parse {f}. Storing the errors only...")
+    return file_id, entry, chains
+
+
+def main(args):
+    files = [f for f in os.listdir(args.mmcif_dir) if f.endswith(".cif")]
+    fn = partial(parse_file, args=args)
+    writer = MmcifStoreWriter(args.output_path)
+    with Pool(processes=args.no_workers) as p:
+        with tqdm(total=len(files)) as pbar:
+            for file_id, entry, chains in p.imap_unordered(fn, files, chunksize=args.chunksize):
+                writer.add(file_id, entry, chains)
+                pbar.update()
+    writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert a template mmCIF directory to a store of pre-parsed chains."
+    )
+    parser.add_argument(
+        "mmcif_dir", type=str, help="Directory containing mmCIF files"
+    )
+    parser.add_argument(
+        "output_path", type=str,
+        help="Path of the store, <output_path>.db and <output_path>.index are written"
+    )
+    parser.add_argument(
+        "--no_workers", type=int, default=4,
+        help="Number of workers to use for parsing"
+    )
+    parser.add_argument(
+        "--chunksize", type=int, default=10,
+        help="How many files should be distributed to each worker at a time"
+    )
+
+    args = parser.parse_args()
+
+    main(args)
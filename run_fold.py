@@ -22,10 +22,14 @@ from utils import (
     save_msa,
     get_chain_info,
     get_msa,
+    alignment_db,
 )
+from utils.msa_cache import remove_run_msa_cache, remove_run_template_cache
 from scripts import search_template
+from openfold.scripts.generate_mmcif_cache import generate_mmcif_cache
 
 import argparse
+import json
 import logging
 import math
 import numpy as np
@@ -200,9 +204,18 @@ def generate_feature_dict(
     alignment_dir,
     data_processor,
     args,
+    alignment_index=None,
 ):
     tmp_fasta_path = os.path.join(args.output_dir, f"tmp_{os.getpid()}.fasta")
-    if len(seqs) == 1:
+    if "multimer" in args.config_preset:
+        with open(tmp_fasta_path, "w") as fp:
+            fp.write("\n".join([f">{tag}\n{seq}" for tag, seq in zip(tags, seqs)]))
+        feature_dict = data_processor.process_fasta(
+            fasta_path=tmp_fasta_path,
+            alignment_dir=alignment_dir,
+            alignment_index=alignment_index,
+        )
+    elif len(seqs) == 1:
         tag = tags[0]
         seq = seqs[0]
         with open(tmp_fasta_path, "w") as fp:
@@ -212,13 +225,6 @@ def generate_feature_dict(
         feature_dict = data_processor.process_fasta(
             fasta_path=tmp_fasta_path, alignment_dir=alignment_dir
         )
-    elif "multimer" in args.config_preset:
-        with open(tmp_fasta_path, "w") as fp:
-            fp.write("\n".join([f">{tag}\n{seq}" for tag, seq in zip(tags, seqs)]))
-        feature_dict = data_processor.process_fasta(
-            fasta_path=tmp_fasta_path,
-            alignment_dir=alignment_dir,
-        )
     else:
         with open(tmp_fasta_path, "w") as fp:
             fp.write("\n".join([f">{tag}\n{seq}" for tag, seq in zip(tags, seqs)]))
@@ -275,6 +281,39 @@ def relax_protein_thread(
         print(f"Relaxation failed: {e}")
 
 
+def get_release_dates_path(args):
+    """
+    Path of the release date and resolution cache of the template mmCIFs, given by
+    --release_dates_path or next to the mmCIF dir by default. The cache is built with
+    the generate_mmcif_cache.py logic on first use, later runs only parse new mmCIFs.
+    """
+    release_dates_path = args.release_dates_path
+    if release_dates_path is None:
+        release_dates_path = os.path.normpath(args.template_mmcif_dir) + "_cache.json"
+    if not os.path.isdir(args.template_mmcif_dir):
+        return release_dates_path if os.path.exists(release_dates_path) else None
+
+    try:
+        generate_mmcif_cache(
+            args.template_mmcif_dir,
+            release_dates_path,
+            no_workers=max(1, args.cpus),
+            reuse=True,
+            record_failures=True,
+        )
+    except Exception as e:
+        # Templates are still featurized without the cache, a failed update must not stop inference.
+        print("Build release date cache failed: {}".format(e))
+        try:
+            with open(release_dates_path, "r") as fp:
+                json.load(fp)
+        except (OSError, ValueError):
+            return None
+        return release_dates_path
+
+    return release_dates_path
+
+
 def interface(args):
     # Create the output directory
     os.makedirs(args.output_dir, exist_ok=True)
@@ -305,6 +344,9 @@ def interface(args):
             )
 
     is_multimer = "multimer" in args.config_preset
+    release_dates_path = get_release_dates_path(args)
+    # Template hits are processed in parallel threads, at most max_templates hits ahead.
+    template_workers = max(1, min(args.cpus, config.data.predict.max_templates))
 
     if is_multimer:
         template_searcher = hmmsearch.Hmmsearch(
@@ -319,6 +361,9 @@ def interface(args):
             max_hits=config.data.predict.max_templates,
             kalign_binary_path=args.kalign_binary_path,
             obsolete_pdbs_path=args.obsolete_pdbs_path,
+            mmcif_store_path=args.template_mmcif_store,
+            release_dates_path=release_dates_path,
+            max_workers=template_workers,
         )
     else:
         template_searcher = hhsearch.HHSearch(
@@ -332,6 +377,9 @@ def interface(args):
             max_hits=config.data.predict.max_templates,
             kalign_binary_path=args.kalign_binary_path,
             obsolete_pdbs_path=args.obsolete_pdbs_path,
+            mmcif_store_path=args.template_mmcif_store,
+            release_dates_path=release_dates_path,
+            max_workers=template_workers,
         )
 
     data_processor = data_pipeline.DataPipeline(
@@ -358,6 +406,11 @@ def interface(args):
     else:
         alignment_dir = args.use_precomputed_alignments
 
+    # Read the features of the packed chains through the index of the alignment db.
+    alignment_index = None
+    if args.pack_alignments:
+        alignment_index = alignment_db.load_alignment_index(alignment_dir)
+
     tag_list = []
     seq_list = []
     for fasta_file in list_files_with_extensions(
@@ -426,6 +479,7 @@ def interface(args):
                 alignment_dir,
                 data_processor,
                 args,
+                alignment_index=alignment_index,
             )
             
             with_other_domain = False # Check if there are regions other than the antibody variable region
@@ -809,6 +863,9 @@ def main(args):
         os.makedirs(alignment_dir)
 
     args.temp_dir = os.path.join(args.temp_dir, str(os.getpid()))
+    if args.scratch_dir is not None:
+        os.makedirs(args.scratch_dir, exist_ok=True)
+        align.init_scratch_root(args.scratch_dir)
 
     # write antibody sequence to temp dir
     abseq_temp_dir = os.path.join(os.path.join(args.temp_dir, "input_fasta"))
@@ -822,23 +879,32 @@ def main(args):
         # get antibody specific msas
         batch_size = 500 # Limit the thread pool size to prevent tasks from getting stuck
         antibody_list_full = get_chain_info.get_chain_info(args=args)
-        for batch_i in range(0, len(antibody_list_full), batch_size):
-            antibody_list = antibody_list_full[batch_i:batch_i+batch_size]
-            # get msa
-            database.init_databases_path(database_path=args.databases_path)
-            get_msa.get_msa(args=args, antibody_list=antibody_list) # all
-            
-            # get antibody region file
-            get_antibody_region.write_regions(alignment_dir, antibody_list, args=args) 
-
-            # padding the antibody msas
-            msa_supplement.padding_msas(args)
-
-            # TODO: 构建inner_paired_msa和outer_paired_msa
-            msa_supplement.merge_msas(args, antibody_list, alignment_dir)
-
-            # search template
-            search_template.search(alignment_dir, antibody_list, args)
+        # Chains are deduplicated within a batch, the run MSA cache is only needed across batches.
+        args.run_msa_cache = len(antibody_list_full) > batch_size
+        try:
+            for batch_i in range(0, len(antibody_list_full), batch_size):
+                antibody_list = antibody_list_full[batch_i:batch_i+batch_size]
+                # get msa
+                database.init_databases_path(database_path=args.databases_path)
+                get_msa.get_msa(args=args, antibody_list=antibody_list) # all
+                
+                # get antibody region files, pad the antibody msas and
+                # merge the msas of multi-domain chains in one pass
+                # TODO: 构建inner_paired_msa和outer_paired_msa
+                msa_supplement.process_msas(args, antibody_list, alignment_dir)
+
+                # search template
+                search_template.search(alignment_dir, antibody_list, args)
+
+                # pack the alignments of the batch into one db file
+                if args.pack_alignments:
+                    chain_names = [name for ab in antibody_list for name in ab.names_to_seqs]
+                    alignment_db.pack_alignments(
+                        alignment_dir, chain_names, "alignments_{}".format(batch_i // batch_size)
+                    )
+        finally:
+            remove_run_msa_cache(args)
+            remove_run_template_cache(args)
 
         time_end = time.time()
         print("\n* Build alignments time: {}s\n".format(time_end - time_start))
@@ -968,6 +1034,12 @@ if __name__ == "__main__":
         default="/tmp/AbCFold",
         help="Path to directory containing temporary files.",
     )
+    parser.add_argument(
+        "--scratch_dir",
+        type=str,
+        default=None,
+        help="Root of the scratch directories of Abalign, /dev/shm if it is available by default.",
+    )
     parser.add_argument(
         "--fold_type",
         type=str,
@@ -980,6 +1052,56 @@ if __name__ == "__main__":
         default=False,
         help="Skip the output file that already exists.",
     )
+    parser.add_argument(
+        "--realign_threads",
+        type=int,
+        default=4,
+        help="""The number of threads used by each Abalign realignment call. 
+        cpus // realign_threads calls run at the same time.""",
+    )
+    parser.add_argument(
+        "--batch_realign",
+        action="store_true",
+        default=False,
+        help="""Realign the MSAs queued while all Abalign calls are busy together in one 
+        batched Abalign call. Experimental: the identity cutoff of Abalign may act across 
+        the MSAs of a batch, so the MSAs can differ from the ones aligned one by one.""",
+    )
+    parser.add_argument(
+        "--pack_alignments",
+        action="store_true",
+        default=False,
+        help="""Pack the alignments of every batch into one db file with a json index 
+        after they are built, and read the features of the packed chains through the index.""",
+    )
+    parser.add_argument(
+        "--msa_cache_dir",
+        type=str,
+        default=None,
+        help="""Path to a persistent cache of the realigned MSAs, shared across batches and runs. 
+        MSAs of chains already in the cache are copied from it instead of being rebuilt. 
+        If not set and the run has more than one batch, a cache in the temp dir is shared 
+        across the batches of this run only.""",
+    )
+    parser.add_argument(
+        "--msa_cache_size",
+        type=float,
+        default=50,
+        help="Maximum size of the MSA cache in GB, the least recently used MSAs are evicted first.",
+    )
+    parser.add_argument(
+        "--template_cache_dir",
+        type=str,
+        default=None,
+        help="""Path to a persistent cache of the hmmsearch template hits, shared across batches and runs. 
+        If not set, a cache in the temp dir is shared across the batches of this run only.""",
+    )
+    parser.add_argument(
+        "--template_cache_size",
+        type=float,
+        default=10,
+        help="Maximum size of the template hit cache in GB, the least recently used hits are evicted first.",
+    )
 
     # template config
     parser.add_argument(
@@ -1000,6 +1122,20 @@ if __name__ == "__main__":
             script_dir, "database/mmcif_files_ab"
         ),
     )
+    parser.add_argument(
+        "--release_dates_path",
+        type=str,
+        default=None,
+        help="""Path of the release date cache of the template mmCIFs, in the format of openfold/scripts/generate_mmcif_cache.py. 
+        It is built on first use, by default next to --template_mmcif_dir. Hits released after --max_template_date are pruned before their mmCIF is read.""",
+    )
+    parser.add_argument(
+        "--template_mmcif_store",
+        type=str,
+        default=None,
+        help="""Path of a store of pre-parsed template chains written by openfold/scripts/generate_mmcif_store.py. 
+        Templates in the store are read from it instead of parsing their mmCIF files.""",
+    )
     parser.add_argument(
         "--max_template_date",
         type=str,
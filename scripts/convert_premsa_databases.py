@@ -0,0 +1,94 @@
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from utils.database import (
+    heavy_length_databases,
+    light_length_databases,
+    heavy_ab_database_path,
+    light_ab_database_path,
+    fv_length_database_path,
+    clone_heavy_database_path,
+    clone_light_database_path,
+    unpaired_database_path,
+)
+from utils.get_msa_by_clonotype import convert_clonotype_to_columnar
+from utils.unpaired_database import convert_to_shard
+from utils.length_database import convert_to_columnar, load_length_database
+from utils.length_index import load_or_build_index
+
+
+def main(args):
+    database_paths = []
+    for databases in [
+        heavy_length_databases,
+        light_length_databases,
+        heavy_ab_database_path,
+        light_ab_database_path,
+        fv_length_database_path,
+    ]:
+        for path in databases.values():
+            path = os.path.join(args.databases_path, path)
+            if path not in database_paths:
+                database_paths.append(path)
+
+    for path in database_paths:
+        if not os.path.exists(path):
+            print(f"{path} does not exist. Skipping...")
+            continue
+
+        columnar_dir = convert_to_columnar(path)
+        print(f"Converted {path} to {columnar_dir}")
+
+        if args.build_index:
+            load_or_build_index(path, load_length_database(path).lengths)
+            print(f"Built region length index for {path}")
+
+    for databases in [clone_heavy_database_path, clone_light_database_path]:
+        for path in databases.values():
+            path = os.path.join(args.databases_path, path)
+            if not os.path.exists(path):
+                print(f"{path} does not exist. Skipping...")
+                continue
+
+            columnar_dir = convert_clonotype_to_columnar(path)
+            print(f"Converted {path} to {columnar_dir}")
+
+    for path in unpaired_database_path.values():
+        path = os.path.join(args.databases_path, path)
+        if not os.path.exists(path):
+            print(f"{path} does not exist. Skipping...")
+            continue
+
+        fasta_files = [
+            file for file in os.listdir(path) if file.endswith(".fasta") or file.endswith(".fas")
+        ]
+        for file in fasta_files:
+            convert_to_shard(os.path.join(path, file))
+        print(f"Converted {len(fasta_files)} files of {path} to CDR3 shards")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Convert the premsa length, clonotype and unpaired databases
+        to the memory-mapped formats read by the MSA builders."""
+    )
+    parser.add_argument(
+        "--databases_path",
+        type=str,
+        default=os.path.join(
+            os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "database"
+        ),
+    )
+    parser.add_argument(
+        "--build_index",
+        action="store_true",
+        default=False,
+        help="Also build the region length index of every database.",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
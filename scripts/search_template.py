@@ -2,23 +2,61 @@ import os
 import json
 from time import time
 from . import hmmsearch
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils.msa_cache import get_template_cache, get_database_fingerprint
 
+TEMPLATE_SEARCH_CPUS = 4  # Threads of one hmmsearch call, hmmsearch scales poorly beyond a few threads
 
-def search_template(inputfile, template_searcher, use_precomputed_msas):
+
+def get_template_search_budget(cpus, job_count):
+    """
+    Split cpus between concurrent template searches.
+    Return the number of concurrent searches and the number of threads of each search.
+    """
+    cpus = max(1, cpus)
+    max_workers = max(1, min(job_count, cpus // TEMPLATE_SEARCH_CPUS))
+    return max_workers, max(1, cpus // max_workers)
+
+
+def get_template_cache_key(template_cache, query, template_searcher):
+    """
+    Cache key of the template hits: the query MSA, the fingerprint of the seqres database
+    and the hmmbuild/hmmsearch settings. The thread count does not change the hits.
+    """
+    return template_cache.get_key(
+        "hmmsearch",
+        query,
+        get_database_fingerprint(template_searcher.database_path),
+        list(template_searcher.flags or []),
+        "hand",
+    )
+
+
+def search_template(
+    inputfile, template_searcher, use_precomputed_msas, n_cpu=None, template_cache=None, cache_key=None
+):
     out_dir = os.path.dirname(inputfile)
-    if use_precomputed_msas and os.path.exists(os.path.join(out_dir, "hmm_output.sto")):
+    out_path = os.path.join(out_dir, "hmm_output.sto")
+    if use_precomputed_msas and os.path.exists(out_path):
         return
 
     if os.path.exists(inputfile):
         uniref90_msa_f = open(inputfile, "r")
         uniref90_msa_as_a3m = uniref90_msa_f.read()
 
+        if template_cache is not None and cache_key is not None:
+            if template_cache.fetch(cache_key, [out_path]):
+                return
+
         pdb_templates_result = template_searcher.query(
             uniref90_msa_as_a3m,
             output_dir=out_dir,
+            n_cpu=n_cpu,
         )
 
+        if template_cache is not None and cache_key is not None:
+            template_cache.store(cache_key, [out_path])
+
 
 def search(data_dir, antibody_list, args):
 
@@ -57,7 +95,43 @@ def search(data_dir, antibody_list, args):
         database_path=args.pdb_seqres_database_path,
     )
     
-    max_workers = min(args.cpus // 8, 1)
+    search_path_list = list(dict.fromkeys(search_path_list))  # Chains shared by several antibodies are searched once
+
+    # Queries with the same content are searched once, the other queries copy the hits from the cache.
+    template_cache = get_template_cache(args)
+    query_groups = {}
+    cache_keys = {}
+    for file in search_path_list:
+        if os.path.exists(file):
+            with open(file, "r") as f:
+                cache_keys[file] = get_template_cache_key(template_cache, f.read(), searcher)
+        else:
+            cache_keys[file] = None
+        query_groups.setdefault(cache_keys[file] or file, []).append(file)
+
+    # All chains of the batch are searched concurrently, each call gets its share of the CPUs.
+    max_workers, n_cpu = get_template_search_budget(args.cpus, len(query_groups))
+    print(
+        "Template search: {} queries, {} unique, {} concurrent searches with {} threads each".format(
+            len(search_path_list), len(query_groups), max_workers, n_cpu
+        )
+    )
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        for file in search_path_list:
-            future = executor.submit(search_template, file, searcher, args.use_precomputed_msas)
+        def submit(file):
+            return executor.submit(
+                search_template, file, searcher, args.use_precomputed_msas, n_cpu, template_cache, cache_keys[file]
+            )
+
+        pending = {submit(files[0]): (files[0], group) for group, files in query_groups.items()}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                file, group = pending.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    print("Template search failed for {}: {}".format(file, e))
+                # The duplicates of a finished query are fetched from the cache,
+                # they are searched themselves only if the first query failed.
+                for duplicate in query_groups.pop(group, [])[1:]:
+                    pending[submit(duplicate)] = (duplicate, None)
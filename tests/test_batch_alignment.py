@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from utils import align
+from utils.fasta import read_fasta_file
+
+# Directory of the Abalign binary, the lib directory of the repository by default.
+ABALIGN_DIR = os.environ.get(
+    "ABALIGN_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lib")
+)
+
+HEAVY_SEQS = {
+    "trastuzumab": "EVQLVESGGGLVQPGGSLRLSCAASGFNIKDTYIHWVRQAPGKGLEWVARIYPTNGYTRYADSVKGRFTISADTSKNTAYLQMNSLRAEDTAVYYCSRWGGDGFYAMDYWGQGTLVTVSS",
+    "adalimumab": "EVQLVESGGGLVQPGRSLRLSCAASGFTFDDYAMHWVRQAPGKGLEWVSAITWNSGHIDYADSVEGRFTISRDNAKNSLYLQMNSLRAEDTAVYYCAKVSYLSTASSLDYWGQGTLVTVSS",
+    "pembrolizumab": "QVQLVQSGVEVKKPGASVKVSCKASGYTFTNYYMYWVRQAPGQGLEWMGGINPSNGGTNFNEKFKNRVTLTTDSSTTTAYMELKSLQFDDTAVYYCARRDYRFDMGFDYWGQGTTVTVSS",
+    "rituximab": "QVQLQQPGAELVKPGASVKMSCKASGYTFTSYNMHWVKQTPGRGLEWIGAIYPGNGDTSYNQKFKGKATLTADKSSSTAYMQLSSLTSEDSAVYYCARSTYYGGDWYFNVWGAGTTVTVSA",
+}
+LIGHT_SEQS = {
+    "trastuzumab": "DIQMTQSPSSLSASVGDRVTITCRASQDVNTAVAWYQQKPGKAPKLLIYSASFLYSGVPSRFSGSRSGTDFTLTISSLQPEDFATYYCQQHYTTPPTFGQGTKVEIK",
+    "adalimumab": "DIQMTQSPSSLSASVGDRVTITCRASQGIRNYLAWYQQKPGKAPKLLIYAASTLQSGVPSRFSGSGSGTDFTLTISSLQPEDVATYYCQRYNRAPYTFGQGTKVEIK",
+    "pembrolizumab": "EIVLTQSPATLSLSPGERATLSCRASKGVSTSGYSYLHWYQQKPGQAPRLLIYLASYLESGVPARFSGSGSGTDFTLTISSLEPEDFAVYYCQHSRDLPLTFGGGTKVEIK",
+    "rituximab": "QIVLSQSPAILSASPGEKVTMTCRASSSVSYIHWFQQKPGSSPKPWIYATSNLASGVPVRFSGSGSGTSYSLTISRVEAEDAATYYCQQWTSNPPTFGGGTKLEIK",
+}
+
+
+def write_jobs(seqs, tmp_dir, prefix):
+    """
+    One MSA per antibody: the antibody as query, the other antibodies and point mutants
+    of the query as hits, so that some hits are above and some below the identity cutoff.
+    """
+    jobs = []
+    for query_name, query_seq in seqs.items():
+        records = [(query_name, query_seq)]
+        for i in range(0, len(query_seq), 15):
+            records.append(("{}_m{}".format(query_name, i), query_seq[:i] + "A" + query_seq[i + 1:]))
+        records += [(name, seq) for name, seq in seqs.items() if name != query_name]
+        fas_file = os.path.join(tmp_dir, "{}_{}.fas".format(prefix, query_name))
+        with open(fas_file, "w") as f:
+            for name, seq in records:
+                f.write(">{}\n{}\n".format(name, seq))
+        jobs.append(fas_file)
+    return jobs
+
+
+@unittest.skipUnless(
+    os.path.exists(os.path.join(ABALIGN_DIR, "Abalign")), "Abalign binary not found, set ABALIGN_DIR"
+)
+class TestBatchAlignment(unittest.TestCase):
+    def setUp(self):
+        self.abalign_path = align.Abalign_path
+        align.init_Abalign_path(ABALIGN_DIR)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        align.Abalign_path = self.abalign_path
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def assert_batch_matches_single(self, seqs, chain):
+        fas_files = write_jobs(seqs, self.tmp_dir, chain)
+        for fas_file in fas_files:
+            align.run_alignment(fas_file, fas_file[:-4] + "_single.a3m", "chothia", chain, cpus=2)
+        align.run_batch_alignment(
+            [(fas_file, fas_file[:-4] + "_batch.a3m") for fas_file in fas_files],
+            "chothia",
+            chain,
+            cpus=2,
+            tmp_dir=self.tmp_dir,
+        )
+
+        for fas_file in fas_files:
+            single = read_fasta_file(fas_file[:-4] + "_single.a3m")
+            self.assertGreater(len(single[0]), 0)
+            self.assertEqual(read_fasta_file(fas_file[:-4] + "_batch.a3m"), single, fas_file)
+
+    def test_heavy(self):
+        self.assert_batch_matches_single(HEAVY_SEQS, "H")
+
+    def test_light(self):
+        self.assert_batch_matches_single(LIGHT_SEQS, "L")
+
+
+if __name__ == "__main__":
+    unittest.main()
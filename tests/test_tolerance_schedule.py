@@ -0,0 +1,214 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from utils.database import regions, regions_fv
+from utils.get_msa_utils import (
+    find_sequences,
+    get_tolerance_schedule,
+    find_rows_by_tolerance_schedule,
+    batch_find_rows_by_tolerance_schedule,
+)
+from utils.length_index import RegionLengthIndex
+
+PAIRED_TOLERANCE = [16, 0, 2, 0, 5, 0, 10, 16, 0, 2, 0, 2, 0, 10]
+HEAVY_TOLERANCE = [10, 0, 0, 0, 0, 0, 5]
+
+
+def widen(tolerance, upper_count_list, cycle):
+    """One widening step of the previous search loops."""
+    if sum(upper_count_list) > 0:
+        for i, count in enumerate(upper_count_list):
+            if count > 0:
+                tolerance[i] = tolerance[i] + 1
+                upper_count_list[i] = count - 1
+                break
+    else:
+        tolerance[cycle % len(tolerance)] = tolerance[cycle % len(tolerance)] + 1
+
+
+def paired_loop_rows(lengths, target_lengths, tolerance, upper_count_list, minmin_seqs, fv_index=None):
+    """Rows selected by the previous loop of get_msa_by_regions_length_paired."""
+    tolerance = list(tolerance)
+    upper_count_list = list(upper_count_list)
+    fv_lengths = pd.DataFrame(lengths, columns=regions_fv)
+    target_df = pd.DataFrame(np.tile(target_lengths, (lengths.shape[0], 1)), columns=regions_fv)
+
+    cycle = 0
+    while cycle < 100:
+        if fv_index is not None:
+            target_rows = fv_index.query(target_lengths, tolerance)
+        else:
+            target_rows = find_sequences(
+                seqs_df=fv_lengths, length_df=fv_lengths, target_df=target_df, tolerance=tolerance
+            ).index.to_numpy()
+        if len(target_rows) >= minmin_seqs or cycle == 99:
+            return np.asarray(target_rows)
+        widen(tolerance, upper_count_list, cycle)
+        cycle += 1
+
+
+def substitution_loop_rows(lengths, target_lengths, tolerance, upper_count_list, minmin_seqs):
+    """Rows selected by the previous loop of get_msa_by_regions_length_substitution."""
+    tolerance = list(tolerance)
+    upper_count_list = list(upper_count_list)
+    length_df = pd.DataFrame(lengths, columns=regions)
+    target_df = pd.DataFrame(np.tile(target_lengths, (lengths.shape[0], 1)), columns=regions)
+
+    cycle = 0
+    while cycle < 50:
+        target_rows = find_sequences(
+            seqs_df=length_df, length_df=length_df, target_df=target_df, tolerance=tolerance
+        ).index.to_numpy()
+        if len(target_rows) >= minmin_seqs or cycle == 49:
+            return target_rows
+        widen(tolerance, upper_count_list, cycle)
+        cycle += 1
+
+
+def random_database(rng, n_rows, n_regions):
+    centers = rng.integers(3, 25, size=n_regions)
+    return np.clip(centers + rng.integers(-6, 7, size=(n_rows, n_regions)), 0, None)
+
+
+def clamp_query(target_lengths, lengths_max, lengths_qx):
+    """Query lengths and pre-widening counts, the same way as the callers."""
+    upper_count_list = [0 for _ in target_lengths]
+    for i in range(len(target_lengths)):
+        if target_lengths[i] > lengths_max[i]:
+            upper_count_list[i] = target_lengths[i] - lengths_qx[i]
+    target_lengths = [min(target_lengths[i], lengths_max[i]) for i in range(len(target_lengths))]
+    return target_lengths, upper_count_list
+
+
+class TestToleranceSchedule(unittest.TestCase):
+    def test_schedule_replays_the_widening_loop(self):
+        tolerance = list(PAIRED_TOLERANCE)
+        upper_count_list = [0, 3, 0, 0, 0, 0, 2, 0, 0, 0, 0, 0, 0, 0]
+        schedule = get_tolerance_schedule(tolerance, upper_count_list, max_cycle=100)
+        for cycle in range(100):
+            self.assertEqual(schedule[cycle].tolist(), tolerance)
+            widen(tolerance, upper_count_list, cycle)
+
+    def test_paired_random_databases(self):
+        rng = np.random.default_rng(0)
+        for trial in range(30):
+            lengths = random_database(rng, int(rng.integers(50, 400)), len(regions_fv))
+            fv_index = RegionLengthIndex.build(lengths)
+            target_lengths = list(lengths[rng.integers(lengths.shape[0])] + rng.integers(-4, 5, size=len(regions_fv)))
+            target_lengths = [max(0, length) for length in target_lengths]
+            minmin_seqs = int(rng.integers(1, 200))
+            upper_count_list = [0] * len(regions_fv)
+            schedule = get_tolerance_schedule(PAIRED_TOLERANCE, upper_count_list, max_cycle=100)
+
+            expected = paired_loop_rows(lengths, target_lengths, PAIRED_TOLERANCE, upper_count_list, minmin_seqs)
+            expected_index = paired_loop_rows(
+                lengths, target_lengths, PAIRED_TOLERANCE, upper_count_list, minmin_seqs, fv_index
+            )
+            np.testing.assert_array_equal(expected, expected_index)
+            np.testing.assert_array_equal(
+                find_rows_by_tolerance_schedule(lengths, target_lengths, schedule, minmin_seqs), expected
+            )
+            np.testing.assert_array_equal(
+                find_rows_by_tolerance_schedule(lengths, target_lengths, schedule, minmin_seqs, index=fv_index),
+                expected,
+            )
+
+    def test_substitution_random_databases(self):
+        rng = np.random.default_rng(1)
+        for trial in range(30):
+            lengths = random_database(rng, int(rng.integers(50, 400)), len(regions))
+            index = RegionLengthIndex.build(lengths)
+            target_lengths = [max(0, int(x)) for x in lengths[0] + rng.integers(-5, 6, size=len(regions))]
+            minmin_seqs = int(rng.integers(1, 200))
+            schedule = get_tolerance_schedule(HEAVY_TOLERANCE, [0] * len(regions), max_cycle=50)
+
+            expected = substitution_loop_rows(lengths, target_lengths, HEAVY_TOLERANCE, [0] * len(regions), minmin_seqs)
+            np.testing.assert_array_equal(
+                find_rows_by_tolerance_schedule(lengths, target_lengths, schedule, minmin_seqs), expected
+            )
+            np.testing.assert_array_equal(
+                find_rows_by_tolerance_schedule(lengths, target_lengths, schedule, minmin_seqs, index=index),
+                expected,
+            )
+
+    def test_upper_count_pre_widening(self):
+        rng = np.random.default_rng(2)
+        for trial in range(20):
+            lengths = random_database(rng, 300, len(regions_fv))
+            fv_index = RegionLengthIndex.build(lengths)
+            lengths_max = lengths.max(axis=0)
+            lengths_qx = np.quantile(lengths, 0.9, axis=0).astype(int)
+            # Some regions of the query are longer than any in the database.
+            query = lengths[0].copy()
+            longer = rng.choice(len(regions_fv), size=3, replace=False)
+            query[longer] = lengths_max[longer] + rng.integers(1, 8, size=3)
+            target_lengths, upper_count_list = clamp_query(list(query), lengths_max, lengths_qx)
+            self.assertGreater(sum(upper_count_list), 0)
+            minmin_seqs = int(rng.integers(1, 300))
+            schedule = get_tolerance_schedule(PAIRED_TOLERANCE, upper_count_list, max_cycle=100)
+
+            expected = paired_loop_rows(lengths, target_lengths, PAIRED_TOLERANCE, upper_count_list, minmin_seqs)
+            np.testing.assert_array_equal(
+                find_rows_by_tolerance_schedule(lengths, target_lengths, schedule, minmin_seqs), expected
+            )
+            np.testing.assert_array_equal(
+                find_rows_by_tolerance_schedule(lengths, target_lengths, schedule, minmin_seqs, index=fv_index),
+                expected,
+            )
+
+            sub_lengths = lengths[:, :7]
+            sub_target, sub_upper_count_list = clamp_query(list(query[:7]), sub_lengths.max(axis=0), sub_lengths.max(axis=0))
+            sub_schedule = get_tolerance_schedule(HEAVY_TOLERANCE, sub_upper_count_list, max_cycle=50)
+            np.testing.assert_array_equal(
+                find_rows_by_tolerance_schedule(sub_lengths, sub_target, sub_schedule, minmin_seqs),
+                substitution_loop_rows(sub_lengths, sub_target, HEAVY_TOLERANCE, sub_upper_count_list, minmin_seqs),
+            )
+
+    def test_minmin_seqs_never_reached(self):
+        rng = np.random.default_rng(3)
+        lengths = random_database(rng, 100, len(regions_fv))
+        fv_index = RegionLengthIndex.build(lengths)
+        # Far from every row, so even the last cycle matches fewer than minmin_seqs rows.
+        target_lengths = [int(x) for x in lengths.max(axis=0) + 40]
+        minmin_seqs = lengths.shape[0] + 1
+        schedule = get_tolerance_schedule(PAIRED_TOLERANCE, [0] * len(regions_fv), max_cycle=100)
+
+        expected = paired_loop_rows(lengths, target_lengths, PAIRED_TOLERANCE, [0] * len(regions_fv), minmin_seqs)
+        self.assertLess(len(expected), minmin_seqs)
+        np.testing.assert_array_equal(
+            find_rows_by_tolerance_schedule(lengths, target_lengths, schedule, minmin_seqs), expected
+        )
+        np.testing.assert_array_equal(
+            find_rows_by_tolerance_schedule(lengths, target_lengths, schedule, minmin_seqs, index=fv_index),
+            expected,
+        )
+
+        sub_lengths = lengths[:, :7]
+        sub_schedule = get_tolerance_schedule(HEAVY_TOLERANCE, [0] * len(regions), max_cycle=50)
+        np.testing.assert_array_equal(
+            find_rows_by_tolerance_schedule(sub_lengths, target_lengths[:7], sub_schedule, minmin_seqs),
+            substitution_loop_rows(sub_lengths, target_lengths[:7], HEAVY_TOLERANCE, [0] * len(regions), minmin_seqs),
+        )
+
+    def test_batched_queries(self):
+        rng = np.random.default_rng(4)
+        lengths = random_database(rng, 500, len(regions_fv))
+        targets, schedules, minmin_list = [], [], []
+        for _ in range(12):
+            targets.append([max(0, int(x)) for x in lengths[rng.integers(500)] + rng.integers(-4, 5, size=len(regions_fv))])
+            schedules.append(get_tolerance_schedule(PAIRED_TOLERANCE, [0] * len(regions_fv), max_cycle=100))
+            minmin_list.append(int(rng.integers(1, 300)))
+
+        results = batch_find_rows_by_tolerance_schedule(
+            lengths, targets, np.stack(schedules), np.array(minmin_list), block_bytes=4096
+        )
+        for target_lengths, minmin_seqs, rows in zip(targets, minmin_list, results):
+            np.testing.assert_array_equal(
+                rows, paired_loop_rows(lengths, target_lengths, PAIRED_TOLERANCE, [0] * len(regions_fv), minmin_seqs)
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
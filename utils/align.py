@@ -1,11 +1,18 @@
 import os
 import sys
+import uuid
+import shutil
+import tempfile
+import subprocess
 
 sys.path.append("..")
-from utils.fasta import read_fasta_file
+from utils.fasta import read_fasta_file, write_fasta_file
+from utils.msa_codec import GAP, read_msa, decode_seqs
 import numpy as np
 
 Abalign_path = "../lib/Abalign"
+BATCH_TAG = "AbB"  # Prefix of the job tag added to the record names of a batched alignment
+scratch_root = None  # Root of the Abalign scratch directories, see get_scratch_root
 
 
 def init_Abalign_path(path):
@@ -14,6 +21,12 @@ def init_Abalign_path(path):
     Abalign_path = os.path.join(path, "Abalign")
 
 
+def init_scratch_root(path):
+    global scratch_root
+
+    scratch_root = path
+
+
 def run_alignment(
     fas_file,
     out_path,
@@ -29,24 +42,133 @@ def run_alignment(
     scheme_cmd = scheme_dict[scheme]
     base_name = os.path.basename(fas_file).split(".")[0]
 
-    cmd = "{} -i {} -s {} {} {} -t {} -z {} -lfs 0".format(
-        Abalign_path,
-        fas_file,
-        scheme_cmd,
-        "-ah" if chain == "H" else "-al",
-        out_path,
-        cpus,
-        cutoff,
-    )
+    cmd_args = [
+        "-i", fas_file, "-s", scheme_cmd, "-ah" if chain == "H" else "-al", out_path,
+        "-t", cpus, "-z", cutoff, "-lfs", 0,
+    ]
     if get_regioned_file:
-        cmd += " -r "
+        cmd_args.append("-r")
     if merge:
-        cmd += " -mg -bd "
-    print(f"alignment {chain} cmd:", cmd)
-    info = os.popen(cmd=cmd)
-    stream = info.read()
+        cmd_args += ["-mg", "-bd"]
+    print(f"alignment {chain} cmd:", " ".join([Abalign_path] + [str(arg) for arg in cmd_args]))
+    # Failed alignments are reported but tolerated, the missing results are handled by the callers.
+    run_abalign(cmd_args, align_info=align_info, check=False)
+
+
+def run_batch_alignment(
+    jobs,
+    scheme="chothia",
+    chain="H",
+    cpus=8,
+    cutoff=60,
+    tmp_dir=None,
+):
+    """
+    Align the sequences of many MSAs with a single Abalign run.
+    The records of all jobs are written into one input with a job tag prefixed to their names,
+    and the aligned records are split back into the output file of each job, with the original
+    names and order. Jobs missing from the batched output, or whose first record is not their
+    query, are realigned with run_alignment on their own.
+    args:
+        jobs: list of (fas_file, out_path) of the same chain type.
+        tmp_dir: directory of the combined input and output, the directory of the first job if None.
+    """
+    jobs = [(fas_file, out_path) for fas_file, out_path in jobs if os.path.exists(fas_file)]
+    if len(jobs) == 0:
+        return
+
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(jobs[0][0])
+    batch_name = "batch_{}_{}_{}".format(os.getpid(), chain, uuid.uuid4().hex[:8])
+    batch_fas_file = os.path.join(tmp_dir, batch_name + ".fas")
+    batch_out_path = os.path.join(tmp_dir, batch_name + ".a3m")
+
+    query_names = []
+    with open(batch_fas_file, "w") as f:
+        for job_idx, (fas_file, _) in enumerate(jobs):
+            names_list, seqs_list = read_fasta_file(fas_file)
+            query_names.append(names_list[0] if len(names_list) > 0 else None)
+            for name, seq in zip(names_list, seqs_list):
+                f.write(">{}{}_{}\n{}\n".format(BATCH_TAG, job_idx, name.lstrip(">"), seq))
+
+    run_alignment(
+        fas_file=batch_fas_file,
+        out_path=batch_out_path,
+        scheme=scheme,
+        chain=chain,
+        cpus=cpus,
+        cutoff=cutoff,
+    )
+
+    job_records = [([], []) for _ in jobs]
+    if os.path.exists(batch_out_path):
+        names_list, seqs_list = read_fasta_file(batch_out_path)
+        for name, seq in zip(names_list, seqs_list):
+            tag, _, name = name.lstrip(">").partition("_")
+            if not tag.startswith(BATCH_TAG):
+                continue
+            job_records[int(tag[len(BATCH_TAG):])][0].append(">" + name)
+            job_records[int(tag[len(BATCH_TAG):])][1].append(seq)
+
+    for (fas_file, out_path), (names_list, seqs_list), query_name in zip(jobs, job_records, query_names):
+        # A job lost in the batched run, or whose query is no longer its first record,
+        # is realigned on its own so that a failure only affects that MSA.
+        if len(names_list) == 0 or names_list[0] != query_name:
+            print("Batched alignment of {} failed, realign it alone.".format(fas_file))
+            run_alignment(
+                fas_file=fas_file,
+                out_path=out_path,
+                scheme=scheme,
+                chain=chain,
+                cpus=cpus,
+                cutoff=cutoff,
+            )
+            continue
+        write_fasta_file(names_list, seqs_list, out_path)
+
+    for path in [batch_fas_file, batch_out_path]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def get_scratch_root():
+    """
+    Root of the scratch directories of the Abalign calls, /dev/shm when it is available.
+    """
+    if scratch_root is not None:
+        return scratch_root
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def run_abalign(cmd_args, cwd=None, align_info=False, check=True):
+    """
+    Run Abalign in cwd without changing the working directory of this process,
+    so that calls can run in parallel threads.
+    args:
+        cmd_args: list of the Abalign arguments.
+        cwd: working directory of Abalign, the current one if None.
+        check: raise RuntimeError if Abalign fails, only print a warning otherwise.
+    """
+    result = subprocess.run(
+        [Abalign_path] + [str(arg) for arg in cmd_args],
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
     if align_info:
-        print(stream)
+        print(result.stdout)
+    if result.returncode != 0:
+        message = "Abalign exited with code {}: {}\n{}".format(
+            result.returncode, " ".join([Abalign_path] + [str(arg) for arg in cmd_args]), result.stdout[-2000:]
+        )
+        if check:
+            raise RuntimeError(message)
+        print("WARNING: " + message)
+
+    return result.stdout
 
 
 def get_clonotype(
@@ -59,65 +181,53 @@ def get_clonotype(
     regioned_file=False,
     cpus=8,
 ):
-    # Save the original working directory
-    original_path = os.getcwd()
-    # Get the path of the current file
+    # Abalign uses the working directory as the base when searching for the VJ gene library,
+    # so it runs in the repository directory. Relative paths are resolved from there too.
     current_path = os.path.dirname(os.path.realpath(__file__))
     parenn_path = os.path.dirname(current_path)
-    # Change the current working directory, 
-    # because Abalign uses the current working directory as the base when searching for the VJ gene library.
-    os.chdir(parenn_path)
 
     scheme_dict = {"chothia": "-c", "imgt": "-g", "kabat": "-k", "martin": "-m"}
     scheme_cmd = scheme_dict[scheme]
     base_name = os.path.basename(fas_file).split(".")[0]
-    out_fas_path_heavy = os.path.join(out_dir, "{}_heavy.fas".format(base_name))
-    out_fas_path_light = os.path.join(out_dir, "{}_light.fas".format(base_name))
-    out_vgene_path_heavy = os.path.join(out_dir, "{}_heavy.vgene".format(base_name))
-    out_vgene_path_light = os.path.join(out_dir, "{}_light.vgene".format(base_name))
-    if chain_type == "H":
-        cmd = "{} -i {} -s {} -ah {} -v {} -vct -sp HS. -z 60 -lfs 0 {} -t {}".format(
-            Abalign_path,
-            fas_file,
-            scheme_cmd,
-            out_fas_path_heavy,
-            out_vgene_path_heavy,
-            "-r" if regioned_file else "",
-            cpus,
-        )
-        print("alignment H cmd: {}".format(cmd))
-    elif chain_type == "L":
-        cmd = "{} -i {} -s {} -al {} -v {} -vct -sp HS. -z 60 -lfs 0 {} -t {}".format(
-            Abalign_path,
-            fas_file,
-            scheme_cmd,
-            out_fas_path_light,
-            out_vgene_path_light,
-            "-r" if regioned_file else "",
-            cpus,
-        )
-        print("alignment L cmd: {}".format(cmd))
-    else:
-        raise ValueError("chain_type should belong to ['H', 'L']")
-
-    info = os.popen(cmd=cmd)
-    stream = info.read()
-    if align_info:
-        print(stream)
-
-    # Switch back to the original working directory
-    os.chdir(original_path)
+    fas_file = os.path.join(parenn_path, fas_file)
+    out_dir = os.path.join(parenn_path, out_dir)
+
+    # Abalign writes its output and intermediate files to a scratch directory on tmpfs,
+    # the output files are moved to out_dir once it finishes.
+    scratch_dir = tempfile.mkdtemp(prefix="abalign_", dir=get_scratch_root())
+    try:
+        if chain_type == "H":
+            out_fas_path = os.path.join(scratch_dir, "{}_heavy.fas".format(base_name))
+            out_vgene_path = os.path.join(scratch_dir, "{}_heavy.vgene".format(base_name))
+            chain_arg = "-ah"
+        elif chain_type == "L":
+            out_fas_path = os.path.join(scratch_dir, "{}_light.fas".format(base_name))
+            out_vgene_path = os.path.join(scratch_dir, "{}_light.vgene".format(base_name))
+            chain_arg = "-al"
+        else:
+            raise ValueError("chain_type should belong to ['H', 'L']")
+
+        cmd_args = [
+            "-i", fas_file, "-s", scheme_cmd, chain_arg, out_fas_path, "-v", out_vgene_path,
+            "-vct", "-sp", "HS.", "-z", 60, "-lfs", 0,
+        ]
+        if regioned_file:
+            cmd_args.append("-r")
+        cmd_args += ["-t", cpus]
+        print("alignment {} cmd: {}".format(chain_type, " ".join([Abalign_path] + [str(arg) for arg in cmd_args])))
+
+        run_abalign(cmd_args, cwd=parenn_path, align_info=align_info)
+
+        os.makedirs(out_dir, exist_ok=True)
+        for file in os.listdir(scratch_dir):
+            shutil.move(os.path.join(scratch_dir, file), os.path.join(out_dir, file))
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
 
 
 def delete_msa_by_first_seq(msa_path):
     """Delete the columns in the MSA that contain gaps in the first sequence"""
-    names_list, seqs_list = read_fasta_file(msa_path)
-    target_seq = seqs_list[0]
-    delete_index_list = [index for index, char in enumerate(target_seq) if char == "-"]
-
-    seqs_list = np.array([list(seq) for seq in seqs_list])
-    seqs_list = np.delete(seqs_list, delete_index_list, axis=1)
-    seqs_list = seqs_list.tolist()
-    seqs_list = ["".join(chars) for chars in seqs_list]
+    names_list, msa = read_msa(msa_path)
+    seqs_list = decode_seqs(msa[:, msa[0] != GAP])
 
     return names_list, seqs_list
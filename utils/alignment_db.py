@@ -0,0 +1,74 @@
+import os
+import json
+import glob
+
+DB_SUFFIX = ".db"
+INDEX_SUFFIX = ".index"
+
+
+def pack_alignments(alignment_dir, chain_names, pack_name):
+    """
+    Pack the files of the given chain directories into one db file, with an index
+    in the format read by DataPipeline through alignment_index:
+        {chain name: {"db": db file name, "files": [[file name, start, size], ...]}}
+    The files of every chain are stored in sorted order, the order in which
+    the data pipeline lists a chain directory.
+    args:
+        alignment_dir: the alignment dir holding one directory per chain.
+        chain_names: names of the chain directories to pack.
+        pack_name: name of the db and index files written in alignment_dir.
+    """
+    db_name = pack_name + DB_SUFFIX
+    db_path = os.path.join(alignment_dir, db_name)
+    index_path = os.path.join(alignment_dir, pack_name + INDEX_SUFFIX)
+
+    # Write to temporary files first so readers never see a partial pack.
+    tmp_db_path = "{}.{}.tmp".format(db_path, os.getpid())
+    tmp_index_path = "{}.{}.tmp".format(index_path, os.getpid())
+    index = {}
+    with open(tmp_db_path, "wb") as db_f:
+        start = 0
+        for name in chain_names:
+            chain_dir = os.path.join(alignment_dir, name)
+            if name in index or not os.path.isdir(chain_dir):
+                continue
+
+            files = []
+            for file in sorted(os.listdir(chain_dir)):
+                path = os.path.join(chain_dir, file)
+                if not os.path.isfile(path):
+                    continue
+                with open(path, "rb") as f:
+                    data = f.read()
+                db_f.write(data)
+                files.append([file, start, len(data)])
+                start += len(data)
+
+            index[name] = {"db": db_name, "files": files}
+
+    with open(tmp_index_path, "w") as f:
+        json.dump(index, f)
+
+    os.replace(tmp_db_path, db_path)
+    os.replace(tmp_index_path, index_path)
+
+    return index
+
+
+def load_alignment_index(alignment_dir):
+    """
+    Load and merge the indexes of all packs in alignment_dir, newer packs override older ones.
+    The db of every chain is made absolute, so it can be opened from the chain directory.
+    """
+    alignment_index = {}
+    index_paths = sorted(
+        glob.glob(os.path.join(alignment_dir, "*" + INDEX_SUFFIX)), key=os.path.getmtime
+    )
+    for index_path in index_paths:
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        for name, chain_index in index.items():
+            chain_index["db"] = os.path.join(os.path.abspath(alignment_dir), chain_index["db"])
+            alignment_index[name] = chain_index
+
+    return alignment_index
@@ -1,4 +1,7 @@
 import os
+import threading
+from utils.length_database import load_length_database
+from utils.length_index import load_or_build_index
 
 regions = ["FR1", "CDR1", "FR2", "CDR2", "FR3", "CDR3", "FR4"]
 regions_fv = ["HFR1", "HCDR1", "HFR2", "HCDR2", "HFR3", "HCDR3", "HFR4", "LFR1", "LCDR1", "LFR2", "LCDR2", "LFR3", "LCDR3", "LFR4"]
@@ -79,4 +82,60 @@ def init_databases_path(database_path):
     fv_length_database_path[database] = os.path.join(database_path, path)
 
   for database, path in unpaired_database_path.items():
-    unpaired_database_path[database] = os.path.join(database_path, path)
\ No newline at end of file
+    unpaired_database_path[database] = os.path.join(database_path, path)
+
+
+class DatabaseRegistry:
+  """
+  Load each database at most once per process and cache its statistics.
+
+  Databases are loaded lazily on first use. The main process loads them
+  before the worker pool is created, so forked workers inherit them
+  instead of reading the files again, and repeated batches reuse them
+  instead of appending new copies.
+  """
+
+  def __init__(self):
+    self._cache = {}
+    self._lock = threading.RLock()
+
+  def _get(self, kind, key, loader):
+    with self._lock:
+      if (kind, key) not in self._cache:
+        self._cache[(kind, key)] = loader()
+      return self._cache[(kind, key)]
+
+  def get_length_database(self, path):
+    """LengthDatabase of a substitution or paired length database."""
+    return self._get("length_database", path, lambda: load_length_database(path))
+
+  def get_length_index(self, path):
+    """RegionLengthIndex of a length database, built on first use."""
+    return self._get(
+      "length_index", path,
+      lambda: load_or_build_index(path, self.get_length_database(path).lengths),
+    )
+
+  def get_max_lengths(self, path):
+    """Maximum length of each region of a length database."""
+    return self._get(
+      "max_lengths", path, lambda: self.get_length_database(path).max_lengths()
+    )
+
+  def get_quantile_lengths(self, path, q):
+    """Upper q-quantile of the length of each region of a length database."""
+    return self._get(
+      "quantile_lengths", (path, q),
+      lambda: self.get_length_database(path).quantile_lengths(q),
+    )
+
+  def get(self, kind, key, loader):
+    """Generic cached loader for databases that are not length databases."""
+    return self._get(kind, key, loader)
+
+  def clear(self):
+    with self._lock:
+      self._cache.clear()
+
+
+database_registry = DatabaseRegistry()  # Registry shared by the MSA builders of this process
@@ -15,22 +15,24 @@ def read_data_from_pickle(infile):
 
 def read_fasta_file(file_path):
     with open(file_path, "r") as f:
-        dat = ""
+        dat = []
         seqs_list = []
         names_list = []
         start = False
-        for line in f.readlines():
+        for line in f:
             if line[0] == ">":
                 start=True
                 names_list.append(line.rstrip("\n").strip(" "))
-                if dat != "":
-                    seqs_list.append(dat)
-                    dat = ""
+                seq = "".join(dat)
+                if seq != "":
+                    seqs_list.append(seq)
+                    dat = []
             else:
                 if start:
-                    dat += line.rstrip("\n")
-        if dat != "":
-            seqs_list.append(dat.strip("\n"))
+                    dat.append(line.rstrip("\n"))
+        seq = "".join(dat)
+        if seq != "":
+            seqs_list.append(seq)
         
         if len(seqs_list) != len(names_list):
             raise IndexError("name count not equal seq count!")
@@ -38,6 +40,32 @@ def read_fasta_file(file_path):
         return names_list, seqs_list
 
 
+def iter_fasta_file(file_path):
+    """
+    Yield the (name, seq) records of a fasta file one at a time,
+    same records as read_fasta_file without loading the whole file.
+    """
+    with open(file_path, "r") as f:
+        name = None
+        seq_lines = []
+        for line in f:
+            if line[0] == ">":
+                if name is not None:
+                    seq = "".join(seq_lines)
+                    if seq == "":
+                        raise IndexError("name count not equal seq count!")
+                    yield name, seq
+                name = line.rstrip("\n").strip(" ")
+                seq_lines = []
+            elif name is not None:
+                seq_lines.append(line.rstrip("\n"))
+        if name is not None:
+            seq = "".join(seq_lines)
+            if seq == "":
+                raise IndexError("name count not equal seq count!")
+            yield name, seq
+
+
 def write_fasta_file( names_list, seqs_list, out_path):
     with open(out_path, "w") as f:
         f.write("\n".join(list(itertools.chain(*zip(names_list, seqs_list)))))
@@ -6,7 +6,10 @@ import json
 REGION_NAME = ["FRONT", "FR1", "CDR1", "FR2", "CDR2", "FR3", "CDR3", "FR4", "BACK"]
 
 
-def para_temp_fas(input_dir, ab):
+def get_region_dict(ab):
+    """
+    Get the region boundaries of a chain from its "*" separated regions.
+    """
     seq = ab.seq
     regions_list = seq.split("*")
     regions_index_list = []
@@ -28,11 +31,18 @@ def para_temp_fas(input_dir, ab):
     for i in range(len(antibody_region)):
         result_dict[antibody_region[i]] = regions_index_list[i]
 
+    return result_dict
+
+
+def para_temp_fas(input_dir, ab):
     with open(os.path.join(input_dir, "region_index.json"), "w") as f:
-        json.dump(result_dict, f, indent=4)
+        json.dump(get_region_dict(ab), f, indent=4)
 
 
-def write_regions(data_dir, antibody_list, args):
+def get_single_antibodies(antibody_list):
+    """
+    Get the single chains of all antibodies, in the order of write_regions.
+    """
     antibody_list = sum([ab.get_all_antibodies() for ab in antibody_list if ab.get_all_antibodies() != None], [])
     
     single_antibody_list = []
@@ -42,7 +52,11 @@ def write_regions(data_dir, antibody_list, args):
         else:
             single_antibody_list.append(ab)
 
-    for ab in single_antibody_list:
+    return single_antibody_list
+
+
+def write_regions(data_dir, antibody_list, args):
+    for ab in get_single_antibodies(antibody_list):
         temp_dir = os.path.join(data_dir, ab.name)
         if args.use_precomputed_alignments and os.path.exists(
             os.path.join(temp_dir, "region_index.json")
@@ -1,13 +1,16 @@
 import os
 import sys
 import random
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from utils.align import run_alignment, get_clonotype
-from utils.fasta import read_fasta_file
+from utils.fasta import read_fasta_file, iter_fasta_file
 import re
 import pandas as pd
 from itertools import chain
 from itertools import combinations, zip_longest
+import bisect
+
+CHAIN_INFO_CHUNK_SIZE = 10000  # Number of input records annotated by one Abalign run
 
 
 class AntiBodySingle:
@@ -169,46 +172,49 @@ def seq_sliding_window(seq, window_size, step_size):
         yield seq[i : i + window_size]
 
 
+def write_fasta_records(records, merged_fasta_path):
+    """Write (name, seq) records to merged_fasta_path one at a time."""
+    with open(merged_fasta_path, "w") as f:
+        for index, (name, seq) in enumerate(records):
+            if index > 0:
+                f.write("\n")
+            f.write(name + "\n" + seq)
+
+
+def iter_sliding_records(records):
+    """Split sequences longer than 200 into windows of 150 with a step of 100, lazily."""
+    for name, seq in records:
+        if len(seq) > 200:
+            for slid_seq in seq_sliding_window(seq, 150, 100):
+                yield name, slid_seq
+        else:
+            yield name, seq
+
+
 def merge_fasta_files(fasta_files_path, merged_fasta_path):
-    names_groups = []
-    names_list = []
-    seqs_list = []
-    for fasta_file_path in fasta_files_path:
-        names, seqs = read_fasta_file(fasta_file_path)
-        names_groups.append([s.split("|")[0].lstrip(">") for s in names])
-        names_list.extend(names)
-        seqs_list.extend(seqs)
+    names_groups = [[] for _ in fasta_files_path]
 
-    with open(merged_fasta_path, "w") as f:
-        f.write("\n".join(chain(*zip(names_list, seqs_list))))
+    def iter_records():
+        for i, fasta_file_path in enumerate(fasta_files_path):
+            for name, seq in iter_fasta_file(fasta_file_path):
+                names_groups[i].append(name.split("|")[0].lstrip(">"))
+                yield name, seq
+
+    write_fasta_records(iter_records(), merged_fasta_path)
 
     return names_groups
 
 
 def merge_fasta_files_sliding(fasta_files_path, merged_fasta_path):
-    names_groups = []
-    names_list = []
-    seqs_list = []
-    for fasta_file_path in fasta_files_path:
-        names = []
-        seqs = []
-        temp_names, temp_seqs = read_fasta_file(fasta_file_path)
-        for name, seq in zip(temp_names, temp_seqs):
-            if len(seq) > 200:
-                slid_seqs = list(seq_sliding_window(seq, 150, 100))
-                slid_names = [name for _ in range(len(slid_seqs))]
-                seqs.extend(slid_seqs)
-                names.extend(slid_names)
-            else:
-                seqs.append(seq)
-                names.append(name)
-        
-        names_groups.append([s.split("|")[0].lstrip(">") for s in names])
-        names_list.extend(names)
-        seqs_list.extend(seqs)
+    names_groups = [[] for _ in fasta_files_path]
 
-    with open(merged_fasta_path, "w") as f:
-        f.write("\n".join(chain(*zip(names_list, seqs_list))))
+    def iter_records():
+        for i, fasta_file_path in enumerate(fasta_files_path):
+            for name, seq in iter_sliding_records(iter_fasta_file(fasta_file_path)):
+                names_groups[i].append(name.split("|")[0].lstrip(">"))
+                yield name, seq
+
+    write_fasta_records(iter_records(), merged_fasta_path)
 
     return names_groups
 
@@ -270,15 +276,20 @@ def para_align_resutls(
 
 
 def group_antibodies(antibody_heavy, antibody_light, names_groups, merged_names_to_seqs):
+    # Index the chains by name once instead of scanning all chains for every name.
+    # The indices keep the order of antibody_heavy + antibody_light.
+    all_antibodies = antibody_heavy + antibody_light
+    name_to_indices = {}
+    for index, antibody in enumerate(all_antibodies):
+        name_to_indices.setdefault(antibody.name, []).append(index)
+
     for i, names in enumerate(names_groups):
         ab = AntiBody()
         abs_list = []
         for name in names:
-            temp_ab_list = []
-            for antibody in antibody_heavy + antibody_light:
-                if antibody.name == name:
-                    temp_ab_list.append(antibody)
-                    ab.add_name(name, merged_names_to_seqs[name])
+            temp_ab_list = [all_antibodies[index] for index in name_to_indices.get(name, [])]
+            for _ in temp_ab_list:
+                ab.add_name(name, merged_names_to_seqs[name])
             
             abs_combinations = list(combinations(temp_ab_list, 2))
             for ab_combination in abs_combinations:
@@ -293,7 +304,12 @@ def group_antibodies(antibody_heavy, antibody_light, names_groups, merged_names_
             #     raise ValueError("The names of sequences are not unique.")
             # else:
             for sab in abs_list:
+                old_name = sab.name
                 sab.name = sab.name + "_" + str(merged_names_to_seqs[sab.name].find(sab.seq.replace("*","")))
+                # Keep the index in step with the new name.
+                index = next(index for index in name_to_indices[old_name] if all_antibodies[index] is sab)
+                name_to_indices[old_name].remove(index)
+                bisect.insort(name_to_indices.setdefault(sab.name, []), index)
 
         if len(abs_list) == 1:
             if abs_list[0].chain_type == "H":
@@ -310,63 +326,97 @@ def group_antibodies(antibody_heavy, antibody_light, names_groups, merged_names_
         yield ab
 
 
-def get_chain_info(args):
-    fasta_dir = args.fasta_dir
+def annotate_chunk(args, records, chunk_name):
+    """
+    Annotate the regions and clonotypes of a chunk of (name, seq) records with Abalign.
+    Return the heavy and light AntiBodySingle of the chunk.
+    """
     temp_dir = args.temp_dir
-    os.makedirs(temp_dir, exist_ok=True)
-
-    fasta_files_path = [
-        os.path.join(fasta_dir, f)
-        for f in os.listdir(fasta_dir)
-        if f.endswith(".fasta") or f.endswith(".fas")
-    ]
-
-    merged_fasta_path = os.path.join(temp_dir, "all_sequences.fasta")
-    slid_merged_fasta_path = os.path.join(temp_dir, "all_sequences_sliding.fasta")
+    merged_fasta_path = os.path.join(temp_dir, "{}.fasta".format(chunk_name))
+    slid_merged_fasta_path = os.path.join(temp_dir, "{}_sliding.fasta".format(chunk_name))
 
-    names_groups = merge_fasta_files(fasta_files_path, merged_fasta_path)
-    slid_names_groups = merge_fasta_files_sliding(fasta_files_path, slid_merged_fasta_path)
+    write_fasta_records(records, merged_fasta_path)
+    write_fasta_records(iter_sliding_records(records), slid_merged_fasta_path)
 
     all_sequences_heavy_regions_path = os.path.join(
-        temp_dir, "all_sequences_sliding_heavy.fas.temp.txt"
+        temp_dir, "{}_sliding_heavy.fas.temp.txt".format(chunk_name)
     )
     all_sequences_light_regions_path = os.path.join(
-        temp_dir, "all_sequences_sliding_light.fas.temp.txt"
+        temp_dir, "{}_sliding_light.fas.temp.txt".format(chunk_name)
     )
     all_sequences_heavy_clone_path = os.path.join(
-        temp_dir, "all_sequences_sliding_heavy.vgene.clonotype_seqs.csv"
+        temp_dir, "{}_sliding_heavy.vgene.clonotype_seqs.csv".format(chunk_name)
     )
     all_sequences_light_clone_path = os.path.join(
-        temp_dir, "all_sequences_sliding_light.vgene.clonotype_seqs.csv"
+        temp_dir, "{}_sliding_light.vgene.clonotype_seqs.csv".format(chunk_name)
     )
 
-    get_clonotype(
-        fas_file=slid_merged_fasta_path,
-        out_dir=temp_dir,
-        chain_type="H",
-        regioned_file=True,
-        cpus=args.cpus,
-    )
-
-    get_clonotype(
-        fas_file=slid_merged_fasta_path,
-        out_dir=temp_dir,
-        chain_type="L",
-        regioned_file=True,
-        cpus=args.cpus,
-    )
+    # Abalign runs without changing the working directory, so both chains are annotated in parallel.
+    chain_cpus = max(1, args.cpus // 2)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(
+                get_clonotype,
+                fas_file=slid_merged_fasta_path,
+                out_dir=temp_dir,
+                chain_type=chain_type,
+                regioned_file=True,
+                cpus=chain_cpus,
+            )
+            for chain_type in ["H", "L"]
+        ]
+        for future in futures:
+            future.result()
 
-    antibodes_heavy, antibodes_light = para_align_resutls(
+    return para_align_resutls(
         all_sequences_heavy_regions_path,
         all_sequences_light_regions_path,
         all_sequences_heavy_clone_path,
         all_sequences_light_clone_path,
         merged_fasta_path,
     )
-    
-    merged_names, merged_seqs = read_fasta_file(merged_fasta_path)
-    merged_names_to_seqs = {n.lstrip(">"):s for n, s in zip(merged_names, merged_seqs)}
-    
+
+
+def get_chain_info(args, chunk_size=CHAIN_INFO_CHUNK_SIZE):
+    fasta_dir = args.fasta_dir
+    temp_dir = args.temp_dir
+    os.makedirs(temp_dir, exist_ok=True)
+
+    fasta_files_path = [
+        os.path.join(fasta_dir, f)
+        for f in os.listdir(fasta_dir)
+        if f.endswith(".fasta") or f.endswith(".fas")
+    ]
+
+    # Stream the input files and annotate them in chunks of chunk_size records,
+    # so the merged and sliding-window files never hold the whole input.
+    names_groups = [[] for _ in fasta_files_path]
+    merged_names_to_seqs = {}
+    antibodes_heavy = []
+    antibodes_light = []
+    records = []
+    chunk_idx = 0
+    for i, fasta_file_path in enumerate(fasta_files_path):
+        for name, seq in iter_fasta_file(fasta_file_path):
+            names_groups[i].append(name.split("|")[0].lstrip(">"))
+            merged_names_to_seqs[name.lstrip(">")] = seq
+            records.append((name, seq))
+            if len(records) >= chunk_size:
+                chunk_heavy, chunk_light = annotate_chunk(
+                    args, records, "all_sequences_{}".format(chunk_idx)
+                )
+                antibodes_heavy.extend(chunk_heavy)
+                antibodes_light.extend(chunk_light)
+                records = []
+                chunk_idx += 1
+
+    if len(records) > 0:
+        chunk_heavy, chunk_light = annotate_chunk(
+            args, records, "all_sequences_{}".format(chunk_idx)
+        )
+        antibodes_heavy.extend(chunk_heavy)
+        antibodes_light.extend(chunk_light)
+
     antibodes_list = [
         ab for ab in group_antibodies(antibodes_heavy, antibodes_light, names_groups, merged_names_to_seqs)
     ]
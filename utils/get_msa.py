@@ -4,7 +4,11 @@ from utils import get_msa_by_single
 from utils import get_msa_by_substitute
 from utils import get_msa_by_pair
 from utils.multiprocess import dynamic_executor_context
+from utils.msa_cache import get_msa_cache
+import shutil
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils.align import run_alignment, run_batch_alignment
 from utils.database import (
     unpaired_database_path, heavy_length_databases, 
     light_length_databases, clone_heavy_database_path, 
@@ -13,6 +17,231 @@ from utils.database import (
 )
 
 
+def get_pair_rows(pair_rows, pair):
+    return pair_rows.get((pair.get_heavy_antibody().name, pair.get_light_antibody().name))
+
+
+UNPAIRED_MSA_PREFIXES = ("clonotype_hits", "single_hits", "uniref90_hits")  # MSAs built per chain
+
+
+def dedup_chains(antibody_list):
+    """
+    Map every chain to the first chain with the same sequence and clonotype.
+    Return the unique (paired, chain) jobs, and the (canonical, duplicate) chains.
+    Chains of paired and unpaired antibodies are searched in different databases,
+    so they are never merged.
+    """
+    canonical_chains = {}
+    chain_jobs = []
+    chain_copies = []
+    for antibody in antibody_list:
+        for chain in antibody.heavy_antibody + antibody.light_antibody:
+            key = (antibody.is_paired(), chain.chain_type, chain.seq, chain.clonotype)
+            if key not in canonical_chains:
+                canonical_chains[key] = chain
+                chain_jobs.append((antibody.is_paired(), chain))
+            elif canonical_chains[key].name != chain.name:
+                chain_copies.append((canonical_chains[key], chain))
+    return chain_jobs, chain_copies
+
+
+def dedup_pairs(antibody_list):
+    """
+    Map every paired and inner-pair job to the first job with the same heavy and light
+    sequences and pair index. Return the unique (pair, label, pair_idx) jobs,
+    and the (canonical job, duplicate job) pairs.
+    """
+    pair_list = []
+    for antibody in antibody_list:
+        paired_antibodies = antibody.get_all_antibodies()
+        if paired_antibodies != None:
+            if len(paired_antibodies) == 1:
+                paired_idx = None
+            else:
+                paired_idx = 0
+            for pair in paired_antibodies:
+                try:
+                    if pair.is_paired():
+                        pair_list.append((pair, "paired_hits", paired_idx))
+                        paired_idx += 1
+                except Exception as e:
+                    pass
+
+        for i, inner_pair in enumerate(antibody.inner_pair_antibody):
+            if inner_pair != None:
+                pair_list.append((inner_pair, f"inner_pair_hits_{i}", None))
+
+    canonical_pairs = {}
+    pair_jobs = []
+    pair_copies = []
+    for job in pair_list:
+        pair, _, pair_idx = job
+        key = (pair.get_heavy_antibody().seq, pair.get_light_antibody().seq, pair_idx)
+        if key not in canonical_pairs:
+            canonical_pairs[key] = job
+            pair_jobs.append(job)
+        else:
+            pair_copies.append((canonical_pairs[key], job))
+    return pair_jobs, pair_copies
+
+
+def copy_msas(args, chain_copies, pair_copies):
+    """Copy the MSAs of the canonical chains and pairs to their duplicates."""
+    if args.use_precomputed_alignments is None:
+        out_alignments_dir = os.path.join(args.output_dir, "alignments")
+    else:
+        out_alignments_dir = args.use_precomputed_alignments
+
+    copy_list = []
+    for canonical, duplicate in chain_copies:
+        canonical_dir = os.path.join(out_alignments_dir, canonical.name)
+        if not os.path.exists(canonical_dir):
+            continue
+        for file in os.listdir(canonical_dir):
+            if file.startswith(UNPAIRED_MSA_PREFIXES) and file.endswith(".a3m"):
+                copy_list.append(
+                    (os.path.join(canonical_dir, file), os.path.join(out_alignments_dir, duplicate.name, file))
+                )
+
+    for (canonical, canonical_label, pair_idx), (duplicate, duplicate_label, _) in pair_copies:
+        canonical_paths = get_msa_by_pair.get_output_paths(out_alignments_dir, canonical, canonical_label, pair_idx)
+        duplicate_paths = get_msa_by_pair.get_output_paths(out_alignments_dir, duplicate, duplicate_label, pair_idx)
+        for scheme, paths in canonical_paths.items():
+            copy_list.extend(zip(paths, duplicate_paths[scheme]))
+
+    for src_path, dst_path in copy_list:
+        if not os.path.exists(src_path) or src_path == dst_path:
+            continue
+        if args.use_precomputed_msas and os.path.exists(dst_path):
+            continue
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        shutil.copyfile(src_path, dst_path)
+
+
+class RealignScheduler:
+    """
+    Realign finished MSAs concurrently with Abalign.
+
+    Each Abalign call uses threads_per_call threads, and cpus // threads_per_call
+    calls run at the same time. By default every MSA is aligned by its own call.
+    With batch_realign, an MSA is submitted as soon as it is added if a call slot
+    is free; otherwise it waits in the queue of its chain type, and the queued MSAs
+    are aligned together by one batched call (see run_batch_alignment) when a slot
+    frees up or the queue reaches batch_size.
+    """
+
+    def __init__(self, cpus, threads_per_call=4, batch_size=64, tmp_dir=None, msa_cache=None, batch_realign=False):
+        self.threads_per_call = max(1, min(threads_per_call, cpus))
+        self.max_calls = max(1, cpus // self.threads_per_call)
+        self.batch_realign = batch_realign
+        # Without batching every MSA is submitted on its own and waits in the executor queue.
+        self.batch_size = batch_size if batch_realign else 1
+        self.tmp_dir = tmp_dir
+        self.msa_cache = msa_cache
+        self.executor = ThreadPoolExecutor(max_workers=self.max_calls)
+        self.lock = threading.Lock()
+        self.queues = {"H": [], "L": []}  # Queued (fas_file, out_path, task) of each chain type
+        self.running = 0  # Number of submitted Abalign calls not finished yet
+        self.futures = []
+
+    def add_paired(self, result_list):
+        features = [
+            feature for feature in result_list
+            if feature["out_temp_name_list"] is not None and feature["out_name_list"] is not None
+        ]
+        if len(features) == 0:
+            return
+        # The heavy and light MSAs of all features must be aligned before post-processing.
+        task = {"paired": True, "results": result_list, "remaining": 2 * len(features)}
+        for feature in features:
+            self.enqueue("H", feature["out_temp_name_list"][0], feature["out_name_list"][0], task)
+            self.enqueue("L", feature["out_temp_name_list"][1], feature["out_name_list"][1], task)
+
+    def add_unpaired(self, results):
+        task = {"paired": False, "results": results, "remaining": 1}
+        self.enqueue(results["chain_type"], results["out_fasta_temp_path"], results["out_msa_path"], task)
+
+    def enqueue(self, chain_type, fas_file, out_path, task):
+        with self.lock:
+            self.queues[chain_type].append((fas_file, out_path, task))
+            if self.running < self.max_calls or len(self.queues[chain_type]) >= self.batch_size:
+                self.submit(chain_type)
+
+    def submit(self, chain_type):
+        # Called with self.lock held.
+        jobs = self.queues[chain_type]
+        if len(jobs) == 0:
+            return
+        self.queues[chain_type] = []
+        self.running += 1
+        self.futures.append(self.executor.submit(self.run, chain_type, jobs))
+
+    def run(self, chain_type, jobs):
+        try:
+            if self.batch_realign:
+                run_batch_alignment(
+                    [(fas_file, out_path) for fas_file, out_path, _ in jobs],
+                    "chothia",
+                    chain_type,
+                    self.threads_per_call,
+                    tmp_dir=self.tmp_dir,
+                )
+            else:
+                for fas_file, out_path, _ in jobs:
+                    if os.path.exists(fas_file):
+                        run_alignment(fas_file, out_path, "chothia", chain_type, cpus=self.threads_per_call)
+            for _, _, task in jobs:
+                with self.lock:
+                    task["remaining"] -= 1
+                    finished = task["remaining"] == 0
+                if finished:
+                    self.finish(task)
+        finally:
+            with self.lock:
+                self.running -= 1
+                # Start the MSAs queued while all call slots were busy.
+                for queued_chain_type in self.queues:
+                    if self.running < self.max_calls:
+                        self.submit(queued_chain_type)
+
+    def finish(self, task):
+        if task["paired"]:
+            get_msa_by_pair.process_feature(
+                task["results"],
+                self.threads_per_call,
+                msa_cache=self.msa_cache,
+                aligned=True,
+            )
+            return
+
+        results = task["results"]
+        try:
+            get_msa_by_clonotype.finish_msa(
+                results["out_fasta_temp_path"],
+                results["out_msa_path"],
+                msa_cache=self.msa_cache,
+                cache_key=results.get("cache_key"),
+            )
+        except Exception as e:
+            print("Realign {} failed: {}".format(results["out_msa_path"], e))
+
+    def close(self):
+        """Align the remaining queued MSAs and wait for all calls to finish."""
+        with self.lock:
+            for chain_type in self.queues:
+                self.submit(chain_type)
+        # Calls finishing here may submit more calls, so wait until the list stops growing.
+        index = 0
+        while True:
+            with self.lock:
+                if index >= len(self.futures):
+                    break
+                future = self.futures[index]
+            future.result()
+            index += 1
+        self.executor.shutdown()
+
+
 def get_msa(args, antibody_list):
     
     result_list = []
@@ -23,83 +252,77 @@ def get_msa(args, antibody_list):
     databases_path = args.databases_path
     unpaired_database_length_dict = get_msa_by_single.get_database_length_dict(databases_path)
     fv_lengths_max, fv_lengths_q3, fv_database_path = get_msa_by_pair.get_database_stats(databases_path)
+    msa_cache = get_msa_cache(args)
+
+    for antibody in antibody_list:
+        if antibody.is_paired() and (length_heavy_max == 0 or length_light_max == 0):
+            length_heavy_max, length_light_max = get_msa_by_substitute.get_sub_max_length(databases_path, heavy_length_databases, light_length_databases)
+        elif ab_heavy_max == 0 or ab_light_max == 0:
+            ab_heavy_max, ab_light_max = get_msa_by_substitute.get_sub_max_length(databases_path, heavy_ab_database_path, light_ab_database_path)
+
+    # Identical chains and pairs of the batch are built once, and their MSAs
+    # are copied to the duplicates after the realignment.
+    chain_jobs, chain_copies = dedup_chains(antibody_list)
+    pair_jobs, pair_copies = dedup_pairs(antibody_list)
+
+    # Search the length databases for all chains of the batch at once, 
+    # so that each database is scanned once per batch instead of once per chain.
+    sub_rows = {}
+    sub_rows.update(get_msa_by_substitute.batch_search_databases(
+        databases_path, heavy_length_databases, [c for paired, c in chain_jobs if paired and c.chain_type == "H"], length_heavy_max, "H"))
+    sub_rows.update(get_msa_by_substitute.batch_search_databases(
+        databases_path, light_length_databases, [c for paired, c in chain_jobs if paired and c.chain_type == "L"], length_light_max, "L"))
+    sub_rows.update(get_msa_by_substitute.batch_search_databases(
+        databases_path, heavy_ab_database_path, [c for paired, c in chain_jobs if not paired and c.chain_type == "H"], ab_heavy_max, "H"))
+    sub_rows.update(get_msa_by_substitute.batch_search_databases(
+        databases_path, light_ab_database_path, [c for paired, c in chain_jobs if not paired and c.chain_type == "L"], ab_light_max, "L"))
+
+    pair_rows = get_msa_by_pair.batch_search_databases(
+        databases_path, [pair for pair, _, _ in pair_jobs], fv_lengths_max, fv_lengths_q3)
 
     with  dynamic_executor_context(process_threshold=1, max_workers=args.cpus) as dynamic_executor:
-        futures = []
+        # Register the large read-only arguments used by every task once, before the process
+        # pool starts, so that the tasks only carry their handles. The candidate rows of each
+        # task are only used by that task and are passed directly.
+        unpaired_database_length_handle = dynamic_executor.share(unpaired_database_length_dict)
+        tasks = []
+        # Search sequences for unpaired MSA
+        for paired, chain in chain_jobs:
+            if chain.chain_type == "H":
+                sub_database_path = heavy_length_databases if paired else heavy_ab_database_path
+                sub_length_max = length_heavy_max if paired else ab_heavy_max
+            else:
+                sub_database_path = light_length_databases if paired else light_ab_database_path
+                sub_length_max = length_light_max if paired else ab_light_max
+            tasks.append((get_msa_by_clonotype.build_msa, args, chain, chain.chain_type))
+            tasks.append((get_msa_by_single.build_msa, args, chain, "chothia", chain.chain_type, unpaired_database_length_handle))
+            tasks.append((get_msa_by_substitute.build_msa, args, chain, "chothia", chain.chain_type, sub_database_path, sub_length_max, sub_rows.get(chain.name)))
+
+        # Search sequences for paired and inner-pair MSA
+        for pair, label, pair_idx in pair_jobs:
+            tasks.append((get_msa_by_pair.build_msa, args, pair, fv_lengths_max, fv_lengths_q3, fv_database_path, label, pair_idx, get_pair_rows(pair_rows, pair)))
+
         executor = dynamic_executor.get_executor(10)
-        for antibody in antibody_list:
-            if antibody.is_paired() and (length_heavy_max == 0 or length_light_max == 0):
-                length_heavy_max, length_light_max = get_msa_by_substitute.get_sub_max_length(databases_path, heavy_length_databases, light_length_databases)
-            elif ab_heavy_max == 0 or ab_light_max == 0:
-                ab_heavy_max, ab_light_max = get_msa_by_substitute.get_sub_max_length(databases_path, heavy_ab_database_path, light_ab_database_path)
-            
-            # Search sequences for unpaired MSA
-            for heavy_chain in antibody.heavy_antibody:
-                futures.append(executor.submit(get_msa_by_clonotype.build_msa, args, heavy_chain, "H"))
-                futures.append(executor.submit(get_msa_by_single.build_msa, args, heavy_chain, "chothia", "H", unpaired_database_length_dict))
-                if antibody.is_paired():
-                    futures.append(executor.submit(get_msa_by_substitute.build_msa, args, heavy_chain, "chothia", "H", heavy_length_databases, length_heavy_max))
-                else:
-                    futures.append(executor.submit(get_msa_by_substitute.build_msa, args, heavy_chain, "chothia", "H", heavy_ab_database_path, ab_heavy_max))
-
-            for light_chain in antibody.light_antibody:
-                futures.append(executor.submit(get_msa_by_clonotype.build_msa, args, light_chain, "L"))
-                futures.append(executor.submit(get_msa_by_single.build_msa, args, light_chain, "chothia", "L", unpaired_database_length_dict))
-                if antibody.is_paired():
-                    futures.append(executor.submit(get_msa_by_substitute.build_msa, args, light_chain, "chothia", "L", light_length_databases, length_light_max))
-                else:
-                    futures.append(executor.submit(get_msa_by_substitute.build_msa, args, light_chain, "chothia", "L", light_ab_database_path, ab_light_max))
-            
-            # Search sequences for paired MSA
-            paired_antibodies = antibody.get_all_antibodies()
-            if paired_antibodies == None:
-                continue
-            if len(paired_antibodies) == 1:
-                paired_idx = None
+        futures = [executor.submit(*task) for task in tasks]
+
+        # Realign each MSA as soon as its builder finishes.
+        realign_scheduler = RealignScheduler(
+            args.cpus,
+            threads_per_call=args.realign_threads,
+            tmp_dir=args.temp_dir,
+            msa_cache=msa_cache,
+            batch_realign=getattr(args, "batch_realign", False),
+        )
+        for future in as_completed(futures):
+            result_list = future.result()
+
+            if result_list and result_list[0].get("out_temp_name_list"):
+                realign_scheduler.add_paired(result_list)
             else:
-                paired_idx = 0
-            for pair in paired_antibodies:
-                try:
-                    if pair.is_paired():
-                        futures.append(executor.submit(get_msa_by_pair.build_msa, args, pair, fv_lengths_max, fv_lengths_q3, fv_database_path, "paired_hits", paired_idx))
-                        paired_idx += 1
-                except Exception as e:
-                    pass
-            
-            # Search sequences for inner-pair MSA
-            for i, inner_pair in enumerate(antibody.inner_pair_antibody):
-                if inner_pair != None:
-                    futures.append(
-                        executor.submit(
-                            get_msa_by_pair.build_msa, args, inner_pair, fv_lengths_max, fv_lengths_q3, fv_database_path, f"inner_pair_hits_{i}"
-                        )
-                    )
-            
-        with ThreadPoolExecutor(max_workers=1) as realign_executor:
-            paired_idx_start = 0
-            for future in as_completed(futures):
-                result_list = future.result()
-
-                if result_list[0].get("out_temp_name_list"):
-                    # Perform paired-sequence multi-sequence alignment
-                    paired_idx_start += realign_executor.submit(
-                        get_msa_by_pair.process_feature,
-                        result_list,
-                        args.cpus,
-                    ).result()
-                    if paired_idx_start > 100000000:
-                        paired_idx_start = 0
-
-                else:
-                    # Perform unpaired-sequence multi-sequence alignment
-                    for results in result_list:
-                        if type(results) == dict and results.get("out_fasta_temp_path"):
-                            realign_executor.submit(
-                                get_msa_by_clonotype.realign_msa, 
-                                results["out_fasta_temp_path"], 
-                                results["out_msa_path"], 
-                                "chothia", 
-                                args.cpus, 
-                                chain_type=results["chain_type"]
-                            )
-                
\ No newline at end of file
+                for results in result_list:
+                    if type(results) == dict and results.get("out_fasta_temp_path"):
+                        realign_scheduler.add_unpaired(results)
+
+        realign_scheduler.close()
+
+    copy_msas(args, chain_copies, pair_copies)
@@ -2,12 +2,14 @@ import sys
 import os
 import csv
 import itertools
+import bisect
 import pickle
 import time
 import numpy as np
 import argparse
 import logging
 import glob
+import shutil
 from time import time
 from utils.fasta import (
     read_fasta_file,
@@ -15,8 +17,10 @@ from utils.fasta import (
     save_data_to_pickle,
     read_data_from_pickle,
 )
-from utils.align import run_alignment, get_clonotype
-from utils.database import clone_heavy_database_path, clone_light_database_path
+from utils.align import run_alignment, get_clonotype, delete_msa_by_first_seq
+from utils.database import clone_heavy_database_path, clone_light_database_path, database_registry
+from utils.length_database import COLUMNAR_SUFFIX
+from utils.msa_cache import get_msa_cache, get_database_fingerprint
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import multiprocessing as mp
 from utils.get_chain_info import AntiBody, AntiBodySingle
@@ -117,6 +121,202 @@ def find_matching_group(
     return group_list
 
 
+class ClonotypeDatabase:
+    """
+    Clonotype groups and their (sequence, abundance) members.
+
+    The members of all groups are stored as one sequence blob with offsets,
+    either in memory or opened with np.memmap from the columnar copy written
+    by convert_clonotype_to_columnar.
+    """
+
+    def __init__(self, groups, group_offsets, seq_blob, seq_offsets, abundances):
+        self.groups = groups  # Clonotype of each group
+        self.group_offsets = group_offsets  # (G + 1,) first member of each group
+        self.seq_blob = seq_blob  # uint8 concatenation of all member sequences
+        self.seq_offsets = seq_offsets  # (S + 1,) start of each member sequence in seq_blob
+        self.abundances = abundances  # (S,) abundance of each member
+
+    @classmethod
+    def from_clone_dict(cls, clone_dict):
+        groups = list(clone_dict.keys())
+        members = [member for group in groups for member in clone_dict[group]]
+        group_offsets = np.zeros(len(groups) + 1, dtype=np.int64)
+        np.cumsum([len(clone_dict[group]) for group in groups], out=group_offsets[1:])
+        seq_bytes = [member[0].encode("ascii") for member in members]
+        seq_offsets = np.zeros(len(seq_bytes) + 1, dtype=np.int64)
+        np.cumsum([len(seq) for seq in seq_bytes], out=seq_offsets[1:])
+        seq_blob = np.frombuffer(b"".join(seq_bytes), dtype=np.uint8)
+        abundances = np.array([member[1] for member in members], dtype=np.int64)
+        return cls(groups, group_offsets, seq_blob, seq_offsets, abundances)
+
+    @classmethod
+    def from_columnar(cls, columnar_dir):
+        with open(os.path.join(columnar_dir, "groups.txt"), "r") as f:
+            groups = f.read().splitlines()
+        group_offsets = np.load(os.path.join(columnar_dir, "group_offsets.npy"), mmap_mode="r")
+        seq_offsets = np.load(os.path.join(columnar_dir, "offsets.npy"), mmap_mode="r")
+        abundances = np.load(os.path.join(columnar_dir, "abundances.npy"), mmap_mode="r")
+        blob_path = os.path.join(columnar_dir, "seqs.bin")
+        if os.path.getsize(blob_path) > 0:
+            seq_blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            seq_blob = np.zeros(0, dtype=np.uint8)
+        return cls(groups, group_offsets, seq_blob, seq_offsets, abundances)
+
+    def save_columnar(self, columnar_dir):
+        # Write to a temporary directory first so readers never see a partial database.
+        tmp_dir = "{}.{}.tmp".format(columnar_dir, os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        with open(os.path.join(tmp_dir, "groups.txt"), "w") as f:
+            f.write("\n".join(self.groups))
+        np.save(os.path.join(tmp_dir, "group_offsets.npy"), np.asarray(self.group_offsets))
+        np.save(os.path.join(tmp_dir, "offsets.npy"), np.asarray(self.seq_offsets))
+        np.save(os.path.join(tmp_dir, "abundances.npy"), np.asarray(self.abundances))
+        with open(os.path.join(tmp_dir, "seqs.bin"), "wb") as f:
+            f.write(np.asarray(self.seq_blob).tobytes())
+
+        if os.path.exists(columnar_dir):
+            shutil.rmtree(columnar_dir)
+        os.rename(tmp_dir, columnar_dir)
+
+    def get_group(self, group_id):
+        """Return the members of a group as [[sequence, abundance], ...]."""
+        start, end = self.group_offsets[group_id], self.group_offsets[group_id + 1]
+        offsets = self.seq_offsets[start : end + 1]
+        group_seq = self.seq_blob[offsets[0] : offsets[-1]].tobytes().decode("ascii")
+        offsets = offsets - offsets[0]
+        return [
+            [group_seq[offsets[i] : offsets[i + 1]], int(self.abundances[start + i])]
+            for i in range(end - start)
+        ]
+
+
+def get_clonotype_columnar_dir(database_path):
+    """Directory of the columnar copy stored next to the pickled clonotype database."""
+    return os.path.splitext(database_path)[0] + COLUMNAR_SUFFIX
+
+
+def convert_clonotype_to_columnar(database_path):
+    columnar_dir = get_clonotype_columnar_dir(database_path)
+    clone_database = ClonotypeDatabase.from_clone_dict(
+        clone_seq_dict(read_data_from_pickle(database_path))
+    )
+    clone_database.save_columnar(columnar_dir)
+    return columnar_dir
+
+
+def load_clonotype_database(database_path):
+    """
+    Load a clonotype database, preferring its columnar copy when it is up to date.
+    """
+    columnar_dir = get_clonotype_columnar_dir(database_path)
+    if os.path.exists(os.path.join(columnar_dir, "groups.txt")) and (
+        not os.path.exists(database_path)
+        or os.path.getmtime(columnar_dir) >= os.path.getmtime(database_path)
+    ):
+        return ClonotypeDatabase.from_columnar(columnar_dir)
+
+    return ClonotypeDatabase.from_clone_dict(clone_seq_dict(read_data_from_pickle(database_path)))
+
+
+def get_clonotype_index(database_path):
+    """
+    ClonotypeIndex of a clonotype database, loaded once per process.
+    """
+    return database_registry.get(
+        "clonotype_index",
+        database_path,
+        lambda: ClonotypeIndex(load_clonotype_database(database_path)),
+    )
+
+
+def gene_prefix(gene, split="*"):
+    # Same prefix as gene_similarity compares, two genes are similar iff their prefixes are equal.
+    return gene[: gene.find(split)]
+
+
+class ClonotypeIndex:
+    """
+    Index of the clonotype groups keyed by V/J-gene prefixes.
+
+    Every split mode has its own dict from the gene prefixes to the groups
+    sharing them, sorted by CDR3 length, so a query is a dict lookup plus a
+    bisect over the CDR3 length window instead of a scan over all groups.
+    """
+
+    def __init__(self, clone_database, paired=False):
+        self.clone_database = clone_database
+        self.paired = paired
+        self.groups = clone_database.groups
+        self.genes = []  # Gene names of each group
+        self.cdr3_lengths = []  # CDR3 lengths of each group
+        for group in self.groups:
+            genes, cdr3_lengths = self.parse(group)
+            self.genes.append(genes)
+            self.cdr3_lengths.append(cdr3_lengths)
+        self.buckets = {}  # {(v_split, j_split): {gene prefixes: (cdr3 lengths, group ids)}}
+
+    def parse(self, clonotype):
+        clonotype_dict = clonotype_to_dict(clonotype, self.paired)
+        if self.paired:
+            genes = (clonotype_dict["HV"], clonotype_dict["HJ"], clonotype_dict["LV"], clonotype_dict["LJ"])
+            cdr3_lengths = (len(clonotype_dict["HCDR3"]), len(clonotype_dict["LCDR3"]))
+        else:
+            genes = (clonotype_dict["V"], clonotype_dict["J"])
+            cdr3_lengths = (len(clonotype_dict["CDR3"]),)
+        return genes, cdr3_lengths
+
+    def get_key(self, genes, v_split, j_split):
+        if self.paired:
+            # The heavy J gene is compared with v_split, as in find_matching_group.
+            splits = (v_split, v_split, v_split, j_split)
+        else:
+            splits = (v_split, j_split)
+        return tuple(gene_prefix(gene, split) for gene, split in zip(genes, splits))
+
+    def get_buckets(self, v_split, j_split):
+        if (v_split, j_split) not in self.buckets:
+            buckets = {}
+            for group_id, genes in enumerate(self.genes):
+                key = self.get_key(genes, v_split, j_split)
+                buckets.setdefault(key, []).append(group_id)
+            for key, group_ids in buckets.items():
+                group_ids.sort(key=lambda group_id: self.cdr3_lengths[group_id][0])
+                lengths = [self.cdr3_lengths[group_id][0] for group_id in group_ids]
+                buckets[key] = (lengths, group_ids)
+            self.buckets[(v_split, j_split)] = buckets
+        return self.buckets[(v_split, j_split)]
+
+    def query(self, target, diff=0, v_split="-", j_split="*"):
+        """
+        Return the sequences of all groups matching target, same as find_matching_group.
+        """
+        genes, cdr3_lengths = self.parse(target)
+        bucket = self.get_buckets(v_split, j_split).get(self.get_key(genes, v_split, j_split))
+        if bucket is None:
+            return []
+
+        lengths, group_ids = bucket
+        start = bisect.bisect_left(lengths, cdr3_lengths[0] - diff)
+        end = bisect.bisect_right(lengths, cdr3_lengths[0] + diff)
+        matched = [
+            group_id
+            for group_id in group_ids[start:end]
+            if all(
+                abs(length - target_length) <= diff
+                for length, target_length in zip(self.cdr3_lengths[group_id][1:], cdr3_lengths[1:])
+            )
+        ]
+        # Keep the order of the database, as the linear scan did.
+        matched.sort()
+
+        group_list = []
+        for group_id in matched:
+            group_list.extend(self.clone_database.get_group(group_id))
+        return group_list
+
+
 def find_matching_group_by_seq(
     target_clonotype,
     target_seq,
@@ -125,17 +325,19 @@ def find_matching_group_by_seq(
     max_diff=10,
     min_seqs=100,
     paired=False,
+    clone_index=None,  # Prebuilt ClonotypeIndex, clone_data is only used when it is None
 ):
-    clone_dict = clone_seq_dict(clone_data)
+    if clone_index is None:
+        clone_index = ClonotypeIndex(
+            ClonotypeDatabase.from_clone_dict(clone_seq_dict(clone_data)), paired
+        )
     split_char_list = [("*", "*"), ("-", "*"), ("V", "J")]
     return_flag = False
     for index in range(max_diff):
         for split_char in split_char_list:
-            group_list = find_matching_group(
-                clone_dict,
+            group_list = clone_index.query(
                 target_clonotype,
                 index,
-                paired,
                 split_char[0],
                 split_char[1],
             )
@@ -154,26 +356,14 @@ def find_matching_group_by_seq(
     return len(names)
 
 
-def delete_msa_by_first_seq(msa_path):
-    """Remove columns from the MSA if the first sequence has a gap in that column."""
-    names_list, seqs_list = read_fasta_file(msa_path)
-    target_seq = seqs_list[0]
-    delete_index_list = [index for index, char in enumerate(target_seq) if char == "-"]
-
-    seqs_list = np.array([list(seq) for seq in seqs_list])
-    seqs_list = np.delete(seqs_list, delete_index_list, axis=1)
-    seqs_list = seqs_list.tolist()
-    seqs_list = ["".join(chars) for chars in seqs_list]
-
-    return names_list, seqs_list
-
-
 def realign_msa(
     out_fasta_temp_path,
     out_msa_path,
     scheme,
     cpus,
     chain_type="H",
+    msa_cache=None,
+    cache_key=None,
 ):
     if out_fasta_temp_path is None or out_msa_path is None:
         return
@@ -184,8 +374,20 @@ def realign_msa(
         chain=chain_type,
         cpus=cpus,
     )
+    finish_msa(out_fasta_temp_path, out_msa_path, msa_cache, cache_key)
+
+
+def finish_msa(
+    out_fasta_temp_path,
+    out_msa_path,
+    msa_cache=None,
+    cache_key=None,
+):
+    """Post-process an MSA aligned by Abalign, see realign_msa."""
     msa_names_list, msa_seqs_list = delete_msa_by_first_seq(out_msa_path)
     write_fasta_file(msa_names_list, msa_seqs_list, out_msa_path)
+    if msa_cache is not None and cache_key is not None:
+        msa_cache.store(cache_key, [out_msa_path])
 
     if os.path.exists(out_fasta_temp_path):
         os.remove(out_fasta_temp_path)
@@ -199,6 +401,7 @@ def search_msa_by_clonotype(
     use_precomputed_msas,
     clone_database_path,
     chain_type="H",
+    msa_cache=None,
 ):
     # if chain_type == "H":
     #     antibody = antibody.get_heavy_antibody()
@@ -240,15 +443,26 @@ def search_msa_by_clonotype(
             result_list.append(feature_dict)
             continue
 
-        clone_data = read_data_from_pickle(database_path)
+        cache_key = None
+        if msa_cache is not None:
+            cache_key = msa_cache.get_key(
+                "clonotype", antibody.seq, antibody.clonotype, chain_type, scheme,
+                get_database_fingerprint(database_path),
+            )
+            if msa_cache.fetch(cache_key, [out_msa_path]):
+                result_list.append(feature_dict)
+                continue
+
         find_matching_group_by_seq(
             target_clonotype=antibody.clonotype,
             target_seq=antibody.seq.replace("*", ""),
-            clone_data=clone_data,
+            clone_data=None,
             outfile=out_fasta_temp_path,
+            clone_index=get_clonotype_index(database_path),
         )
         feature_dict["out_fasta_temp_path"] = out_fasta_temp_path
         feature_dict["out_msa_path"] = out_msa_path
+        feature_dict["cache_key"] = cache_key
 
         result_list.append(feature_dict)
 
@@ -277,8 +491,9 @@ def build_msa(args, antibody, chain_type):
         tmp_dir,
         out_alignments_dir,
         use_precomputed_msas,
-        clone_heavy_database_path,
+        clone_heavy_database_path if chain_type == "H" else clone_light_database_path,
         chain_type=chain_type,
+        msa_cache=get_msa_cache(args),
     )
     
     return results
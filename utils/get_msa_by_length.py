@@ -1,6 +1,7 @@
 import os
 import shutil
 import pandas as pd
+import numpy as np
 import csv
 from time import time
 from typing import Dict
@@ -8,6 +9,7 @@ from utils.fasta import read_fasta_file, write_fasta_file, save_data_to_pickle,
 from utils.align import run_alignment, delete_msa_by_first_seq
 from utils.database import regions, schemes, heavy_length_databases, light_length_databases, \
 unpaired_database_path, fv_length_database_path, regions_fv, heavy_ab_database_path, light_ab_database_path
+from utils.get_msa_utils import batch_hamming
 
 fv_seqs = None # Global variable to store Fv region sequences, avoiding duplicate file reads.
 fv_lengths = None # Global variable to store the Fv region length, avoiding duplicate file reads.
@@ -59,17 +61,6 @@ def find_sequences(
     return matched_sequences
 
 
-def hamming_distance(s1, s2):
-    """Calculate the Hamming distance between two strings"""
-    if len(s1) != len(s2):
-        raise ValueError("The two strings have different lengths, cannot calculate Hamming distance.")
-
-    distance = 0
-    for i in range(len(s1)):
-        distance += bin(ord(s1[i]) ^ ord(s2[i])).count('1')
-    return distance
-
-
 def cdrs_length_match(
     database_lengths:Dict[str, UnpairedFasta],
     query_length, 
@@ -209,8 +200,8 @@ def get_msa_by_regions_length_paired(
             
             if len(target_seqs) >= minmin_seqs or cycle == 99:
                 if len(target_seqs) > minmax_seqs:
-                    target_seqs = [seq for seq in target_seqs if len(regioned_seq.split("*")[5]) == len(seq[5]) 
-                                   and hamming_distance(regioned_seq.split("*")[5], seq[5]) <= int(target_lengths[5] * 0.8 * 2)]
+                    distances = batch_hamming(regioned_seq.split("*")[5], [seq[5] for seq in target_seqs])
+                    target_seqs = [target_seqs[i] for i in np.flatnonzero(distances <= int(target_lengths[5] * 0.8 * 2))]
                 target_seqs_heavy = ["".join(seq[:7]) for seq in target_seqs]
                 target_seqs_light = ["".join(seq[7:]) for seq in target_seqs]
 
@@ -331,7 +322,8 @@ def get_msa_by_regions_length_substitution(
             target_seqs = target_seqs.to_numpy().tolist()
             if len(target_seqs) >= minmin_seqs or cycle == 49:
                 if len(target_seqs) > maxmin_seqs:
-                    target_seqs = [seq for seq in target_seqs if len(regioned_seq.split("*")[5]) == len(seq[5]) and hamming_distance(regioned_seq.split("*")[5], seq[5]) <= int(target_lengths[5] * 0.8 * 2)]
+                    distances = batch_hamming(regioned_seq.split("*")[5], [seq[5] for seq in target_seqs])
+                    target_seqs = [target_seqs[i] for i in np.flatnonzero(distances <= int(target_lengths[5] * 0.8 * 2))]
                 target_seqs = target_seqs[:maxmin_seqs]
                 target_seqs = ["".join(seq) for seq in target_seqs]
                 target_seqs = [seq_without_region] + target_seqs
@@ -451,7 +443,8 @@ def get_msa_by_regions_length_unpaired(
             
             if query_cdr3_length == int(closest_lengths[3]) and len(target_seqs_list_temp) >= minmin_seqs*10:
                 hamming_distance_cutoff = int(target_lengths[5] * hamming_tolerance)
-                target_seqs_list.extend([target_seqs_list_temp[index] for index, t_seq in enumerate(target_names_list_temp) if len(t_seq.lstrip(">")) == query_cdr3_length and hamming_distance(t_seq.lstrip(">"), query_cdr3) <= hamming_distance_cutoff])
+                distances = batch_hamming(query_cdr3, [t_seq.lstrip(">") for t_seq in target_names_list_temp])
+                target_seqs_list.extend([target_seqs_list_temp[index] for index in np.flatnonzero(distances <= hamming_distance_cutoff)])
             else:
                 target_seqs_list.extend(target_seqs_list_temp)
                 if len(target_seqs_list) > maxmin_seqs:
@@ -461,7 +454,8 @@ def get_msa_by_regions_length_unpaired(
             while len(target_seqs_list) > maxmin_seqs:
                 hamming_tolerance = hamming_tolerance * 0.9
                 hamming_distance_cutoff = int(target_lengths[5] * hamming_tolerance)
-                target_seqs_list = [target_seqs_list_temp[index] for index, t_seq in enumerate(target_names_list_temp) if len(t_seq.lstrip(">")) == query_cdr3_length and hamming_distance(t_seq.lstrip(">"), query_cdr3) <= hamming_distance_cutoff]
+                distances = batch_hamming(query_cdr3, [t_seq.lstrip(">") for t_seq in target_names_list_temp])
+                target_seqs_list = [target_seqs_list_temp[index] for index in np.flatnonzero(distances <= hamming_distance_cutoff)]
                 if hamming_tolerance < 0.1:
                     break
 
@@ -5,21 +5,25 @@ from time import time
 from utils.fasta import (
     read_fasta_file,
     write_fasta_file,
-    read_data_from_pickle,
     merge_fasta_file,
 )
 from utils.align import run_alignment, delete_msa_by_first_seq
-from utils.database import fv_length_database_path
-from utils.get_msa_utils import find_sequences, hamming_distance
+from utils.database import fv_length_database_path, database_registry
+from utils.get_msa_utils import (
+    batch_hamming,
+    get_tolerance_schedule,
+    find_rows_by_tolerance_schedule,
+    batch_find_rows_by_tolerance_schedule,
+)
 from utils.get_chain_info import AntiBody, PairAntiBody
 from utils.database import regions, regions_fv
 from concurrent.futures import ProcessPoolExecutor, as_completed, ThreadPoolExecutor
 import multiprocessing as mp
 import random
 from utils.multiprocess import dynamic_executor_context
+from utils.msa_cache import get_msa_cache, get_database_fingerprint
 
-fv_seqs = None  # Global variable to store Fv region sequences, avoiding duplicate file reads.
-fv_lengths = None  # Global variable to store the Fv region length, avoiding duplicate file reads.
+PAIRED_TOLERANCE = [16, 0, 2, 0, 5, 0, 10, 16, 0, 2, 0, 2, 0, 10]  # Starting tolerance of each Fv region
 
 
 def realign_seqs(
@@ -36,6 +40,23 @@ def realign_seqs(
         chain="H",
         cpus=cpus,
     )
+    run_alignment(
+        fas_file=out_temp_name_list[1],
+        out_path=out_name_list[1],
+        scheme="chothia",
+        chain="L",
+        cpus=cpus,
+    )
+    return finish_seqs(out_temp_name_list, out_name_list, pair_idx, idx_start)
+
+
+def finish_seqs(
+    out_temp_name_list,
+    out_name_list,
+    pair_idx=None,
+    idx_start=0,
+):
+    """Rename and post-process the heavy and light MSAs aligned by Abalign, see realign_seqs."""
     msa_names_list, msa_seqs_list = delete_msa_by_first_seq(out_name_list[0])
     
     A_id_list = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M']
@@ -61,13 +82,6 @@ def realign_seqs(
     msa_names_list[0] = ">Heavy_chain"
     write_fasta_file(msa_names_list, msa_seqs_list, out_name_list[0])
 
-    run_alignment(
-        fas_file=out_temp_name_list[1],
-        out_path=out_name_list[1],
-        scheme="chothia",
-        chain="L",
-        cpus=cpus,
-    )
     msa_names_list, msa_seqs_list = delete_msa_by_first_seq(out_name_list[1])
     if isinstance(pair_idx, int):
         msa_names_list = [
@@ -95,42 +109,46 @@ def realign_seqs(
 
     return len(msa_names_list)
 
-def process_feature(feature_list, cpus, idx_start=0):
+def process_feature(feature_list, cpus, idx_start=0, msa_cache=None, aligned=False):
+    """
+    Realign the paired MSAs of feature_list, or only post-process them if they
+    have already been aligned by a batched alignment (aligned=True).
+    """
     for feature in feature_list:
         if feature["out_temp_name_list"] is None or feature["out_name_list"] is None:
             continue
-        idx_start += realign_seqs(
-            feature["out_temp_name_list"],
-            feature["out_name_list"],
-            cpus,
-            pair_idx=feature.get("pair_idx", None),
-            idx_start=idx_start,
-        )
+        # Only MSAs numbered from the start are cached, the cache key does not hold idx_start.
+        cacheable = idx_start == 0
+        if aligned:
+            idx_start += finish_seqs(
+                feature["out_temp_name_list"],
+                feature["out_name_list"],
+                pair_idx=feature.get("pair_idx", None),
+                idx_start=idx_start,
+            )
+        else:
+            idx_start += realign_seqs(
+                feature["out_temp_name_list"],
+                feature["out_name_list"],
+                cpus,
+                pair_idx=feature.get("pair_idx", None),
+                idx_start=idx_start,
+            )
+        if msa_cache is not None and feature.get("cache_key") is not None and cacheable:
+            msa_cache.store(feature["cache_key"], feature["out_name_list"])
     return idx_start
 
-def get_msa_by_regions_length_paired(
+def get_query_schedule(
     heavy_antibody,
     light_antibody,
-    tmp_dir,
-    tolerance=[],
-    minmin_seqs=2000,  # Minimum number of sequences
-    minmax_seqs=50000,  # Maximum number of sequences
+    tolerance,
     fv_lengths_max=None,  # Maximum length of the Fv region
     fv_lengths_qx=None,  # Upper x-quantile of the Fv region length
-    fv_seqs=None,  # Fv region sequences
-    fv_lengths=None,  # Fv region lengths
-    scheme="chothia",
 ):
-    target_names = []
-    cycle = 0
-
+    """
+    Get the region lengths of the paired query and its tolerance schedule.
+    """
     seq = heavy_antibody.seq + "*" + light_antibody.seq
-    temp_output_heavy = os.path.join(
-        tmp_dir, "pair_{}_msa_{}_{}.fas".format(heavy_antibody.name, scheme, random.randint(1,10000))
-    )
-    temp_output_light = os.path.join(
-        tmp_dir, "pair_{}_msa_{}_{}.fas".format(light_antibody.name, scheme, random.randint(1,10000))
-    )
     regioned_seq = seq.replace("-", "")
     target_lengths = [len(region) for region in regioned_seq.split("*")]
     # tolerance[5] += int(target_lengths[5] * 0.1) # Default tolerance of 0.1 is allowed
@@ -149,57 +167,163 @@ def get_msa_by_regions_length_paired(
             for i in range(len(target_lengths))
         ]
 
-    target_lengths_df = np.tile(target_lengths, (fv_seqs.shape[0], 1))
-    target_df = pd.DataFrame(target_lengths_df, columns=regions_fv)
+    schedule = get_tolerance_schedule(tolerance, upper_count_list, max_cycle=100)
+
+    return target_lengths, schedule
+
 
-    while len(target_names) < minmin_seqs and cycle < 100:
-        target_seqs = find_sequences(
-            seqs_df=fv_seqs,
-            length_df=fv_lengths,
-            target_df=target_df,
-            tolerance=tolerance,
+def batch_search(
+    pair_list,
+    fv_lengths,
+    fv_lengths_max=None,
+    fv_lengths_qx=None,
+    tolerance=PAIRED_TOLERANCE,
+    minmin_seqs=2000,
+):
+    """
+    Search the Fv database for all paired queries in one pass.
+    Return the matched rows of each pair, in the order of pair_list.
+    """
+    targets_lengths = []
+    schedules = []
+    for pair in pair_list:
+        target_lengths, schedule = get_query_schedule(
+            pair.get_heavy_antibody(),
+            pair.get_light_antibody(),
+            tolerance,
+            fv_lengths_max=fv_lengths_max,
+            fv_lengths_qx=fv_lengths_qx,
         )
-        target_seqs = target_seqs.to_numpy().tolist()
-
-        if len(target_seqs) >= minmin_seqs or cycle == 99:
-            if len(target_seqs) > minmax_seqs:
-                target_seqs = [
-                    seq
-                    for seq in target_seqs
-                    if len(regioned_seq.split("*")[5]) == len(seq[5])
-                    and hamming_distance(regioned_seq.split("*")[5], seq[5])
-                    <= int(target_lengths[5] * 0.8 * 2)
-                ]
-            target_seqs_heavy = ["".join(seq[:7]) for seq in target_seqs]
-            target_seqs_light = ["".join(seq[7:]) for seq in target_seqs]
-
-            target_seqs_heavy = [
-                "".join(regioned_seq.split("*")[:7])
-            ] + target_seqs_heavy
-            target_seqs_light = [
-                "".join(regioned_seq.split("*")[7:])
-            ] + target_seqs_light
-            target_names = [">seq_{}".format(i) for i in range(len(target_seqs_heavy))]
-
-            write_fasta_file(target_names, target_seqs_heavy, temp_output_heavy)
-            write_fasta_file(target_names, target_seqs_light, temp_output_light)
-
-            break
+        targets_lengths.append(target_lengths)
+        schedules.append(schedule)
 
-        else:
-            if sum(upper_count_list) > 0:
-                for i, count in enumerate(upper_count_list):
-                    if count > 0:
-                        tolerance[i] = tolerance[i] + 1
-                        upper_count_list[i] = count - 1
-                        break
-            else:
-                tolerance[cycle % 14] = tolerance[cycle % 14] + 1
-            cycle += 1
+    return batch_find_rows_by_tolerance_schedule(
+        fv_lengths, targets_lengths, schedules, minmin_seqs
+    )
+
+
+def batch_search_databases(
+    databases_path,
+    pair_list,
+    fv_lengths_max=None,
+    fv_lengths_qx=None,
+):
+    """
+    Run batch_search on every Fv database for the given pairs.
+    Return {(heavy name, light name): {scheme: matched rows}}.
+    """
+    result = {
+        (pair.get_heavy_antibody().name, pair.get_light_antibody().name): {}
+        for pair in pair_list
+    }
+    if len(pair_list) == 0:
+        return result
+
+    for scheme, database_path in fv_length_database_path.items():
+        length_database = database_registry.get_length_database(os.path.join(databases_path, database_path))
+        rows_list = batch_search(
+            pair_list, length_database.lengths, fv_lengths_max=fv_lengths_max, fv_lengths_qx=fv_lengths_qx
+        )
+        for pair, rows in zip(pair_list, rows_list):
+            result[(pair.get_heavy_antibody().name, pair.get_light_antibody().name)][scheme] = rows
+
+    return result
+
+
+def get_msa_by_regions_length_paired(
+    heavy_antibody,
+    light_antibody,
+    tmp_dir,
+    tolerance=[],
+    minmin_seqs=2000,  # Minimum number of sequences
+    minmax_seqs=50000,  # Maximum number of sequences
+    fv_lengths_max=None,  # Maximum length of the Fv region
+    fv_lengths_qx=None,  # Upper x-quantile of the Fv region length
+    fv_database=None,  # Fv region length database
+    scheme="chothia",
+    fv_index=None,  # Region length index of the Fv database
+    target_rows=None,  # Matched rows precomputed by batch_search
+):
+    seq = heavy_antibody.seq + "*" + light_antibody.seq
+    temp_output_heavy = os.path.join(
+        tmp_dir, "pair_{}_msa_{}_{}.fas".format(heavy_antibody.name, scheme, random.randint(1,10000))
+    )
+    temp_output_light = os.path.join(
+        tmp_dir, "pair_{}_msa_{}_{}.fas".format(light_antibody.name, scheme, random.randint(1,10000))
+    )
+    regioned_seq = seq.replace("-", "")
+    target_lengths, schedule = get_query_schedule(
+        heavy_antibody,
+        light_antibody,
+        tolerance,
+        fv_lengths_max=fv_lengths_max,
+        fv_lengths_qx=fv_lengths_qx,
+    )
+
+    if target_rows is None:
+        # Replay the tolerance-widening schedule in a single pass over the database.
+        target_rows = find_rows_by_tolerance_schedule(
+            fv_database.lengths,
+            target_lengths,
+            schedule,
+            minmin_seqs,
+            index=fv_index,
+        )
+    target_rows = np.asarray(target_rows, dtype=np.int64)
+
+    if len(target_rows) > minmax_seqs:
+        # Filter by the CDR3 distance before gathering the full sequences.
+        distances = batch_hamming(
+            regioned_seq.split("*")[5], fv_database.get_region_seqs(target_rows, 5)
+        )
+        target_rows = target_rows[distances <= int(target_lengths[5] * 0.8 * 2)]
+    target_seqs = fv_database.get_seqs(target_rows)
+    target_seqs_heavy = ["".join(seq[:7]) for seq in target_seqs]
+    target_seqs_light = ["".join(seq[7:]) for seq in target_seqs]
+
+    target_seqs_heavy = [
+        "".join(regioned_seq.split("*")[:7])
+    ] + target_seqs_heavy
+    target_seqs_light = [
+        "".join(regioned_seq.split("*")[7:])
+    ] + target_seqs_light
+    target_names = [">seq_{}".format(i) for i in range(len(target_seqs_heavy))]
+
+    write_fasta_file(target_names, target_seqs_heavy, temp_output_heavy)
+    write_fasta_file(target_names, target_seqs_light, temp_output_light)
 
     return [temp_output_heavy, temp_output_light]
 
 
+def get_output_paths(out_alignments_dir, antibody, label="paired_hits", pair_idx=None):
+    """
+    Return {scheme: [heavy a3m path, light a3m path]} of the paired MSAs of antibody.
+    """
+    if pair_idx != None:
+        label = label + "_" + str(pair_idx)
+    extend_name = False
+    if len(fv_length_database_path.items()) > 1:
+        extend_name = True
+
+    output_paths = {}
+    for scheme in fv_length_database_path.keys():
+        heavy_output_path = os.path.join(
+            out_alignments_dir, antibody.get_heavy_antibody().name, label
+        )
+        light_output_path = os.path.join(
+            out_alignments_dir, antibody.get_light_antibody().name, label
+        )
+        if extend_name:
+            heavy_output_path += "_" + scheme + ".a3m"
+            light_output_path += "_" + scheme + ".a3m"
+        else:
+            heavy_output_path += ".a3m"
+            light_output_path += ".a3m"
+        output_paths[scheme] = [heavy_output_path, light_output_path]
+
+    return output_paths
+
+
 def search_msas_by_pair(
     antibody,
     tmp_dir,
@@ -210,16 +334,13 @@ def search_msas_by_pair(
     fv_database_path,
     label = "paired_hits",
     pair_idx = None,
+    target_rows = None,
+    msa_cache = None,
 ):
     # Generate MSA for the paired database
-    if pair_idx != None:
-        label = label + "_" + str(pair_idx)
     result_list = []
     if antibody.is_paired():
-        extend_name = False
-        if len(fv_length_database_path.items()) > 1:
-            extend_name = True
-
+        output_paths = get_output_paths(out_alignments_dir, antibody, label, pair_idx)
         for scheme, database_path in fv_length_database_path.items():
             result_dict = {
                 "out_temp_name_list": None,
@@ -228,26 +349,12 @@ def search_msas_by_pair(
             heavy_antibody = antibody.get_heavy_antibody()
             light_antibody = antibody.get_light_antibody()
 
-            heavy_output_path = os.path.join(
-                out_alignments_dir, heavy_antibody.name, label
-            )
-            light_output_path = os.path.join(
-                out_alignments_dir, light_antibody.name, label
-            )
-
+            heavy_output_path, light_output_path = output_paths[scheme]
             if not os.path.exists(os.path.dirname(heavy_output_path)):
                 os.makedirs(os.path.dirname(heavy_output_path), exist_ok=True)
             if not os.path.exists(os.path.dirname(light_output_path)):
                 os.makedirs(os.path.dirname(light_output_path), exist_ok=True)
 
-            if extend_name:
-                heavy_output_path += "_" + scheme + ".a3m"
-                light_output_path += "_" + scheme + ".a3m"
-
-            else:
-                heavy_output_path += ".a3m"
-                light_output_path += ".a3m"
-
             result_dict["out_name_list"] = [heavy_output_path, light_output_path]
             if use_precomputed_msas:
                 if os.path.exists(heavy_output_path) and os.path.exists(
@@ -257,20 +364,37 @@ def search_msas_by_pair(
                     result_list.append(result_dict)
                     continue
 
-            fv_seqs, fv_lengths = read_data_from_pickle(fv_database_path)
+            # The sequence names of the MSAs depend on pair_idx.
+            cache_key = None
+            if msa_cache is not None:
+                cache_key = msa_cache.get_key(
+                    "pair", heavy_antibody.seq, light_antibody.seq, pair_idx, scheme, PAIRED_TOLERANCE,
+                    fv_lengths_max, fv_lengths_q3, get_database_fingerprint(fv_database_path),
+                )
+                if msa_cache.fetch(cache_key, result_dict["out_name_list"]):
+                    result_list.append(result_dict)
+                    continue
+
+            fv_database = database_registry.get_length_database(fv_database_path)
+            scheme_rows = None if target_rows is None else target_rows.get(scheme)
+            fv_index = None
+            if scheme_rows is None:
+                fv_index = database_registry.get_length_index(fv_database_path)
             out_temp_name_list = get_msa_by_regions_length_paired(
                 heavy_antibody,
                 light_antibody,
                 tmp_dir,
-                tolerance=[16, 0, 2, 0, 5, 0, 10, 16, 0, 2, 0, 2, 0, 10],
+                tolerance=PAIRED_TOLERANCE,
                 fv_lengths_max=fv_lengths_max,
                 fv_lengths_qx=fv_lengths_q3,
-                fv_seqs=fv_seqs,
-                fv_lengths=fv_lengths,
+                fv_database=fv_database,
                 scheme=scheme,
+                fv_index=fv_index,
+                target_rows=scheme_rows,
             )
             result_dict["out_temp_name_list"] = out_temp_name_list
             result_dict["pair_idx"] = pair_idx
+            result_dict["cache_key"] = cache_key
             result_list.append(result_dict)
 
     else:
@@ -279,7 +403,7 @@ def search_msas_by_pair(
     return result_list
 
 
-def build_msa(args, antibody, fv_lengths_max, fv_lengths_q3, fv_database_path, label="paired_hits", pair_idx=None):
+def build_msa(args, antibody, fv_lengths_max, fv_lengths_q3, fv_database_path, label="paired_hits", pair_idx=None, target_rows=None):
     tmp_dir = args.temp_dir
     output_dir = args.output_dir
     use_precomputed_msas = args.use_precomputed_msas
@@ -304,6 +428,8 @@ def build_msa(args, antibody, fv_lengths_max, fv_lengths_q3, fv_database_path, l
         fv_database_path,
         label=label,
         pair_idx=pair_idx,
+        target_rows=target_rows,
+        msa_cache=get_msa_cache(args),
     )
     
     return result
@@ -311,11 +437,12 @@ def build_msa(args, antibody, fv_lengths_max, fv_lengths_q3, fv_database_path, l
 
 def get_database_stats(databases_path):
     fv_database_path = os.path.join(databases_path, fv_length_database_path["paired"])
-    fv_seqs, fv_lengths = read_data_from_pickle(fv_database_path)
     # Get the maximum value of each column in fv_length
-    fv_lengths_max = fv_lengths.max(axis=0).tolist()
+    fv_lengths_max = database_registry.get_max_lengths(fv_database_path)
     # Get the upper quartile of each column in fv_length
-    fv_lengths_q3 = fv_lengths.quantile(0.999).tolist()
+    fv_lengths_q3 = database_registry.get_quantile_lengths(fv_database_path, 0.999)
+    # Load the region length index here, so that the forked workers inherit it.
+    database_registry.get_length_index(fv_database_path)
 
     return fv_lengths_max, fv_lengths_q3, fv_database_path
 
@@ -343,13 +470,7 @@ def getmsa(args, antibody_list):
         os.makedirs(out_alignments_dir, exist_ok=True)
 
     # Preload the database to avoid duplicate reads.
-    global fv_seqs, fv_lengths
-    fv_database_path = os.path.join(databases_path, fv_length_database_path["paired"])
-    fv_seqs, fv_lengths = read_data_from_pickle(fv_database_path)
-    # Get the maximum value of each column in fv_length
-    fv_lengths_max = fv_lengths.max(axis=0).tolist()
-    # Get the upper quartile of each column in fv_length
-    fv_lengths_q3 = fv_lengths.quantile(0.999).tolist()
+    fv_lengths_max, fv_lengths_q3, fv_database_path = get_database_stats(databases_path)
 
     
     task_count = sum([2 for antibody in antibody_list for pair in antibody.get_all_antibodies() if pair != None])
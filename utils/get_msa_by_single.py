@@ -1,15 +1,18 @@
 import os
+import numpy as np
 from time import time
 from typing import Dict
 from utils.fasta import read_fasta_file, write_fasta_file
 from utils.align import run_alignment, delete_msa_by_first_seq
-from utils.database import unpaired_database_path
-from utils.get_msa_utils import hamming_distance, split_list
+from utils.database import unpaired_database_path, database_registry
+from utils.get_msa_utils import split_list
+from utils.unpaired_database import load_unpaired_shard
+from utils.msa_cache import get_msa_cache, get_database_fingerprint
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import hashlib
 import multiprocessing as mp
 from utils.get_chain_info import AntiBody, AntiBodySingle
-from utils.multiprocess import dynamic_executor_context
+from utils.multiprocess import dynamic_executor_context, resolve_shared
 
 class UnpairedFasta:
     def __init__(
@@ -152,43 +155,42 @@ def get_msa_by_regions_length_unpaired(
             database_path, closest_lengths_list[closest_idx][0]
         )
 
-        with open(target_database, "r") as f:
-            lines_list = f.read().splitlines()
-            target_names_list_temp = lines_list[0::2]
-            target_seqs_list_temp = lines_list[1::2]
+        shard = load_unpaired_shard(target_database)
+        distances = None
 
         if (
             query_cdr3_length == int(closest_lengths[3])
-            and len(target_seqs_list_temp) >= minmin_seqs * 10
+            and shard.n_rows >= minmin_seqs * 10
         ):
+            # The CDR3 distances of the whole file are computed once.
+            distances = shard.cdr3_distances(query_cdr3)
             hamming_distance_cutoff = int(target_lengths[5] * hamming_tolerance)
             target_seqs_list.extend(
-                [
-                    target_seqs_list_temp[index]
-                    for index, t_seq in enumerate(target_names_list_temp)
-                    if len(t_seq.lstrip(">")) == query_cdr3_length
-                    and hamming_distance(t_seq.lstrip(">"), query_cdr3)
-                    <= hamming_distance_cutoff
-                ]
+                shard.get_seqs(np.flatnonzero(distances <= hamming_distance_cutoff))
             )
         else:
-            target_seqs_list.extend(target_seqs_list_temp)
-            if len(target_seqs_list) > maxmin_seqs:
+            if len(target_seqs_list) + shard.n_rows > maxmin_seqs:
+                target_seqs_list.extend(
+                    shard.get_seqs(np.arange(max(0, maxmin_seqs - len(target_seqs_list))))
+                )
                 target_seqs_list = target_seqs_list[:maxmin_seqs]
                 break
-
-        while len(target_seqs_list) > maxmin_seqs:
-            hamming_tolerance = hamming_tolerance * 0.9
-            hamming_distance_cutoff = int(target_lengths[5] * hamming_tolerance)
-            target_seqs_list = [
-                target_seqs_list_temp[index]
-                for index, t_seq in enumerate(target_names_list_temp)
-                if len(t_seq.lstrip(">")) == query_cdr3_length
-                and hamming_distance(t_seq.lstrip(">"), query_cdr3)
-                <= hamming_distance_cutoff
-            ]
-            if hamming_tolerance < 0.1:
-                break
+            target_seqs_list.extend(shard.get_seqs())
+
+        if len(target_seqs_list) > maxmin_seqs:
+            # Shrink the tolerance until the hits of this file fit, counting the
+            # hits from the distances and only gathering the sequences once.
+            if distances is None:
+                distances = shard.cdr3_distances(query_cdr3)
+            while True:
+                hamming_tolerance = hamming_tolerance * 0.9
+                hamming_distance_cutoff = int(target_lengths[5] * hamming_tolerance)
+                seqs_count = np.count_nonzero(distances <= hamming_distance_cutoff)
+                if seqs_count <= maxmin_seqs or hamming_tolerance < 0.1:
+                    break
+            target_seqs_list = shard.get_seqs(
+                np.flatnonzero(distances <= hamming_distance_cutoff)
+            )
 
         closest_idx += 1
 
@@ -209,6 +211,7 @@ def get_msa_by_single(
     unpaired_database_length_dict,
     chain_type="H",
     hamming_tolerance=0.5 * 2,
+    msa_cache=None,
 ):
     if antibody is None:
         return []
@@ -243,6 +246,22 @@ def get_msa_by_single(
             )
             continue
 
+        cache_key = None
+        if msa_cache is not None:
+            cache_key = msa_cache.get_key(
+                "single", seq, chain_type, scheme, hamming_tolerance,
+                get_database_fingerprint(os.path.join(databases_path, databse_path)),
+            )
+            if msa_cache.fetch(cache_key, [out_msa_path]):
+                result_list.append(
+                    {
+                        "out_fasta_temp_path": None,
+                        "out_msa_path": None,
+                        "chain_type": chain_type,
+                    }
+                )
+                continue
+
         tmp_name = get_msa_by_regions_length_unpaired(
             seq,
             unpaired_database_length_dict[scheme],
@@ -257,6 +276,7 @@ def get_msa_by_single(
                 "out_fasta_temp_path": tmp_name,
                 "out_msa_path": out_msa_path,
                 "chain_type": chain_type,
+                "cache_key": cache_key,
             }
         )
 
@@ -264,6 +284,7 @@ def get_msa_by_single(
 
 
 def build_msa(args, antibody, scheme, chain_type, unpaired_database_length_dict):
+    unpaired_database_length_dict = resolve_shared(unpaired_database_length_dict)
     tmp_dir = args.temp_dir
     output_dir = args.output_dir
     use_precomputed_msas = args.use_precomputed_msas
@@ -289,12 +310,22 @@ def build_msa(args, antibody, scheme, chain_type, unpaired_database_length_dict)
         unpaired_database_length_dict,
         chain_type=chain_type,
         hamming_tolerance=0.5 * 2,
+        msa_cache=get_msa_cache(args),
     )
     
     return result
 
 
 def get_database_length_dict(databases_path):
+    # The file listing is built once per process and reused by every batch.
+    return database_registry.get(
+        "unpaired_length_dict",
+        databases_path,
+        lambda: load_database_length_dict(databases_path),
+    )
+
+
+def load_database_length_dict(databases_path):
     # Preload the database to avoid duplicate reads.
     unpaired_database_length_dict = {}
     for scheme, databse_path in unpaired_database_path.items():
@@ -2,25 +2,30 @@ import os
 import pandas as pd
 import numpy as np
 from time import time
-from utils.fasta import read_fasta_file, write_fasta_file, read_data_from_pickle
+from utils.fasta import read_fasta_file, write_fasta_file
 from utils.align import run_alignment, delete_msa_by_first_seq
 from utils.database import (
     heavy_length_databases,
     light_length_databases,
     heavy_ab_database_path,
     light_ab_database_path,
+    database_registry,
+)
+from utils.get_msa_utils import (
+    batch_hamming,
+    get_tolerance_schedule,
+    find_rows_by_tolerance_schedule,
+    batch_find_rows_by_tolerance_schedule,
 )
-from utils.get_msa_utils import find_sequences, hamming_distance
 from utils.get_chain_info import AntiBody
 from concurrent.futures import ProcessPoolExecutor, as_completed, ThreadPoolExecutor
 import multiprocessing as mp
 from utils.multiprocess import dynamic_executor_context
 from utils.database import regions
+from utils.msa_cache import get_msa_cache, get_database_fingerprint
 
-heavy_lengths_sub_list = ([])
-heavy_seqs_sub_list = ([])
-light_seqs_sub_list = ([])
-light_lengths_sub_list = ([])
+HEAVY_TOLERANCE = [10, 0, 0, 0, 0, 0, 5]  # Starting tolerance of each heavy chain region
+LIGHT_TOLERANCE = [10, 0, 10, 0, 10, 0, 10]  # Starting tolerance of each light chain region
 
 
 def realign_seqs(
@@ -46,33 +51,16 @@ def realign_seqs(
         os.remove(tmp_fasta_name)
 
 
-def get_msa_by_regions_length_substitution(
+def get_query_schedule(
     antibody,
-    tmp_dir,
-    tolerance=[0],  # Tolerance for the sequence lengths of various regions
-    chain_type="H",   # The type of the chain
-    database="uniref90",  # Database type
-    minmin_seqs=1000,  # Minimum number of sequences (requires 1000 for osa pair)
-    maxmin_seqs=10000,  # Maximum number of sequences (requires 50000 for osa pair)
-    database_index=0,  # Index of the database being used
+    tolerance,
     sub_length_max=None,  # Maximum length in the replacement database
-    heavy_seqs_sub_list=None,  # Sequences from the replacement heavy chain length database
-    heavy_lengths_sub_list=None,  # Lengths from the replacement heavy chain length database
-    light_seqs_sub_list=None,  # Sequences from the replacement light chain length database
-    light_lengths_sub_list=None,  # Lengths from the replacement light chain length database
 ):
-    assert chain_type in ["H", "L"]
-    name = antibody.name
-    seq = antibody.seq
-
-    target_names = []
-    cycle = 0
-
-    output_path = os.path.join(tmp_dir, "{}_{}_msa.fas".format(database, name))
-
-    regioned_seq = seq.replace("-", "")
+    """
+    Get the region lengths of the query chain and its tolerance schedule.
+    """
+    regioned_seq = antibody.seq.replace("-", "")
     target_lengths = [len(region) for region in regioned_seq.split("*")]
-    seq_without_region = regioned_seq.replace("*", "")
     # A tolerance of 0.1 is allowed by default in the CDR3 region. It might be necessary to check if tolerance should be applied to the light chain.
     # tolerance[5] += int(target_lengths[5] * 0.1) 
 
@@ -89,55 +77,118 @@ def get_msa_by_regions_length_substitution(
             for i in range(len(target_lengths))
         ]
 
+    schedule = get_tolerance_schedule(tolerance, upper_count_list, max_cycle=50)
+
+    return target_lengths, schedule
+
+
+def batch_search(
+    antibody_list,
+    lengths,
+    sub_length_max=None,
+    chain_type="H",
+    minmin_seqs=1000,
+):
+    """
+    Search a replacement length database for all chains of one type in one pass.
+    Return the matched rows of each chain, in the order of antibody_list.
+    """
+    tolerance = HEAVY_TOLERANCE if chain_type == "H" else LIGHT_TOLERANCE
+    targets_lengths = []
+    schedules = []
+    for antibody in antibody_list:
+        target_lengths, schedule = get_query_schedule(
+            antibody, tolerance, sub_length_max=sub_length_max
+        )
+        targets_lengths.append(target_lengths)
+        schedules.append(schedule)
+
+    return batch_find_rows_by_tolerance_schedule(
+        lengths, targets_lengths, schedules, minmin_seqs
+    )
+
+
+def batch_search_databases(
+    databases_path,
+    sub_database_path,
+    antibody_list,
+    sub_length_max=None,
+    chain_type="H",
+):
+    """
+    Run batch_search on every replacement database for the given chains.
+    Return {chain name: {database name: matched rows}}.
+    """
+    result = {antibody.name: {} for antibody in antibody_list}
+    if len(antibody_list) == 0:
+        return result
+
+    for database_name, database_path in sub_database_path.items():
+        length_database = database_registry.get_length_database(os.path.join(databases_path, database_path))
+        rows_list = batch_search(
+            antibody_list, length_database.lengths, sub_length_max=sub_length_max, chain_type=chain_type
+        )
+        for antibody, rows in zip(antibody_list, rows_list):
+            result[antibody.name][database_name] = rows
+
+    return result
+
+
+def get_msa_by_regions_length_substitution(
+    antibody,
+    tmp_dir,
+    tolerance=[0],  # Tolerance for the sequence lengths of various regions
+    chain_type="H",   # The type of the chain
+    database="uniref90",  # Database type
+    minmin_seqs=1000,  # Minimum number of sequences (requires 1000 for osa pair)
+    maxmin_seqs=10000,  # Maximum number of sequences (requires 50000 for osa pair)
+    database_index=0,  # Index of the database being used
+    sub_length_max=None,  # Maximum length in the replacement database
+    heavy_database_sub_list=None,  # Replacement heavy chain length databases
+    light_database_sub_list=None,  # Replacement light chain length databases
+    length_index=None,  # Region length index of the replacement database
+    target_rows=None,  # Matched rows precomputed by batch_search
+):
+    assert chain_type in ["H", "L"]
+    name = antibody.name
+    seq = antibody.seq
+
+    output_path = os.path.join(tmp_dir, "{}_{}_msa.fas".format(database, name))
+
+    regioned_seq = seq.replace("-", "")
+    seq_without_region = regioned_seq.replace("*", "")
+    target_lengths, schedule = get_query_schedule(
+        antibody, tolerance, sub_length_max=sub_length_max
+    )
+
     if chain_type == "H":
-        target_lengths_df = np.tile(target_lengths, (heavy_seqs_sub_list[database_index].shape[0], 1))
+        length_database = heavy_database_sub_list[database_index]
     else:
-        target_lengths_df = np.tile(target_lengths, (light_seqs_sub_list[database_index].shape[0], 1))
-        
-    target_df = pd.DataFrame(target_lengths_df, columns=regions)
-    
-    while len(target_names) < minmin_seqs and cycle < 50:
-        if chain_type == "H":
-            target_seqs = find_sequences(
-                seqs_df=heavy_seqs_sub_list[database_index],
-                length_df=heavy_lengths_sub_list[database_index],
-                target_df=target_df,
-                tolerance=tolerance,
-            )
-        else:
-            target_seqs = find_sequences(
-                seqs_df=light_seqs_sub_list[database_index],
-                length_df=light_lengths_sub_list[database_index],
-                target_df=target_df,
-                tolerance=tolerance,
-            )
+        length_database = light_database_sub_list[database_index]
+
+    if target_rows is None:
+        # Replay the tolerance-widening schedule in a single pass over the database.
+        target_rows = find_rows_by_tolerance_schedule(
+            length_database.lengths,
+            target_lengths,
+            schedule,
+            minmin_seqs,
+            index=length_index,
+        )
+    target_rows = np.asarray(target_rows, dtype=np.int64)
 
-        target_seqs = target_seqs.to_numpy().tolist()
-        if len(target_seqs) >= minmin_seqs or cycle == 49:
-            if len(target_seqs) > maxmin_seqs:
-                target_seqs = [
-                    seq
-                    for seq in target_seqs
-                    if len(regioned_seq.split("*")[5]) == len(seq[5])
-                    and hamming_distance(regioned_seq.split("*")[5], seq[5])
-                    <= int(target_lengths[5] * 0.8 * 2)
-                ]
-            target_seqs = target_seqs[:maxmin_seqs]
-            target_seqs = ["".join(seq) for seq in target_seqs]
-            target_seqs = [seq_without_region] + target_seqs
-            target_names = [">seq_{}".format(i) for i in range(len(target_seqs))]
-            write_fasta_file(target_names, target_seqs, output_path)
-            break
-        else:
-            if sum(upper_count_list) > 0:
-                for i, count in enumerate(upper_count_list):
-                    if count > 0:
-                        tolerance[i] = tolerance[i] + 1
-                        upper_count_list[i] = count - 1
-                        break
-            else:
-                tolerance[cycle % 7] = tolerance[cycle % 7] + 1
-            cycle += 1
+    if len(target_rows) > maxmin_seqs:
+        # Filter by the CDR3 distance before gathering the full sequences.
+        distances = batch_hamming(
+            regioned_seq.split("*")[5], length_database.get_region_seqs(target_rows, 5)
+        )
+        target_rows = target_rows[distances <= int(target_lengths[5] * 0.8 * 2)]
+    target_seqs = length_database.get_seqs(target_rows)
+    target_seqs = target_seqs[:maxmin_seqs]
+    target_seqs = ["".join(seq) for seq in target_seqs]
+    target_seqs = [seq_without_region] + target_seqs
+    target_names = [">seq_{}".format(i) for i in range(len(target_seqs))]
+    write_fasta_file(target_names, target_seqs, output_path)
 
     return output_path
 
@@ -151,6 +202,8 @@ def search_msas_by_substitution(
     use_precomputed_msas,
     sub_length_max,
     chain_type="H",
+    target_rows=None,
+    msa_cache=None,
 ):
 
     if antibody is None:
@@ -187,46 +240,61 @@ def search_msas_by_substitution(
             result_list.append(result_dict)
             continue
 
-        seqs_sub_list = []
-        lengths_sub_list = []
         database_full_path = os.path.join(databases_path, database_path)
-        seqs, lengths = read_data_from_pickle(database_full_path)
-        seqs_sub_list.append(seqs)
-        lengths_sub_list.append(lengths)
+        cache_key = None
+        if msa_cache is not None:
+            cache_key = msa_cache.get_key(
+                "substitution", antibody.seq, chain_type, database_name,
+                HEAVY_TOLERANCE if chain_type == "H" else LIGHT_TOLERANCE,
+                sub_length_max, get_database_fingerprint(database_full_path),
+            )
+            if msa_cache.fetch(cache_key, [out_msa_path]):
+                result_list.append(result_dict)
+                continue
+
+        length_database = database_registry.get_length_database(database_full_path)
+        database_sub_list = [length_database]
+        database_rows = None if target_rows is None else target_rows.get(database_name)
+        length_index = None
+        if database_rows is None:
+            length_index = database_registry.get_length_index(database_full_path)
 
         if chain_type == "H":
             tmp_fasta_name = get_msa_by_regions_length_substitution(
                 antibody=antibody,
                 tmp_dir=tmp_dir,
-                tolerance=[10, 0, 0, 0, 0, 0, 5],
+                tolerance=HEAVY_TOLERANCE,
                 chain_type=chain_type,
                 database="uniref90",
-                database_index=index,
+                database_index=0,
                 sub_length_max=sub_length_max,
-                heavy_lengths_sub_list=lengths_sub_list,
-                heavy_seqs_sub_list=seqs_sub_list,
+                heavy_database_sub_list=database_sub_list,
+                length_index=length_index,
+                target_rows=database_rows,
             )
         else:
             tmp_fasta_name = get_msa_by_regions_length_substitution(
                 antibody=antibody,
                 tmp_dir=tmp_dir,
-                tolerance=[10, 0, 10, 0, 10, 0, 10],
+                tolerance=LIGHT_TOLERANCE,
                 chain_type=chain_type,
                 database="uniref90",
-                database_index=index,
+                database_index=0,
                 sub_length_max=sub_length_max,
-                light_lengths_sub_list=lengths_sub_list,
-                light_seqs_sub_list=seqs_sub_list,
+                light_database_sub_list=database_sub_list,
+                length_index=length_index,
+                target_rows=database_rows,
             )
 
         result_dict["out_fasta_temp_path"] = tmp_fasta_name
         result_dict["out_msa_path"] = out_msa_path
+        result_dict["cache_key"] = cache_key
         result_list.append(result_dict)
 
     return result_list
 
 
-def build_msa(args, antibody, scheme, chain_type, database_path, sub_length_max):
+def build_msa(args, antibody, scheme, chain_type, database_path, sub_length_max, target_rows=None):
     fasta_dir = args.fasta_dir
     tmp_dir = args.temp_dir
     output_dir = args.output_dir
@@ -250,6 +318,8 @@ def build_msa(args, antibody, scheme, chain_type, database_path, sub_length_max)
         args.use_precomputed_msas,
         sub_length_max,
         chain_type=chain_type,
+        target_rows=target_rows,
+        msa_cache=get_msa_cache(args),
     )
     
     return result
@@ -257,25 +327,14 @@ def build_msa(args, antibody, scheme, chain_type, database_path, sub_length_max)
 
 def get_sub_max_length(databases_path, database_heavy, database_light):
     # Preload the sequences and lengths from the replacement database to avoid duplicate file reads.
-    global heavy_seqs_sub_list, heavy_lengths_sub_list, light_seqs_sub_list, light_lengths_sub_list
-    for _, database_path in database_heavy.items():
-        database_path = os.path.join(databases_path, database_path)
-        heavy_seqs, heavy_lengths = read_data_from_pickle(database_path)
-        heavy_seqs_sub_list.append(heavy_seqs)
-        heavy_lengths_sub_list.append(heavy_lengths)
-
-    for _, database_path in database_light.items():
-        database_path = os.path.join(databases_path, database_path)
-        light_seqs, light_lengths = read_data_from_pickle(database_path)
-        light_seqs_sub_list.append(light_seqs)
-        light_lengths_sub_list.append(light_lengths)
-
-    sub_length_heavy_max = (
-        heavy_lengths_sub_list[0].max(axis=0).tolist()
-    )
-    sub_length_light_max = (
-        light_lengths_sub_list[0].max(axis=0).tolist()
-    )
+    # The databases and their indexes are loaded once per process by the registry.
+    heavy_paths = [os.path.join(databases_path, path) for path in database_heavy.values()]
+    light_paths = [os.path.join(databases_path, path) for path in database_light.values()]
+    for database_path in heavy_paths + light_paths:
+        database_registry.get_length_index(database_path)
+
+    sub_length_heavy_max = database_registry.get_max_lengths(heavy_paths[0])
+    sub_length_light_max = database_registry.get_max_lengths(light_paths[0])
 
     return sub_length_heavy_max, sub_length_light_max
 
@@ -304,24 +363,8 @@ def getmsa(args, antibody_list):
     if not os.path.exists(out_alignments_dir):
         os.makedirs(out_alignments_dir, exist_ok=True)
 
-    global heavy_seqs_sub_list, heavy_lengths_sub_list, light_seqs_sub_list, light_lengths_sub_list
-    for _, database_path in heavy_length_databases.items():
-        database_path = os.path.join(databases_path, database_path)
-        heavy_seqs, heavy_lengths = read_data_from_pickle(database_path)
-        heavy_seqs_sub_list.append(heavy_seqs)
-        heavy_lengths_sub_list.append(heavy_lengths)
-
-    for _, database_path in light_length_databases.items():
-        database_path = os.path.join(databases_path, database_path)
-        light_seqs, light_lengths = read_data_from_pickle(database_path)
-        light_seqs_sub_list.append(light_seqs)
-        light_lengths_sub_list.append(light_lengths)
-
-    sub_length_heavy_max = (
-        heavy_lengths_sub_list[0].max(axis=0).tolist()
-    )
-    sub_length_light_max = (
-        light_lengths_sub_list[0].max(axis=0).tolist()
+    sub_length_heavy_max, sub_length_light_max = get_sub_max_length(
+        databases_path, heavy_length_databases, light_length_databases
     )
 
 
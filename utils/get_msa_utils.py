@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 from utils.database import regions, regions_fv
 from utils.fasta import read_fasta_file,  save_data_to_pickle
@@ -33,6 +34,165 @@ def find_sequences(
     return matched_sequences
 
 
+def get_tolerance_schedule(tolerance, upper_count_list, max_cycle=100):
+    """
+    Tolerances checked by each cycle of the tolerance-widening search, shape (max_cycle, R).
+    Regions exceeding the database maximum length are widened first,
+    then the regions are widened one at a time in turn.
+    args:
+        tolerance: starting tolerance of each region.
+        upper_count_list: number of extra widening steps for each region exceeding the database maximum length.
+        max_cycle: maximum number of search cycles.
+    """
+    tolerance = list(tolerance)
+    upper_count_list = list(upper_count_list)
+    schedule = []
+    for cycle in range(max_cycle):
+        schedule.append(list(tolerance))
+        if sum(upper_count_list) > 0:
+            for i, count in enumerate(upper_count_list):
+                if count > 0:
+                    tolerance[i] = tolerance[i] + 1
+                    upper_count_list[i] = count - 1
+                    break
+        else:
+            tolerance[cycle % len(tolerance)] = tolerance[cycle % len(tolerance)] + 1
+
+    return np.array(schedule)
+
+
+def find_rows_by_tolerance_schedule(
+    lengths,
+    target_lengths,
+    schedule,
+    minmin_seqs,
+    index=None,
+):
+    """
+    Find the database rows returned by the first cycle of the tolerance schedule
+    that matches at least minmin_seqs rows, or by the last cycle if none does.
+    The cycle at which each row starts to match is computed once,
+    so the whole schedule costs a single pass over the database.
+    args:
+        lengths: (N, R) region lengths of the database.
+        target_lengths: region lengths of the query.
+        schedule: (K, R) tolerances of each cycle, see get_tolerance_schedule.
+        minmin_seqs: minimum number of sequences.
+        index: optional RegionLengthIndex of the database, used to skip rows outside the last tolerance.
+    return:
+        Sorted row indices of the matched sequences.
+    """
+    schedule = np.asarray(schedule)
+    lengths = np.asarray(lengths)
+    if index is not None:
+        candidate_rows = index.query(target_lengths, schedule[-1])
+        lengths = lengths[candidate_rows]
+    else:
+        candidate_rows = np.arange(lengths.shape[0])
+
+    diff = np.abs(lengths - np.asarray(target_lengths))
+    # First cycle at which each region of each row is within tolerance, max_cycle if never.
+    row_cycle = np.zeros(diff.shape[0], dtype=np.int64)
+    for i in range(diff.shape[1]):
+        np.maximum(
+            row_cycle,
+            np.searchsorted(schedule[:, i], diff[:, i], side="left"),
+            out=row_cycle,
+        )
+
+    max_cycle = schedule.shape[0]
+    matched_counts = np.cumsum(np.bincount(row_cycle, minlength=max_cycle + 1))[:max_cycle]
+    enough = np.flatnonzero(matched_counts >= minmin_seqs)
+    stop_cycle = enough[0] if enough.size > 0 else max_cycle - 1
+
+    return candidate_rows[row_cycle <= stop_cycle]
+
+
+def batch_find_rows_by_tolerance_schedule(
+    lengths,
+    targets_lengths,
+    schedules,
+    minmin_seqs,
+    block_bytes=1 << 22,
+):
+    """
+    Batched version of find_rows_by_tolerance_schedule for Q queries.
+    The database is streamed once in blocks of rows, each block is compared
+    against all queries with NumPy broadcasting.
+    args:
+        lengths: (N, R) region lengths of the database.
+        targets_lengths: (Q, R) region lengths of the queries.
+        schedules: (Q, K, R) tolerance schedules of the queries.
+        minmin_seqs: minimum number of sequences, int or one per query.
+        block_bytes: approximate size of the (Q, block, R) working array of each block.
+    return:
+        List of Q arrays with the sorted row indices matched by each query.
+    """
+    lengths = np.asarray(lengths)
+    targets = np.asarray(targets_lengths, dtype=np.int32)
+    schedules = np.asarray(schedules)
+    n_queries, max_cycle, n_regions = schedules.shape
+    if n_queries == 0:
+        return []
+    minmin_seqs = np.broadcast_to(np.asarray(minmin_seqs), (n_queries,))
+
+    # Lookup table of the first cycle at which a region difference d is within tolerance,
+    # max_cycle if never. Differences larger than every tolerance share the last entry.
+    max_diff = int(schedules.max()) + 1
+    diffs = np.arange(max_diff + 1)
+    first_cycle = np.empty((n_queries, n_regions, max_diff + 1), dtype=np.int32)
+    for q in range(n_queries):
+        for i in range(n_regions):
+            first_cycle[q, i] = np.searchsorted(schedules[q, :, i], diffs, side="left")
+    first_cycle = first_cycle.reshape(-1)
+    table_offset = (
+        np.arange(n_queries)[:, None] * n_regions + np.arange(n_regions)[None, :]
+    ) * (max_diff + 1)
+
+    # The stopping cycle of a query can only decrease as more rows are seen,
+    # so rows above the current stopping cycle are dropped right away.
+    stop_cycle = np.full(n_queries, max_cycle - 1)
+    cycle_counts = np.zeros((n_queries, max_cycle + 1), dtype=np.int64)
+    hit_queries, hit_rows, hit_cycles = [], [], []
+
+    block_size = max(1, block_bytes // (4 * n_queries * n_regions))
+    for start in range(0, lengths.shape[0], block_size):
+        block = lengths[start : start + block_size].astype(np.int32)
+        diff = np.minimum(np.abs(block[None, :, :] - targets[:, None, :]), max_diff)
+        row_cycle = first_cycle[table_offset[:, None, :] + diff].max(axis=2)
+
+        query_idx, row_idx = np.nonzero(row_cycle <= stop_cycle[:, None])
+        if query_idx.size == 0:
+            continue
+        cycles = row_cycle[query_idx, row_idx]
+        hit_queries.append(query_idx)
+        hit_rows.append(row_idx + start)
+        hit_cycles.append(cycles)
+
+        cycle_counts += np.bincount(
+            query_idx * (max_cycle + 1) + cycles,
+            minlength=n_queries * (max_cycle + 1),
+        ).reshape(n_queries, max_cycle + 1)
+        enough = np.cumsum(cycle_counts[:, :max_cycle], axis=1) >= minmin_seqs[:, None]
+        stop_cycle = np.where(enough.any(axis=1), enough.argmax(axis=1), max_cycle - 1)
+
+    if not hit_queries:
+        return [np.empty(0, dtype=np.int64) for _ in range(n_queries)]
+
+    hit_queries = np.concatenate(hit_queries)
+    hit_rows = np.concatenate(hit_rows)
+    hit_cycles = np.concatenate(hit_cycles)
+    keep = hit_cycles <= stop_cycle[hit_queries]
+    hit_queries = hit_queries[keep]
+    hit_rows = hit_rows[keep]
+
+    # Blocks are visited in order, so a stable sort keeps the rows of each query sorted.
+    order = np.argsort(hit_queries, kind="stable")
+    split_idx = np.cumsum(np.bincount(hit_queries, minlength=n_queries))[:-1]
+
+    return np.split(hit_rows[order], split_idx)
+
+
 def hamming_distance(s1, s2):
     """Calculate the Hamming distance between two strings"""
     if len(s1) != len(s2):
@@ -44,6 +204,50 @@ def hamming_distance(s1, s2):
     return distance
 
 
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int32)
+
+
+def batch_hamming(query, candidates, mode="bit", lengths=None):
+    """
+    Hamming distances between query and every candidate.
+    Candidates whose length differs from the query get the maximum int32 value,
+    so they never pass a distance cutoff.
+    args:
+        query: query string.
+        candidates: list of strings, or (N, W) uint8 matrix of zero-padded strings.
+        mode: "bit" counts the differing bits of each character pair, same as hamming_distance,
+            "mismatch" counts the differing characters.
+        lengths: (N,) string lengths of a candidate matrix, all W if None.
+    """
+    query = np.frombuffer(query.encode("ascii"), dtype=np.uint8)
+    query_length = query.shape[0]
+
+    if isinstance(candidates, np.ndarray):
+        n_candidates, width = candidates.shape
+        if lengths is None:
+            lengths = np.full(n_candidates, width)
+        rows = np.flatnonzero(np.asarray(lengths) == query_length)
+        if query_length > width:
+            rows = rows[:0]
+        matrix = candidates[rows, :query_length]
+    else:
+        n_candidates = len(candidates)
+        lengths = np.fromiter(map(len, candidates), dtype=np.int64, count=n_candidates)
+        rows = np.flatnonzero(lengths == query_length)
+        matrix = np.frombuffer(
+            "".join([candidates[i] for i in rows]).encode("ascii"), dtype=np.uint8
+        ).reshape(rows.shape[0], query_length)
+
+    distances = np.full(n_candidates, np.iinfo(np.int32).max, dtype=np.int32)
+    if mode == "bit":
+        distances[rows] = POPCOUNT[matrix ^ query].sum(axis=1)
+    elif mode == "mismatch":
+        distances[rows] = (matrix != query).sum(axis=1)
+    else:
+        raise ValueError("Unknown Hamming distance mode: {}".format(mode))
+    return distances
+
+
 def split_list(list_, n):
     """将列表分割为n个子列表"""    
     n = min(n, len(list_))
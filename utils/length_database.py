@@ -0,0 +1,151 @@
+import os
+import json
+import numpy as np
+from utils.fasta import read_data_from_pickle
+
+COLUMNAR_SUFFIX = ".columnar"
+
+
+class LengthDatabase:
+    """
+    Region sequences and region lengths of a length database.
+
+    The data is either held in memory (from the pickled DataFrames) or opened
+    with np.memmap from the columnar format written by convert_to_columnar,
+    in which case every process reading the database shares the page cache.
+    """
+
+    def __init__(self, lengths, columns, seqs=None, seq_blob=None, seq_offsets=None):
+        self.lengths = lengths  # (N, R) region lengths
+        self.columns = list(columns)  # Region names
+        self._seqs = seqs  # (N, R) object array of region sequences, in-memory format
+        self._seq_blob = seq_blob  # uint8 concatenation of all region sequences, columnar format
+        self._seq_offsets = seq_offsets  # (N * R + 1,) start of each region in seq_blob
+
+    @classmethod
+    def from_dataframes(cls, seqs_df, lengths_df):
+        return cls(
+            lengths_df.to_numpy(),
+            lengths_df.columns,
+            seqs=seqs_df.to_numpy(),
+        )
+
+    @classmethod
+    def from_columnar(cls, columnar_dir):
+        with open(os.path.join(columnar_dir, "meta.json"), "r") as f:
+            meta = json.load(f)
+        lengths = np.load(os.path.join(columnar_dir, "lengths.npy"), mmap_mode="r")
+        seq_offsets = np.load(os.path.join(columnar_dir, "offsets.npy"), mmap_mode="r")
+        blob_path = os.path.join(columnar_dir, "seqs.bin")
+        if os.path.getsize(blob_path) > 0:
+            seq_blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            seq_blob = np.zeros(0, dtype=np.uint8)
+        return cls(lengths, meta["columns"], seq_blob=seq_blob, seq_offsets=seq_offsets)
+
+    @property
+    def n_rows(self):
+        return self.lengths.shape[0]
+
+    def get_seqs(self, rows):
+        """
+        Return the region sequences of the given rows as a list of lists of strings.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if self._seqs is not None:
+            return self._seqs[rows].tolist()
+
+        n_regions = len(self.columns)
+        result = []
+        for row in rows:
+            offsets = self._seq_offsets[row * n_regions : (row + 1) * n_regions + 1]
+            row_seq = self._seq_blob[offsets[0] : offsets[-1]].tobytes().decode("ascii")
+            offsets = offsets - offsets[0]
+            result.append(
+                [row_seq[offsets[i] : offsets[i + 1]] for i in range(n_regions)]
+            )
+        return result
+
+    def get_region_seqs(self, rows, region):
+        """
+        Return the sequences of one region (column index) of the given rows as a list of strings.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if self._seqs is not None:
+            return self._seqs[rows, region].tolist()
+
+        positions = rows * len(self.columns) + region
+        starts = np.asarray(self._seq_offsets[positions]).tolist()
+        ends = np.asarray(self._seq_offsets[positions + 1]).tolist()
+        return [self._seq_blob[s:e].tobytes().decode("ascii") for s, e in zip(starts, ends)]
+
+    def max_lengths(self):
+        """Maximum length of each region."""
+        return np.asarray(self.lengths).max(axis=0).tolist()
+
+    def quantile_lengths(self, q):
+        """Upper q-quantile of the length of each region."""
+        return np.quantile(np.asarray(self.lengths), q, axis=0).tolist()
+
+
+def get_columnar_dir(database_path):
+    """Directory of the columnar copy stored next to the pickled database."""
+    return os.path.splitext(database_path)[0] + COLUMNAR_SUFFIX
+
+
+def convert_to_columnar(database_path, columnar_dir=None):
+    """
+    Convert a pickled (seqs_df, lengths_df) length database to the columnar format:
+        lengths.npy: (N, R) int8/int16 region lengths.
+        seqs.bin: all region sequences concatenated row by row.
+        offsets.npy: (N * R + 1,) int64 start of each region sequence in seqs.bin.
+        meta.json: region names.
+    """
+    if columnar_dir is None:
+        columnar_dir = get_columnar_dir(database_path)
+    seqs_df, lengths_df = read_data_from_pickle(database_path)
+
+    lengths = lengths_df.to_numpy()
+    dtype = np.int8 if lengths.size == 0 or lengths.max() <= np.iinfo(np.int8).max else np.int16
+
+    seqs = seqs_df.to_numpy().reshape(-1)
+    seq_bytes = [seq.encode("ascii") for seq in seqs]
+    offsets = np.zeros(len(seq_bytes) + 1, dtype=np.int64)
+    np.cumsum([len(seq) for seq in seq_bytes], out=offsets[1:])
+
+    # Write to a temporary directory first so readers never see a partial database.
+    tmp_dir = "{}.{}.tmp".format(columnar_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    np.save(os.path.join(tmp_dir, "lengths.npy"), np.ascontiguousarray(lengths, dtype=dtype))
+    np.save(os.path.join(tmp_dir, "offsets.npy"), offsets)
+    with open(os.path.join(tmp_dir, "seqs.bin"), "wb") as f:
+        f.write(b"".join(seq_bytes))
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump({"columns": [str(c) for c in lengths_df.columns]}, f, indent=4)
+
+    if os.path.exists(columnar_dir):
+        old_dir = "{}.{}.old".format(columnar_dir, os.getpid())
+        os.rename(columnar_dir, old_dir)
+        os.rename(tmp_dir, columnar_dir)
+        for file in os.listdir(old_dir):
+            os.remove(os.path.join(old_dir, file))
+        os.rmdir(old_dir)
+    else:
+        os.rename(tmp_dir, columnar_dir)
+
+    return columnar_dir
+
+
+def load_length_database(database_path):
+    """
+    Load a length database, preferring its columnar copy when it is up to date.
+    """
+    columnar_dir = get_columnar_dir(database_path)
+    if os.path.exists(os.path.join(columnar_dir, "meta.json")) and (
+        not os.path.exists(database_path)
+        or os.path.getmtime(columnar_dir) >= os.path.getmtime(database_path)
+    ):
+        return LengthDatabase.from_columnar(columnar_dir)
+
+    seqs_df, lengths_df = read_data_from_pickle(database_path)
+    return LengthDatabase.from_dataframes(seqs_df, lengths_df)
@@ -0,0 +1,147 @@
+import os
+import numpy as np
+
+INDEX_SUFFIX = ".length_index.npz"
+
+_index_cache = {}  # Loaded indexes keyed by database path, avoiding duplicate file reads.
+
+
+class RegionLengthIndex:
+    """
+    Bucket index over the per-region lengths of a length database.
+
+    Rows that share the same region-length vector are stored in one bucket.
+    Buckets are sorted by the length of the most selective region, so a
+    tolerance query only visits the buckets inside that region's window and
+    then gathers the rows of every matching bucket.
+    """
+
+    def __init__(self, keys, offsets, rows, primary):
+        self.keys = keys  # (U, R) unique region-length vectors, sorted by the primary region
+        self.offsets = offsets  # (U + 1,) start of each bucket in rows
+        self.rows = rows  # (N,) database row ids grouped by bucket
+        self.primary = int(primary)  # Region used to sort the buckets
+
+    @property
+    def n_rows(self):
+        return self.rows.shape[0]
+
+    @classmethod
+    def build(cls, lengths):
+        """
+        Build the index from a (N, R) region-length matrix or DataFrame.
+        """
+        lengths = np.asarray(lengths, dtype=np.int16)
+        keys, inverse, counts = np.unique(
+            lengths, axis=0, return_inverse=True, return_counts=True
+        )
+        inverse = inverse.reshape(-1)
+
+        # Sort the buckets by the region with the most distinct lengths.
+        primary = int(np.argmax([len(np.unique(keys[:, i])) for i in range(keys.shape[1])]))
+        order = np.argsort(keys[:, primary], kind="stable")
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.shape[0])
+
+        keys = keys[order]
+        counts = counts[order]
+        rows = np.argsort(rank[inverse], kind="stable")
+        offsets = np.zeros(keys.shape[0] + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        return cls(keys, offsets, rows.astype(np.int64), primary)
+
+    def query(self, target_lengths, tolerance=0):
+        """
+        Return the sorted database rows whose every region length is within
+        tolerance of target_lengths.
+        args:
+            target_lengths: list of R region lengths of the query.
+            tolerance: int or list of R per-region tolerances.
+        """
+        target = np.asarray(target_lengths, dtype=np.int32)
+        tolerance = np.broadcast_to(np.asarray(tolerance, dtype=np.int32), target.shape)
+
+        primary_keys = self.keys[:, self.primary]
+        lo = np.searchsorted(
+            primary_keys, target[self.primary] - tolerance[self.primary], side="left"
+        )
+        hi = np.searchsorted(
+            primary_keys, target[self.primary] + tolerance[self.primary], side="right"
+        )
+        if lo >= hi:
+            return np.empty(0, dtype=np.int64)
+
+        window = self.keys[lo:hi].astype(np.int32)
+        matched = np.flatnonzero((np.abs(window - target) <= tolerance).all(axis=1)) + lo
+        if matched.size == 0:
+            return np.empty(0, dtype=np.int64)
+
+        starts = self.offsets[matched]
+        counts = self.offsets[matched + 1] - starts
+        shift = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        rows = self.rows[shift + np.arange(shift.shape[0])]
+        rows.sort()
+
+        return rows
+
+    def count(self, target_lengths, tolerance=0):
+        """Return the number of rows a query with this tolerance would match."""
+        return self.query(target_lengths, tolerance).shape[0]
+
+    def save(self, path):
+        # Write to a temporary file first so concurrent readers never see a partial index.
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                keys=self.keys,
+                offsets=self.offsets,
+                rows=self.rows,
+                primary=np.array(self.primary),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["keys"], data["offsets"], data["rows"], data["primary"])
+
+
+def get_index_path(database_path):
+    """Path of the index stored next to the length database."""
+    return os.path.splitext(database_path)[0] + INDEX_SUFFIX
+
+
+def load_or_build_index(database_path, lengths=None):
+    """
+    Load the region-length index stored next to database_path, building and
+    saving it first if it is missing or older than the database.
+    args:
+        database_path: path of the pickled length database.
+        lengths: region-length matrix of the database, only needed when the index has to be built.
+    """
+    if database_path in _index_cache:
+        return _index_cache[database_path]
+
+    index_path = get_index_path(database_path)
+    index = None
+    if os.path.exists(index_path) and (
+        not os.path.exists(database_path)
+        or os.path.getmtime(index_path) >= os.path.getmtime(database_path)
+    ):
+        index = RegionLengthIndex.load(index_path)
+        if lengths is not None and index.n_rows != len(lengths):
+            index = None
+
+    if index is None:
+        if lengths is None:
+            raise ValueError("No index found for {}, lengths are required to build it.".format(database_path))
+        index = RegionLengthIndex.build(lengths)
+        try:
+            index.save(index_path)
+        except OSError as e:
+            print("Save region length index failed: {}".format(e))
+
+    _index_cache[database_path] = index
+    return index
@@ -0,0 +1,214 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+from utils.database import database_registry
+
+
+RUN_CACHE_DIRNAME = "msa_cache"  # Cache directory in the temp dir when --msa_cache_dir is not set
+RUN_TEMPLATE_CACHE_DIRNAME = "template_cache"  # Cache directory in the temp dir when --template_cache_dir is not set
+EVICT_LOW_WATER = 0.9  # An eviction shrinks the cache to this fraction of max_size
+
+
+class MsaCache:
+    """
+    Content-addressed cache of the finished, realigned a3m files.
+
+    Each entry is a directory named by the hash of everything the MSA depends on
+    (chain sequences, database fingerprints and builder parameters), holding the
+    a3m files in output order. Entries are copied in and out rather than hardlinked,
+    because the MSA post-processing rewrites the a3m files in place. The least
+    recently used entries are evicted once the cache exceeds max_size bytes.
+    The size of the cache is tracked in memory, seeded by one scan of the cache directory;
+    the directory is only scanned again when the tracked size exceeds max_size, since
+    other processes may have stored or evicted entries in the meantime.
+    The same layout stores the template hits of hmmsearch, with suffix ".sto".
+    """
+
+    def __init__(self, cache_dir, max_size, suffix=".a3m"):
+        self.cache_dir = cache_dir
+        self.max_size = max_size  # Maximum size of the cache in bytes
+        self.suffix = suffix  # Suffix of the cached files
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._total_size = 0  # Tracked size of the cache in bytes, only used when it is bounded
+        if self.max_size != float("inf"):
+            self._total_size = sum(size for _, size, _ in self.scan())
+
+    def get_key(self, *items):
+        """Hash of the given builder inputs, items must be JSON serializable."""
+        data = json.dumps(items, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get_entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fetch(self, key, out_paths):
+        """
+        Copy the cached files of key to out_paths. Return False on a cache miss.
+        """
+        entry_dir = self.get_entry_dir(key)
+        cached_paths = [os.path.join(entry_dir, "{}{}".format(i, self.suffix)) for i in range(len(out_paths))]
+        if not all(os.path.exists(path) for path in cached_paths):
+            return False
+
+        try:
+            for cached_path, out_path in zip(cached_paths, out_paths):
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                # Copy next to out_path and rename, so readers never see a partial file.
+                tmp_path = "{}.{}.{}.tmp".format(out_path, os.getpid(), threading.get_ident())
+                shutil.copyfile(cached_path, tmp_path)
+                os.replace(tmp_path, out_path)
+            # The entry mtime records the last use, for the LRU eviction.
+            os.utime(entry_dir)
+        except OSError as e:
+            print("Fetch MSA cache failed: {}".format(e))
+            return False
+
+        return True
+
+    def store(self, key, paths):
+        """
+        Copy the finished files at paths into the cache under key.
+        """
+        entry_dir = self.get_entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+
+        # Write to a temporary directory first so readers never see a partial entry.
+        tmp_dir = "{}.{}.{}.tmp".format(entry_dir, os.getpid(), threading.get_ident())
+        entry_size = 0
+        try:
+            os.makedirs(tmp_dir, exist_ok=True)
+            for i, path in enumerate(paths):
+                shutil.copyfile(path, os.path.join(tmp_dir, "{}{}".format(i, self.suffix)))
+                entry_size += os.path.getsize(path)
+            os.rename(tmp_dir, entry_dir)
+        except OSError as e:
+            # Another process stored the same entry first, or the disk is full.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.exists(entry_dir):
+                print("Store MSA cache failed: {}".format(e))
+            return
+
+        if self.max_size != float("inf"):
+            with self._lock:
+                self._total_size += entry_size
+                over_size = self._total_size > self.max_size
+            if over_size:
+                self.evict()
+
+    def scan(self):
+        """
+        List the (last use, size, directory) of every entry of the cache.
+        """
+        entries = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, key)
+                if key.endswith(".tmp"):
+                    continue
+                try:
+                    size = sum(
+                        os.path.getsize(os.path.join(entry_dir, file))
+                        for file in os.listdir(entry_dir)
+                    )
+                    entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+                except OSError:
+                    continue
+
+        return entries
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in
+        EVICT_LOW_WATER of max_size, so that evictions stay infrequent.
+        """
+        with self._lock:
+            entries = self.scan()
+            total_size = sum(size for _, size, _ in entries)
+
+            entries.sort()
+            for _, size, entry_dir in entries:
+                if total_size <= self.max_size * EVICT_LOW_WATER:
+                    break
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total_size -= size
+
+            self._total_size = total_size
+
+
+def get_database_fingerprint(path):
+    """
+    Fingerprint of a database file or directory: its path, size and modification time.
+    """
+    def load_fingerprint():
+        if not os.path.exists(path):
+            return [path]
+        if os.path.isdir(path):
+            files = sorted(os.listdir(path))
+            return [
+                path,
+                [
+                    [file, os.path.getsize(os.path.join(path, file)), os.path.getmtime(os.path.join(path, file))]
+                    for file in files
+                ],
+            ]
+        return [path, os.path.getsize(path), os.path.getmtime(path)]
+
+    return database_registry.get("database_fingerprint", path, load_fingerprint)
+
+
+def get_msa_cache(args):
+    """
+    MsaCache configured by --msa_cache_dir and --msa_cache_size.
+    Without --msa_cache_dir, an unbounded cache in the temp dir of the run is used
+    when the run has more than one batch (args.run_msa_cache), so identical chains
+    of different batches are only built once per run. None otherwise.
+    """
+    cache_dir = getattr(args, "msa_cache_dir", None)
+    if cache_dir is None:
+        if not getattr(args, "run_msa_cache", False):
+            return None
+        cache_dir = os.path.join(args.temp_dir, RUN_CACHE_DIRNAME)
+        max_size = float("inf")
+    else:
+        max_size = int(getattr(args, "msa_cache_size", 50) * 1024 ** 3)
+    return database_registry.get(
+        "msa_cache", (cache_dir, max_size), lambda: MsaCache(cache_dir, max_size)
+    )
+
+
+def remove_run_msa_cache(args):
+    """Remove the cache in the temp dir of the run, see get_msa_cache."""
+    cache_dir = os.path.join(args.temp_dir, RUN_CACHE_DIRNAME)
+    if getattr(args, "msa_cache_dir", None) is None and os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def get_template_cache(args):
+    """
+    MsaCache of the hmmsearch template hits, configured by --template_cache_dir and
+    --template_cache_size. Without --template_cache_dir, an unbounded cache in the
+    temp dir of the run is used, like get_msa_cache.
+    """
+    cache_dir = getattr(args, "template_cache_dir", None)
+    if cache_dir is None:
+        cache_dir = os.path.join(args.temp_dir, RUN_TEMPLATE_CACHE_DIRNAME)
+        max_size = float("inf")
+    else:
+        max_size = int(getattr(args, "template_cache_size", 10) * 1024 ** 3)
+    return database_registry.get(
+        "template_cache", (cache_dir, max_size), lambda: MsaCache(cache_dir, max_size, suffix=".sto")
+    )
+
+
+def remove_run_template_cache(args):
+    """Remove the template cache in the temp dir of the run, see get_template_cache."""
+    cache_dir = os.path.join(args.temp_dir, RUN_TEMPLATE_CACHE_DIRNAME)
+    if getattr(args, "template_cache_dir", None) is None and os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir, ignore_errors=True)
@@ -0,0 +1,133 @@
+import os
+import numpy as np
+
+GAP = ord("-")
+
+
+def parse_records(text):
+    """
+    Split the text of a FASTA/a3m file into names and sequences.
+    Names keep their ">" like read_fasta_file, multi-line sequences are joined.
+    """
+    names = []
+    seqs = []
+    start = text.find(">")
+    if start < 0:
+        return names, seqs
+
+    for record in text[start + 1 :].split("\n>"):
+        name, _, seq = record.partition("\n")
+        names.append(">" + name.strip(" \r"))
+        seqs.append(seq.replace("\n", "").replace("\r", ""))
+
+    return names, seqs
+
+
+def encode_seqs(seqs):
+    """
+    Encode aligned sequences of the same length as a (N, L) uint8 matrix of ASCII codes.
+    """
+    if len(seqs) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    width = len(seqs[0])
+    if any(len(seq) != width for seq in seqs):
+        raise ValueError("The sequences of the MSA are not aligned.")
+    # bytearray keeps the matrix writable.
+    blob = np.frombuffer(bytearray("".join(seqs).encode("ascii")), dtype=np.uint8)
+    return blob.reshape(len(seqs), width)
+
+
+def decode_seqs(msa):
+    """Decode a (N, L) uint8 matrix back to a list of strings."""
+    msa = np.ascontiguousarray(msa, dtype=np.uint8)
+    width = msa.shape[1]
+    text = msa.tobytes().decode("ascii")
+    return [text[i : i + width] for i in range(0, len(text), width)] if width > 0 else [""] * msa.shape[0]
+
+
+def split_deletions(seqs):
+    """
+    Remove the lowercase (inserted) residues of a3m sequences and count them.
+    Return the blob of the remaining residues, the start of each sequence in it,
+    and the number of residues deleted before every remaining residue,
+    same counts as parsers.parse_a3m.
+    """
+    offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+    np.cumsum([len(seq) for seq in seqs], out=offsets[1:])
+    blob = np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8)
+
+    is_lower = (blob >= ord("a")) & (blob <= ord("z"))
+    lower_count = np.cumsum(is_lower, dtype=np.int64)
+    kept = np.flatnonzero(~is_lower)
+
+    # Start of each sequence in the kept residues.
+    kept_offsets = np.searchsorted(kept, offsets)
+
+    # Deletions before a kept residue: lowercase residues since the previous kept
+    # residue, or since the start of its sequence for the first one.
+    previous = np.empty(kept.shape[0], dtype=np.int64)
+    previous[1:] = lower_count[kept[:-1]]
+    first = kept_offsets[:-1][kept_offsets[:-1] < kept_offsets[1:]]
+    seq_starts = offsets[:-1][kept_offsets[:-1] < kept_offsets[1:]]
+    previous[first] = np.where(seq_starts > 0, lower_count[np.maximum(seq_starts - 1, 0)], 0)
+    deletions = (lower_count[kept] - previous).astype(np.int32)
+
+    return blob[kept], kept_offsets, deletions
+
+
+def parse_a3m_matrix(seqs):
+    """
+    Parse a3m sequences to a (N, L) uint8 matrix of the aligned residues and
+    a (N, L) int32 deletion-count matrix.
+    """
+    aligned, offsets, deletions = split_deletions(seqs)
+    widths = np.diff(offsets)
+    if widths.shape[0] > 0 and np.any(widths != widths[0]):
+        raise ValueError("The sequences of the MSA are not aligned.")
+    width = int(widths[0]) if widths.shape[0] > 0 else 0
+    return aligned.reshape(len(seqs), width), deletions.reshape(len(seqs), width)
+
+
+def read_records(msa_path):
+    """Read the names and sequences of a FASTA/a3m file as lists of strings."""
+    with open(msa_path, "r") as f:
+        return parse_records(f.read())
+
+
+def read_msa(msa_path):
+    """
+    Read a FASTA/a3m file of aligned sequences.
+    Return the names and the (N, L) uint8 matrix of the sequences.
+    """
+    names, seqs = read_records(msa_path)
+    return names, encode_seqs(seqs)
+
+
+def read_a3m(msa_path):
+    """
+    Read an a3m file.
+    Return the names, the (N, L) uint8 matrix of the aligned residues and the deletion-count matrix.
+    """
+    names, seqs = read_records(msa_path)
+    msa, deletions = parse_a3m_matrix(seqs)
+    return names, msa, deletions
+
+
+def write_msa(msa_path, names, msa, end="\n", atomic=False):
+    """
+    Write names and sequences (a uint8 matrix or a list of strings) with one buffered write.
+    With atomic, the file is written next to msa_path and renamed over it,
+    so readers never see a partial MSA.
+    """
+    if isinstance(msa, np.ndarray):
+        msa = decode_seqs(msa)
+    lines = []
+    for name, seq in zip(names, msa):
+        lines.append(name)
+        lines.append(seq)
+
+    out_path = "{}.{}.tmp".format(msa_path, os.getpid()) if atomic else msa_path
+    with open(out_path, "w") as f:
+        f.write("\n".join(lines) + (end if len(lines) > 0 else ""))
+    if atomic:
+        os.replace(out_path, msa_path)
@@ -1,9 +1,13 @@
 import os
 import json
 import shutil
+import zlib
 import numpy as np
 from utils.fasta import read_fasta_file, write_fasta_file
-from utils.get_antibody_region import REGION_NAME
+from utils.msa_codec import GAP, encode_seqs, decode_seqs, read_records, read_msa, write_msa
+from utils.get_antibody_region import REGION_NAME, get_region_dict, get_single_antibodies
+
+LINKER_SEED = 42  # Default seed of the linker shuffle in merge_msas and process_msas
 
 
 def mask_msa(
@@ -157,17 +161,14 @@ def get_msa(args):
                     antigen_idx += 1
 
 
-def region_padding(
-    region_file,
+def pad_region_dict(
+    region_dict,
     front_len,
     back_len,
 ):
     """
-    compute the padding length for the region file.
+    Shift the regions by front_len and set the FRONT and BACK padding regions.
     """
-    with open(region_file, "r") as f:
-        region_dict = json.load(f)
-    
     for region in REGION_NAME:
         region_dict[region][0] += front_len
         region_dict[region][1] += front_len
@@ -175,29 +176,45 @@ def region_padding(
     region_dict["FRONT"] = [0, front_len]
     region_dict["BACK"] = [region_dict["FR4"][1], back_len]
     region_dict["length"] = region_dict["BACK"][1]
+
+    return region_dict
+
+
+def write_region_dict(region_file, region_dict):
+    """Write the region file through a temporary file, so readers never see a partial file."""
+    tmp_file = "{}.{}.tmp".format(region_file, os.getpid())
+    with open(tmp_file, "w") as f:
+        json.dump(region_dict, f, indent=4)
+    os.replace(tmp_file, region_file)
+
+
+def region_padding(
+    region_file,
+    front_len,
+    back_len,
+):
+    """
+    compute the padding length for the region file.
+    """
+    with open(region_file, "r") as f:
+        region_dict = json.load(f)
+    
+    pad_region_dict(region_dict, front_len, back_len)
     
     with open(region_file, "w") as f:
         json.dump(region_dict, f, indent=4)
 
 
-def msa_padding(
-    msa_file,
+def pad_seqs(
+    seqs,
     padding_seq,
-    region_file=None,
 ):
     """
-    Padding the MSA file with the padding sequence.
-    args:
-    msa_file: str, the input MSA file path.
-    padding_seq: str, the padding sequence.
-    region_file: str, the input region file path.
+    Pad the aligned sequences with gaps to the length of the padding sequence.
+    Return the padded sequences (None if the padding sequence is not longer than the MSA)
+    and the start of the query in the padding sequence.
     """
     padding_seq = padding_seq.replace("-", "")
-    with open(msa_file, "r") as f:
-        lines = f.read().splitlines()
-        names = lines[::2]
-        seqs = lines[1::2]
-
     loc_start = padding_seq.find(seqs[0].replace("-", ""))
     if len(padding_seq) > len(seqs[0]):
         loc_end = loc_start + len(seqs[0])
@@ -209,13 +226,45 @@ def msa_padding(
         
         padded_seqs = [front_padding + seq + back_padding for seq in seqs]
         padded_seqs[0] = padding_seq
-        
-        with open(msa_file, "w") as f:
-            for name, seq in zip(names, padded_seqs):
-                f.write(name + "\n" + seq + "\n")
+        return padded_seqs, loc_start
+
+    return None, loc_start
+
+
+def msa_padding(
+    msa_file,
+    padding_seq,
+    region_file=None,
+):
+    """
+    Padding the MSA file with the padding sequence.
+    args:
+    msa_file: str, the input MSA file path.
+    padding_seq: str, the padding sequence.
+    region_file: str, the input region file path.
+    """
+    names, seqs = read_records(msa_file)
+    padded_seqs, loc_start = pad_seqs(seqs, padding_seq)
+    if padded_seqs is not None:
+        write_msa(msa_file, names, padded_seqs)
         
     if os.path.exists(region_file):
-        region_padding(region_file, loc_start, len(padding_seq))
+        region_padding(region_file, loc_start, len(padding_seq.replace("-", "")))
+
+
+def gap_fill(
+    msa,
+    region_dict,
+):
+    """
+    Replace the FRONT and BACK regions of all but the first row of a uint8 MSA with gaps.
+    """
+    tg_seq = msa[0].copy()
+    msa[:, region_dict["FRONT"][0]:region_dict["FRONT"][1]] = GAP
+    msa[:, region_dict["BACK"][0]:region_dict["BACK"][1]] = GAP
+    
+    msa[0] = tg_seq
+    return msa
 
 
 def msa_gap_padding(
@@ -229,24 +278,12 @@ def msa_gap_padding(
     padding_seq: str, the padding sequence.
     region_file: str, the input region file path.
     """
-    with open(msa_file, "r") as f:
-        lines = f.read().splitlines()
-        names = lines[::2]
-        seqs = lines[1::2]
-
-    seqs = np.array([list(seq) for seq in seqs], dtype=object)
+    names, seqs = read_msa(msa_file)
     
     with open(region_file, "r") as f:
         region_dict = json.load(f)
     
-    tg_seq = seqs[0].copy()
-    seqs[:, region_dict["FRONT"][0]:region_dict["FRONT"][1]] = "-"
-    seqs[:, region_dict["BACK"][0]:region_dict["BACK"][1]] = "-"
-    
-    seqs[0] = tg_seq
-    with open(msa_file, "w") as f:
-        for name, seq in zip(names, seqs):
-            f.write(name + "\n" + "".join(seq) + "\n")
+    write_msa(msa_file, names, gap_fill(seqs, region_dict))
 
 
 def padding_msas(
@@ -299,9 +336,139 @@ def filter_array(arr, cutoff=3):
     return np.array(result).astype(int)
 
 
-def merge_msas(args, antibody_list, alignment_dir):
+def read_chain_msas(chain_dir):
+    """
+    Read the a3m files of a chain directory as a list of [path, names, seqs], in listing order.
+    """
+    return [
+        [os.path.join(chain_dir, file)] + list(read_records(os.path.join(chain_dir, file)))
+        for file in os.listdir(chain_dir)
+        if file.endswith(".a3m")
+    ]
+
+
+def merge_inchain_msas(full_seq, domain_msas):
+    """
+    Merge the MSAs of the domains of one chain into MSAs of the full chain.
+    args:
+    full_seq: str, the full sequence of the chain.
+    domain_msas: list of the read_chain_msas result of every domain, in the order of the domains.
+    Return {file name: (names, seqs)} of the merged MSAs.
+    """
+    inner_paired_dict = {}
+    outter_paired_list = []
+    single_files_dict = {}
+    for msas in domain_msas:
+        for path, names, seqs in msas:
+            file = os.path.basename(path)
+            if file.startswith("inner"):
+                inner_paired_dict.setdefault(file, []).append((names, seqs))
+            elif file.startswith("paired"):
+                outter_paired_list.append((path, names, seqs))
+            else:
+                single_files_dict.setdefault(file, []).append((names, seqs))
+
+    merged = {}
+
+    # merge inner paired
+    for file, msa_list in inner_paired_dict.items():
+        if len(msa_list) == 2:
+            seqs_list = [seqs for _, seqs in msa_list]
+            
+            # get min count of seqs_list
+            min_count = min([len(seqs) for seqs in seqs_list])
+            seqs_list = [seqs[:min_count] for seqs in seqs_list]
+            
+            seq1_start = full_seq.find(seqs_list[0][0].replace("-", ""))
+            seq1_end = len(seqs_list[0][0].replace("-", "")) + seq1_start
+            seq2_start = full_seq.find(seqs_list[1][0].replace("-", ""))
+            linker = '-' * (seq2_start - seq1_end)
+            seq2_back = len(full_seq) - seq2_start - len(seqs_list[1][0].replace("-", ""))
+            
+            front_linker = '-' * seq1_start
+            back_linker = '-' * seq2_back
+            
+            connect_seq = [front_linker + seqs_list[0][i] + linker + seqs_list[1][i] + back_linker for i in range(min_count)]
+            connect_seq[0] = full_seq
+            
+            merged[file] = ([f">seq{i}" for i in range(len(connect_seq))], connect_seq)
+
+    # merge outter paired
+    if len(outter_paired_list) > 0:
+        out_names = [">Target"]
+        out_seqs = [full_seq]
+        for path, names, seqs in sorted(outter_paired_list, key=lambda msa: msa[0], reverse=True):
+            front_gap = full_seq.find(seqs[0].replace("-", ""))
+            back_gap = len(full_seq) - front_gap - len(seqs[0].replace("-", ""))
+            
+            out_names.extend(names[1:])
+            out_seqs.extend('-' * front_gap + seq + '-' * back_gap for seq in seqs[1:])
+        merged["paired_hits.a3m"] = (out_names, out_seqs)
+
+    # merge single files
+    for file, msa_list in single_files_dict.items():
+        out_names = [">Target"]
+        out_seqs = [full_seq]
+        for names, seqs in msa_list:
+            front_gap = full_seq.find(seqs[0].replace("-", ""))
+            back_gap = len(full_seq) - front_gap - len(seqs[0].replace("-", ""))
+            
+            out_names.extend(f">seq{i}" for i in range(1, len(seqs)))
+            out_seqs.extend('-' * front_gap + seq + '-' * back_gap for seq in seqs[1:])
+        merged[file] = (out_names, out_seqs)
+
+    return merged
+
+
+def get_linker_rng(seed, ori_name, file):
+    """
+    Random generator of the linker of one merged MSA. It only depends on the seed,
+    the chain and the file, so the linkers do not change with the batch composition.
+    """
+    return np.random.default_rng([seed, zlib.crc32("{}/{}".format(ori_name, file).encode("utf-8"))])
+
+
+def rebuild_linker(msa, file="", rng=None):
+    """
+    Fill the linker columns of a merged uint8 MSA, the runs of more than 3 columns
+    that are gaps in every row but the first, with shuffled residues of the first row.
+    args:
+    msa: np.ndarray, (N, L) uint8 MSA, modified in place.
+    file: str, the file name used in messages.
+    rng: np.random.Generator, shuffles the linker of every row.
+    """
+    # Identify columns (excluding the first row) that consist entirely of gaps.
+    gap_cols = np.all(msa[1:] == GAP, axis=0)
+    gap_cols = np.where(gap_cols)[0]
+    if gap_cols.size == 0:
+        return msa
+    
+    # Index of the last column among all non-gap columns.
+    non_gap_cols = np.where(np.any(msa[1:] != GAP, axis=0))[0]
+    if non_gap_cols.size == 0:
+        print(f"INFO: {file} has no non-gap column.")
+        return msa
+    last_col_idx = non_gap_cols[-1]
+    gap_cols = gap_cols[gap_cols < last_col_idx]
+    
+    # Exclude columns from gap_cols with a continuous length less than 3.
+    gap_cols = filter_array(gap_cols, cutoff=3)
+    
+    if rng is None:
+        rng = np.random.default_rng()
+
+    # Shuffle the linker of all rows at once, each row independently.
+    linker = msa[0, gap_cols]
+    linker_block = np.broadcast_to(linker, (msa.shape[0] - 1, linker.shape[0]))
+    msa[1:, gap_cols] = rng.permuted(linker_block, axis=1)
+
+    return msa
+
+
+def merge_msas(args, antibody_list, alignment_dir, seed=LINKER_SEED):
 
     # merge antibody
+    merged_dirs = []
     for ab in antibody_list:
         inner_paired_abs = ab.get_inchain_antibodies()
         for ori_name, inner_abs in inner_paired_abs.items():
@@ -313,137 +480,99 @@ def merge_msas(args, antibody_list, alignment_dir):
             if not os.path.exists(tmp_align_dir):
                 os.mkdir(tmp_align_dir)
             
-            inner_paired_dict = {}
-            outter_paired_list = []
-            single_files_dict = {}
-            for inner_ab in inner_abs:
-                for file in os.listdir(os.path.join(alignment_dir, inner_ab.name)):
-                    if file.endswith(".a3m"):
-                        if file.startswith("inner"):
-                            if file not in inner_paired_dict:
-                                inner_paired_dict[file] = []
-                            inner_paired_dict[file].append(os.path.join(alignment_dir, inner_ab.name, file))
-                        elif file.startswith("paired"):
-                            outter_paired_list.append(os.path.join(alignment_dir, inner_ab.name, file))
-                        else:
-                            if file not in single_files_dict:
-                                single_files_dict[file] = []
-                            single_files_dict[file].append(os.path.join(alignment_dir, inner_ab.name, file))
+            domain_msas = [read_chain_msas(os.path.join(alignment_dir, inner_ab.name)) for inner_ab in inner_abs]
+            merged = merge_inchain_msas(full_seq, domain_msas)
             
-            # merge inner paired
-            for file, file_list in inner_paired_dict.items():
-                if len(file_list) == 2:
-                    out_file = os.path.join(tmp_align_dir, file)
-                    seqs_list = []
-                    names_list = []
-                    for file in file_list:
-                        with open(file, "r") as f:
-                            lines = f.read().splitlines()
-                            names = lines[::2]
-                            seqs = lines[1::2]
-                            seqs_list.append(seqs)
-                            names_list.append(names)
-                    
-                    # get min count of seqs_list
-                    min_count = min([len(seqs) for seqs in seqs_list])
-                    seqs_list = [seqs[:min_count] for seqs in seqs_list]
-                    names_list = [names[:min_count] for names in names_list]
-                    
-                    seq1_start = full_seq.find(seqs_list[0][0].replace("-", ""))
-                    seq1_end = len(seqs_list[0][0].replace("-", "")) + seq1_start
-                    seq2_start = full_seq.find(seqs_list[1][0].replace("-", ""))
-                    linker = '-' * (seq2_start - seq1_end)
-                    seq2_back = len(full_seq) - seq2_start - len(seqs_list[1][0].replace("-", ""))
-                    
-                    front_linker = '-' * seq1_start
-                    back_linker = '-' * seq2_back
-                    
-                    connect_seq = [front_linker + seqs_list[0][i] + linker + seqs_list[1][i] + back_linker for i in range(min_count)]
-                    connect_seq[0] = full_seq
-                    
-                    with open(out_file, "w") as f:
-                        for i, seq in enumerate(connect_seq):       
-                            f.write(f">seq{i}\n{seq}\n")
-
-            # merge outter paired
             if os.path.exists(os.path.join(tmp_align_dir, "paired_hits.a3m")):
                 os.remove(os.path.join(tmp_align_dir, "paired_hits.a3m"))
-            
-            count = 0
-            for idx, file in enumerate(sorted(outter_paired_list, reverse=True)):
-                with open(os.path.join(tmp_align_dir, "paired_hits.a3m"), "a") as paired_f:
-                    if idx == 0:
-                        paired_f.write(f">Target\n{full_seq}\n")
-                    with open(file, "r") as f:
-                        lines = f.read().splitlines()
-                        names = lines[::2]
-                        seqs = lines[1::2]
-                        
-                        front_gap = full_seq.find(seqs[0].replace("-", ""))
-                        back_gap = len(full_seq) - front_gap - len(seqs[0].replace("-", ""))
-                        
-                        front_linker = '-' * front_gap
-                        back_linker = '-' * back_gap
-                        
-                        for i, seq in enumerate(seqs[1:], start=1):
-                            paired_f.write(f"{names[i]}\n{ front_linker + seq + back_linker}\n")
-                            
-            # merge single files
-            for file, file_list in single_files_dict.items():
-                with open(os.path.join(tmp_align_dir, file), "w") as f:
-                    f.write(f">Target\n{full_seq}\n")
-                    for file in file_list:
-                        with open(file, "r") as f2:
-                            lines = f2.read().splitlines()
-                            seqs = lines[1::2]
-                            names = lines[::2]
-                            
-                            front_gap = full_seq.find(seqs[0].replace("-", ""))
-                            back_gap = len(full_seq) - front_gap - len(seqs[0].replace("-", ""))
-                            
-                            for i, seq in enumerate(seqs[1:], start=1):
-                                f.write(f">seq{i}\n{ '-' * front_gap + seq + '-' * back_gap}\n")
+            for file, (names, seqs) in merged.items():
+                write_msa(os.path.join(tmp_align_dir, file), names, seqs)
+            merged_dirs.append((ori_name, tmp_align_dir))
                                 
     # rebuild linker
+    for ori_name, tmp_align_dir in merged_dirs:
+        for file in os.listdir(tmp_align_dir):
+            if file.endswith(".a3m"):
+                names, seqs = read_msa(os.path.join(tmp_align_dir, file))
+                rng = get_linker_rng(seed, ori_name, file)
+                write_msa(os.path.join(tmp_align_dir, file), names, rebuild_linker(seqs, file, rng))
+
+
+def get_input_seqs(fasta_dir):
+    """Map the name of every input sequence to its sequence."""
+    input_seqs = {}
+    for fasta in os.listdir(fasta_dir):
+        names, seqs = read_fasta_file(os.path.join(fasta_dir, fasta))
+        for name, seq in zip(names, seqs):
+            input_seqs.setdefault(name.lstrip(">"), seq)
+    return input_seqs
+
+
+def process_msas(args, antibody_list, alignment_dir, gap_padding=False, seed=LINKER_SEED):
+    """
+    Post-process the MSAs of a batch of antibodies in one pass:
+    compute the regions of every chain, pad (or gap-fill) its MSAs to the input sequence,
+    merge the MSAs of the domains of multi-domain chains and rebuild their linkers.
+    Every MSA is read once and every final file is written once, atomically.
+    Same as write_regions, padding_msas and merge_msas run in turn for the batch.
+    The linkers are shuffled with generators seeded by seed, see get_linker_rng.
+    """
+    input_seqs = get_input_seqs(args.fasta_dir)
+
+    chain_msas = {}
+    for ab in get_single_antibodies(antibody_list):
+        if ab.name in chain_msas:
+            continue
+
+        chain_dir = os.path.join(alignment_dir, ab.name)
+        os.makedirs(chain_dir, exist_ok=True)
+        region_dict = get_region_dict(ab)
+        msas = read_chain_msas(chain_dir)
+
+        # Only the chains named after an input sequence are padded, see padding_msas.
+        padding_seq = input_seqs.get(ab.name)
+        if padding_seq is not None and len(msas) > 0:
+            if gap_padding:
+                for msa in msas:
+                    msa[2] = decode_seqs(gap_fill(encode_seqs(msa[2]), region_dict))
+                    write_msa(msa[0], msa[1], msa[2], atomic=True)
+            else:
+                padding_seq = padding_seq.replace("-", "")
+                loc_start = None
+                for msa in msas:
+                    padded_seqs, msa_loc_start = pad_seqs(msa[2], padding_seq)
+                    if loc_start is None:
+                        loc_start = msa_loc_start
+                    if padded_seqs is not None:
+                        msa[2] = padded_seqs
+                        write_msa(msa[0], msa[1], msa[2], atomic=True)
+                # The regions are shifted once per chain, not once per MSA file.
+                pad_region_dict(region_dict, loc_start, len(padding_seq))
+
+        write_region_dict(os.path.join(chain_dir, "region_index.json"), region_dict)
+        chain_msas[ab.name] = msas
+
     for ab in antibody_list:
-        inner_paired_abs = ab.get_inchain_antibodies()
-        for ori_name, inner_abs in inner_paired_abs.items():
+        for ori_name, inner_abs in ab.get_inchain_antibodies().items():
             if len(inner_abs) == 1:
                 continue
-            
+
             tmp_align_dir = os.path.join(alignment_dir, ori_name)
-            
-            for file in os.listdir(tmp_align_dir):
-                if file.endswith(".a3m"):
-                    with open(os.path.join(tmp_align_dir, file), "r") as f:
-                        lines = f.read().splitlines()
-                        names = lines[::2]
-                        seqs = lines[1::2]
-
-                    # to array
-                    seqs = np.array([list(seq) for seq in seqs], dtype=object)
-                    
-                    # Identify columns (excluding the first row) that consist entirely of gaps.
-                    gap_cols = np.all(seqs[1:] == '-', axis=0)
-                    gap_cols = np.where(gap_cols)[0]
-                    if gap_cols.size == 0:
-                        continue
-                    
-                    # Index of the last column among all non-gap columns.
-                    try:
-                        last_col_idx = np.where(np.any(seqs[1:] != '-', axis=0))[0][-1]
-                    except IndexError:
-                        print(f"INFO: {file} has no non-gap column.")
-                    gap_cols = gap_cols[gap_cols < last_col_idx]
-                    
-                    # Exclude columns from gap_cols with a continuous length less than 3.
-                    gap_cols = filter_array(gap_cols, cutoff=3)
-                    
-                    linker = seqs[0][gap_cols]
-                    for i, seq in enumerate(seqs[1:], start=1):
-                        shuffled_linker = np.random.permutation(linker)
-                        seqs[i][gap_cols] = shuffled_linker
-                    
-                    with open(os.path.join(tmp_align_dir, file), "w") as f:
-                        for name, seq in zip(names, seqs):
-                            f.write(name + "\n" + "".join(seq) + "\n")
\ No newline at end of file
+            os.makedirs(tmp_align_dir, exist_ok=True)
+
+            domain_msas = [
+                chain_msas[inner_ab.name] if inner_ab.name in chain_msas
+                else read_chain_msas(os.path.join(alignment_dir, inner_ab.name))
+                for inner_ab in inner_abs
+            ]
+            merged = merge_inchain_msas(inner_abs[0].full_seq, domain_msas)
+
+            if "paired_hits.a3m" not in merged and os.path.exists(os.path.join(tmp_align_dir, "paired_hits.a3m")):
+                os.remove(os.path.join(tmp_align_dir, "paired_hits.a3m"))
+            for file, (names, seqs) in merged.items():
+                write_msa(
+                    os.path.join(tmp_align_dir, file),
+                    names,
+                    rebuild_linker(encode_seqs(seqs), file, get_linker_rng(seed, ori_name, file)),
+                    atomic=True,
+                )
@@ -1,20 +1,95 @@
 import multiprocessing as mp
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
+import itertools
+import pickle
 import os
 
+_shared_objects = {}  # Objects registered with DynamicExecutor.share, keyed by handle
+# Record the pickled size of the process pool tasks when DynamicExecutor is not told otherwise.
+REPORT_SERIALIZATION = os.environ.get("ABCFOLD_REPORT_SERIALIZATION", "0") == "1"
+_shared_keys = itertools.count()
+
+
+class SharedHandle:
+    """
+    Picklable reference to a large read-only object registered with DynamicExecutor.share.
+    Only the key is sent with a task, the object is looked up in the worker.
+    """
+    def __init__(self, key):
+        self.key = key
+
+    def get(self):
+        return _shared_objects[self.key]
+
+
+def resolve_shared(obj):
+    """Return the object referred to by a SharedHandle, any other object unchanged."""
+    if isinstance(obj, SharedHandle):
+        return obj.get()
+    return obj
+
+
+def _init_shared_objects(shared_objects):
+    # With fork the workers already inherit the objects and initargs are not pickled,
+    # with spawn they are pickled once per worker instead of once per task.
+    _shared_objects.update(shared_objects)
+
+
+class _ReportingExecutor:
+    """
+    Process pool proxy recording the pickled size of every task, used only when
+    DynamicExecutor is created with report_serialization, as each task is pickled twice.
+    """
+    def __init__(self, executor, stats):
+        self._executor = executor
+        self._stats = stats
+
+    def submit(self, fn, *args, **kwargs):
+        try:
+            size = len(pickle.dumps((fn, args, kwargs), protocol=pickle.HIGHEST_PROTOCOL))
+            self._stats.setdefault(getattr(fn, "__name__", str(fn)), []).append(size)
+        except Exception:
+            pass  # The executor reports unpicklable tasks itself.
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._executor, name)
+
+
 class DynamicExecutor:
-    def __init__(self, process_threshold=20, max_workers=None):
+    def __init__(self, process_threshold=20, max_workers=None, report_serialization=None):
         """
         Initialize the dynamic executor.
         :param process_threshold: Threshold for the number of tasks to use ProcessPoolExecutor.
         :param max_workers: Maximum number of worker threads/processes.
+        :param report_serialization: Pickle every process pool task a second time to record its size,
+            off unless ABCFOLD_REPORT_SERIALIZATION=1 when None.
         """
         self.process_threshold = process_threshold
         self.max_workers = max_workers or os.cpu_count()
+        self.record_serialization = (
+            REPORT_SERIALIZATION if report_serialization is None else report_serialization
+        )
         self._process_pool = None
         self._thread_pool = None
-    
+        self._shared_keys = []
+        self.serialization_stats = {}  # Pickled bytes of every process pool task, by function name
+
+    def share(self, obj):
+        """
+        Register a large read-only object once and return a SharedHandle to pass to tasks
+        instead of the object. Tasks get the object back with resolve_shared.
+        Every shared object is sent to every worker, so only share objects used by many tasks,
+        not the arguments of a single task. Objects must be shared before the process pool is started.
+        """
+        if self._process_pool:
+            raise RuntimeError("Objects must be shared before the process pool is started.")
+        key = next(_shared_keys)
+        _shared_objects[key] = obj
+        self._shared_keys.append(key)
+        return SharedHandle(key)
+
     def get_executor(self, task_count):
         """
         Return the appropriate executor based on the number of tasks.
@@ -23,7 +98,11 @@ class DynamicExecutor:
             if not self._process_pool:
                 self._process_pool = ProcessPoolExecutor(
                     max_workers=self.max_workers,
+                    initializer=_init_shared_objects,
+                    initargs=({key: _shared_objects[key] for key in self._shared_keys},),
                 )
+            if self.record_serialization:
+                return _ReportingExecutor(self._process_pool, self.serialization_stats)
             return self._process_pool
         else:
             if not self._thread_pool:
@@ -31,7 +110,16 @@ class DynamicExecutor:
                     max_workers=self.max_workers
                 )
             return self._thread_pool
-    
+
+    def report_serialization(self):
+        """Print the number of tasks and pickled bytes sent to the process pool per function."""
+        for name, sizes in self.serialization_stats.items():
+            print(
+                "Task serialization {}: {} tasks, {} bytes in total, {} bytes at most".format(
+                    name, len(sizes), sum(sizes), max(sizes)
+                )
+            )
+
     def shutdown(self):
         """Shut down all executors"""
         if self._process_pool:
@@ -40,12 +128,16 @@ class DynamicExecutor:
         if self._thread_pool:
             self._thread_pool.shutdown()
             self._thread_pool = None
+        self.report_serialization()
+        for key in self._shared_keys:
+            _shared_objects.pop(key, None)
+        self._shared_keys = []
 
 @contextmanager
-def dynamic_executor_context(process_threshold=20, max_workers=None):
+def dynamic_executor_context(process_threshold=20, max_workers=None, report_serialization=None):
     """Context manager for automatic management of executor lifetime."""
-    executor = DynamicExecutor(process_threshold, max_workers)
+    executor = DynamicExecutor(process_threshold, max_workers, report_serialization)
     try:
         yield executor
     finally:
-        executor.shutdown()
\ No newline at end of file
+        executor.shutdown()
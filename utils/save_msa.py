@@ -1,7 +1,12 @@
 from openfold.np.residue_constants import ID_TO_HHBLITS_AA
-from itertools import chain
+from utils.msa_codec import write_msa
 import numpy as np
 
+# ASCII code of every HHblits amino acid id.
+HHBLITS_ID_TO_ASCII = np.array(
+    [ord(ID_TO_HHBLITS_AA[i]) for i in range(len(ID_TO_HHBLITS_AA))], dtype=np.uint8
+)
+
 def save_msa(
     msa: np.ndarray,
     output_file: str,
@@ -9,7 +14,5 @@ def save_msa(
     """
     Save msa to file.
     """
-    with open(output_file, "w") as f:
-        names = [">seq_{}".format(i) for i in range(msa.shape[0])]
-        seqs = ["".join([ID_TO_HHBLITS_AA[aa_id] for aa_id in seq]) for seq in msa]
-        f.write("\n".join(chain(*zip(names, seqs))))
\ No newline at end of file
+    names = [">seq_{}".format(i) for i in range(msa.shape[0])]
+    write_msa(output_file, names, HHBLITS_ID_TO_ASCII[np.asarray(msa, dtype=np.int64)], end="")
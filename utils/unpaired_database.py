@@ -0,0 +1,128 @@
+import os
+import numpy as np
+from utils.database import database_registry
+from utils.get_msa_utils import batch_hamming
+
+SHARD_SUFFIX = ".shard"
+
+
+class UnpairedShard:
+    """
+    CDR3 headers and sequences of one per-length FASTA file of the unpaired database.
+
+    The CDR3 of every record is stored as a row of a fixed-width uint8 matrix,
+    so the distance of a query CDR3 to all records is a single array expression.
+    The sequences are stored as one blob with offsets. The shard is either held
+    in memory (parsed from the FASTA file) or opened with np.memmap from the
+    binary copy written by convert_to_shard.
+    """
+
+    def __init__(self, cdr3, cdr3_lengths, seq_blob, seq_offsets):
+        self.cdr3 = cdr3  # (N, W) uint8 CDR3 of each record, zero padded
+        self.cdr3_lengths = cdr3_lengths  # (N,) CDR3 length of each record
+        self.seq_blob = seq_blob  # uint8 concatenation of all sequences
+        self.seq_offsets = seq_offsets  # (N + 1,) start of each sequence in seq_blob
+
+    @classmethod
+    def from_fasta(cls, fasta_path):
+        with open(fasta_path, "r") as f:
+            lines_list = f.read().splitlines()
+        cdr3_list = [name.lstrip(">").encode("ascii") for name in lines_list[0::2]]
+        seq_bytes = [seq.encode("ascii") for seq in lines_list[1::2]]
+
+        cdr3_lengths = np.array([len(cdr3) for cdr3 in cdr3_list], dtype=np.int16)
+        width = int(cdr3_lengths.max()) if cdr3_lengths.size > 0 else 0
+        cdr3 = np.zeros((len(cdr3_list), width), dtype=np.uint8)
+        for i, name in enumerate(cdr3_list):
+            cdr3[i, : len(name)] = np.frombuffer(name, dtype=np.uint8)
+
+        seq_offsets = np.zeros(len(seq_bytes) + 1, dtype=np.int64)
+        np.cumsum([len(seq) for seq in seq_bytes], out=seq_offsets[1:])
+        seq_blob = np.frombuffer(b"".join(seq_bytes), dtype=np.uint8)
+
+        return cls(cdr3, cdr3_lengths, seq_blob, seq_offsets)
+
+    @classmethod
+    def from_shard(cls, shard_dir):
+        cdr3 = np.load(os.path.join(shard_dir, "cdr3.npy"), mmap_mode="r")
+        cdr3_lengths = np.load(os.path.join(shard_dir, "cdr3_lengths.npy"), mmap_mode="r")
+        seq_offsets = np.load(os.path.join(shard_dir, "offsets.npy"), mmap_mode="r")
+        blob_path = os.path.join(shard_dir, "seqs.bin")
+        if os.path.getsize(blob_path) > 0:
+            seq_blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            seq_blob = np.zeros(0, dtype=np.uint8)
+        return cls(cdr3, cdr3_lengths, seq_blob, seq_offsets)
+
+    def save_shard(self, shard_dir):
+        # Write to a temporary directory first so readers never see a partial shard.
+        tmp_dir = "{}.{}.tmp".format(shard_dir, os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        np.save(os.path.join(tmp_dir, "cdr3.npy"), np.asarray(self.cdr3))
+        np.save(os.path.join(tmp_dir, "cdr3_lengths.npy"), np.asarray(self.cdr3_lengths))
+        np.save(os.path.join(tmp_dir, "offsets.npy"), np.asarray(self.seq_offsets))
+        with open(os.path.join(tmp_dir, "seqs.bin"), "wb") as f:
+            f.write(np.asarray(self.seq_blob).tobytes())
+
+        if os.path.exists(shard_dir):
+            for file in os.listdir(shard_dir):
+                os.remove(os.path.join(shard_dir, file))
+            os.rmdir(shard_dir)
+        os.rename(tmp_dir, shard_dir)
+
+    @property
+    def n_rows(self):
+        return self.cdr3_lengths.shape[0]
+
+    def cdr3_distances(self, query_cdr3):
+        """
+        Bit-level Hamming distance between query_cdr3 and the CDR3 of every record,
+        same as get_msa_utils.hamming_distance. Records whose CDR3 length differs
+        from the query get the maximum int32 value.
+        """
+        return batch_hamming(query_cdr3, self.cdr3, lengths=self.cdr3_lengths)
+
+    def get_seqs(self, rows=None):
+        """
+        Return the sequences of the given rows (all rows if None) as a list of strings.
+        """
+        if rows is None:
+            rows = np.arange(self.n_rows)
+        rows = np.asarray(rows, dtype=np.int64)
+        if rows.shape[0] == 0:
+            return []
+
+        # Decode the covering span once and slice the strings from it.
+        start = self.seq_offsets[rows.min()]
+        span = self.seq_blob[start : self.seq_offsets[rows.max() + 1]].tobytes().decode("ascii")
+        starts = (np.asarray(self.seq_offsets[rows]) - start).tolist()
+        ends = (np.asarray(self.seq_offsets[rows + 1]) - start).tolist()
+        return [span[s:e] for s, e in zip(starts, ends)]
+
+
+def get_shard_dir(fasta_path):
+    """Directory of the binary shard stored next to the FASTA file."""
+    return os.path.splitext(fasta_path)[0] + SHARD_SUFFIX
+
+
+def convert_to_shard(fasta_path):
+    shard_dir = get_shard_dir(fasta_path)
+    UnpairedShard.from_fasta(fasta_path).save_shard(shard_dir)
+    return shard_dir
+
+
+def load_unpaired_shard(fasta_path):
+    """
+    Load one file of the unpaired database, preferring its shard when it is up to date.
+    Memory-mapped shards are kept by the database registry, FASTA files are parsed per call.
+    """
+    shard_dir = get_shard_dir(fasta_path)
+    if os.path.exists(os.path.join(shard_dir, "seqs.bin")) and (
+        not os.path.exists(fasta_path)
+        or os.path.getmtime(shard_dir) >= os.path.getmtime(fasta_path)
+    ):
+        return database_registry.get(
+            "unpaired_shard", fasta_path, lambda: UnpairedShard.from_shard(shard_dir)
+        )
+
+    return UnpairedShard.from_fasta(fasta_path)